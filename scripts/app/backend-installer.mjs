@@ -25,7 +25,8 @@ export class BackendInstaller {
         {"name": "tqdm", "version": "4.64.1"}, 
         {"name": "mashumaro", "version": "3.3"},
         {"name": "wheel", "version": "0.38.4"},
-        {"name": "scipy", "version": "1.10.0"}
+        {"name": "scipy", "version": "1.10.0"},
+        {"name": "safetensors", "version": "0.2.8"}
     ]
 
     progress = new ProgressTracker()
@@ -0,0 +1,392 @@
+import os
+import sys
+import gc
+import json
+import shutil
+import platform
+import argparse
+import tempfile
+import statistics
+from contextlib import redirect_stdout
+from threading import Condition
+from time import perf_counter
+from uuid import uuid4
+from benchmarks.model_loading import peak_rss
+
+# Benchmark of the image generator end to end on CPU with tiny stand-in models, so changes of the generator
+# can be compared against a baseline without downloading models or having a GPU, run from the server folder:
+#
+#   python -m benchmarks.generator [--output results.json] [--baseline baseline.json]
+#
+# Generator logs are written to stderr, results are written as JSON to the output file or stdout.
+
+def percentile(values : list[float], fraction : float) -> float | None:
+    if len(values) == 0:
+        return None
+
+    ordered = sorted(values)
+    return ordered[min(round(fraction * (len(ordered) - 1)), len(ordered) - 1)]
+
+def summary(values : list[float]) -> dict:
+    return {
+        "count" : len(values),
+        "mean" : round(statistics.mean(values), 6) if len(values) > 0 else None,
+        "p50" : round(percentile(values, 0.5), 6) if len(values) > 0 else None,
+        "p95" : round(percentile(values, 0.95), 6) if len(values) > 0 else None
+    }
+
+class TaskRecorder:
+    """Times of progress callbacks of generated tasks."""
+
+    def __init__(self, url_for_outputs : str):
+        self.url_for_outputs = url_for_outputs
+
+        # Task identifier -> time of adding, times of denoising steps, time of completion
+        self.added : dict = {}
+        self.steps : dict = {}
+        self.finished : dict = {}
+
+        self.condition = Condition()
+
+    def task(self, prompt : str, settings, outputs : int = 1, priority = None):
+        from rendering.tasks import ImageGeneratorTask, ImageGeneratorOutput
+
+        task = ImageGeneratorTask(
+            prompt=prompt,
+            outputs=[ImageGeneratorOutput(id=uuid4(), url=os.path.join(self.url_for_outputs, f"{uuid4()}.jpg")) for _ in range(outputs)],
+            settings=settings,
+            callback=self.callback,
+            priority=priority
+        )
+
+        self.steps[task.id] = []
+
+        return task
+
+    def add(self, generator, tasks : list):
+        for task in tasks:
+            self.added[task.id] = perf_counter()
+            generator.add_task(task)
+
+    def callback(self, task, progress : float, seed : int, error : str | None = None):
+        now = perf_counter()
+
+        if error is not None:
+            print(f"[BENCH] Task failed: {error}", file=sys.stderr)
+
+        with self.condition:
+            if progress >= 1.0:
+                self.finished[task.id] = now
+                self.condition.notify_all()
+            else:
+                self.steps[task.id].append(now)
+
+    def wait(self, tasks : list, timeout : float):
+        with self.condition:
+            is_finished = self.condition.wait_for(lambda: all(task.id in self.finished for task in tasks), timeout=timeout)
+
+        if is_finished == False:
+            raise TimeoutError(f"Tasks are not finished in {timeout:.0f}s")
+
+    # Time between consecutive denoising steps of every task
+    def step_latencies(self, tasks : list) -> list[float]:
+        latencies = []
+
+        for task in tasks:
+            times = self.steps[task.id]
+            latencies += [end - start for start, end in zip(times, times[1:])]
+
+        return latencies
+
+    def latencies(self, tasks : list) -> list[float]:
+        return [self.finished[task.id] - self.added[task.id] for task in tasks]
+
+def create_generator(url_for_root : str, url_for_preview : str, url_for_upscale : str, device : str, dimension : int):
+    from rendering.generator import ImageGenerator
+
+    os.makedirs(url_for_root, exist_ok=True)
+
+    with open(os.path.join(url_for_root, "config.json"), "w") as file:
+        json.dump({
+            "url_for_data" : os.path.join(url_for_root, "data"),
+            "preview_models" : [{ "name" : "Preview", "path" : url_for_preview, "revision" : None, "downloaded_file_bytes" : 1, "total_file_bytes" : 1 }],
+            "upscale_models" : [{ "name" : "Upscale", "path" : url_for_upscale, "revision" : None, "downloaded_file_bytes" : 1, "total_file_bytes" : 1 }]
+        }, file)
+
+    generator = ImageGenerator(url_for_root=url_for_root, devices=[device], warm_up_enabled=False)
+
+    # Sizes of real models would take minutes per image on CPU
+    generator.base_dimension = dimension
+    generator.upscaled_dimension = dimension * 4
+
+    generator.start()
+
+    return generator
+
+# Loading from disk for the first time in the process, again after eviction, and reusing the loaded pipeline
+def measure_loading(generator, settings) -> dict:
+    worker = generator.workers[0]
+
+    def load() -> float:
+        start = perf_counter()
+        worker.prepare_model_if_needed(settings)
+        return round(perf_counter() - start, 6)
+
+    cold = load()
+    cached = load()
+
+    worker.stop()
+    gc.collect()
+
+    warm = load()
+
+    return { "cold" : cold, "warm" : warm, "cached" : cached }
+
+# Denoising step latency of the pipeline alone, through the generator, and through the generator with previews
+def measure_steps(generator, recorder : TaskRecorder, settings, repeats : int, timeout : float) -> dict:
+    worker = generator.workers[0]
+    width, height = generator.dimensions_for_settings(settings)
+
+    worker.prepare_model_if_needed(settings)
+
+    direct = []
+
+    for _ in range(repeats):
+        times = []
+
+        worker.pipe(prompt="a", width=width, height=height, num_inference_steps=settings.steps, callback=lambda step, timestep, latents: times.append(perf_counter()))
+        direct += [end - start for start, end in zip(times, times[1:])]
+
+    def generate(preview_every_steps : int) -> list[float]:
+        generator.preview_every_steps = preview_every_steps
+        generator.preview_every_ms = 0
+
+        tasks = [recorder.task("a", settings) for _ in range(repeats)]
+
+        # Tasks are added one by one, so they are never batched together
+        for task in tasks:
+            recorder.add(generator, [task])
+            recorder.wait([task], timeout)
+
+        return recorder.step_latencies(tasks)
+
+    callbacks = generate(preview_every_steps=settings.steps * 10)
+    previews = generate(preview_every_steps=1)
+
+    direct_step = statistics.median(direct)
+    callbacks_step = statistics.median(callbacks)
+    previews_step = statistics.median(previews)
+
+    return {
+        "direct" : summary(direct),
+        "callbacks" : summary(callbacks),
+        "previews" : summary(previews),
+        "callback_overhead" : round(callbacks_step - direct_step, 6),
+        "preview_overhead" : round(previews_step - callbacks_step, 6)
+    }
+
+# Streams of tasks added at once, as many at a time as users queue them
+def task_streams(recorder : TaskRecorder, url_for_preview : str, url_for_source : str, steps : int) -> dict:
+    from rendering.tasks import ImageGeneratorTaskSettings, ImageGeneratorTaskType, ImageGeneratorTaskPriority, ImageGeneratorTaskUpscaleSettings
+
+    def preview(outputs : int = 2, priority = None, **settings):
+        return recorder.task("a", ImageGeneratorTaskSettings(model=url_for_preview, steps=steps, **settings), outputs=outputs, priority=priority)
+
+    def upscale(dimension : int):
+        settings = ImageGeneratorTaskSettings(
+            model=url_for_preview,
+            steps=steps,
+            type=ImageGeneratorTaskType.upscale,
+            initial_url=url_for_source,
+            upscale=ImageGeneratorTaskUpscaleSettings(dimension=dimension)
+        )
+
+        return recorder.task("a", settings, outputs=1)
+
+    methods = ["dpm", "ddim", "dpm-ss"]
+
+    return {
+        # Same settings, batched together
+        "uniform" : lambda: [preview() for _ in range(12)],
+
+        # Sampling methods, seamless tiling, sizes and priorities changing from task to task
+        "mixed" : lambda: [
+            preview(
+                outputs=1 + index % 3,
+                method=methods[index % len(methods)],
+                seamless=1 if index % 4 == 0 else 0,
+                dimensions=[1.0, 0.75, 0.5][index % 3],
+                priority=ImageGeneratorTaskPriority.bulk if index % 5 == 0 else None
+            )
+            for index in range(12)
+        ],
+
+        # Previews interleaved with upscales of another model
+        "upscales" : lambda: [task for index in range(3) for task in [preview(), preview(outputs=1), upscale(dimension=256)]]
+    }
+
+def measure_stream(generator, recorder : TaskRecorder, tasks : list, timeout : float) -> dict:
+    scheduled = generator.tasks.stats
+    pipelines = generator.workers[0].pipelines.stats
+
+    start = perf_counter()
+
+    recorder.add(generator, tasks)
+    recorder.wait(tasks, timeout)
+
+    duration = perf_counter() - start
+    images = sum(len(task.outputs) for task in tasks)
+
+    scheduler_stats = generator.tasks.stats
+    pipelines_stats = generator.workers[0].pipelines.stats
+
+    return {
+        "tasks" : len(tasks),
+        "images" : images,
+        "duration" : round(duration, 6),
+        "tasks_per_second" : round(len(tasks) / duration, 6),
+        "images_per_second" : round(images / duration, 6),
+        "latency" : summary(recorder.latencies(tasks)),
+        "step_latency" : summary(recorder.step_latencies(tasks)),
+        "reordered" : scheduler_stats["reordered"] - scheduled["reordered"],
+        "reloads_avoided" : scheduler_stats["reloads_avoided"] - scheduled["reloads_avoided"],
+        "model_loads" : pipelines_stats["misses"] - pipelines["misses"]
+    }
+
+def run(url_for_work : str, url_for_models : str, device : str, dimension : int, steps : int, repeats : int, streams : list[str], timeout : float) -> dict:
+    import torch
+    import diffusers
+    from PIL import Image
+    from benchmarks.tiny import build_models
+    from rendering.tasks import ImageGeneratorTaskSettings, ImageGeneratorTaskType
+
+    report = {
+        "environment" : {
+            "python" : platform.python_version(),
+            "platform" : platform.platform(),
+            "torch" : torch.__version__,
+            "diffusers" : diffusers.__version__,
+            "device" : device,
+            "dimension" : dimension,
+            "steps" : steps,
+            "repeats" : repeats
+        },
+        "peak_rss" : {}
+    }
+
+    start = perf_counter()
+    url_for_preview, url_for_upscale = build_models(url_for_models)
+    report["environment"]["models_build"] = round(perf_counter() - start, 3)
+
+    url_for_outputs = os.path.join(url_for_work, "outputs")
+    os.makedirs(url_for_outputs, exist_ok=True)
+
+    # Source image of upscales, a quarter of the upscaled size
+    url_for_source = os.path.join(url_for_work, "source.png")
+    Image.effect_noise((dimension, dimension), 64).convert("RGB").save(url_for_source)
+
+    recorder = TaskRecorder(url_for_outputs)
+    generator = create_generator(os.path.join(url_for_work, "root"), url_for_preview, url_for_upscale, device, dimension)
+
+    report["peak_rss"]["start"] = round(peak_rss(), 1)
+
+    preview_settings = ImageGeneratorTaskSettings(model=url_for_preview, steps=steps, batch=1)
+    upscale_settings = ImageGeneratorTaskSettings(model=url_for_preview, steps=steps, type=ImageGeneratorTaskType.upscale)
+
+    report["load"] = {
+        "preview" : measure_loading(generator, preview_settings),
+        "upscale" : measure_loading(generator, upscale_settings)
+    }
+    report["peak_rss"]["load"] = round(peak_rss(), 1)
+
+    report["steps"] = measure_steps(generator, recorder, preview_settings, repeats, timeout)
+    report["peak_rss"]["steps"] = round(peak_rss(), 1)
+
+    report["streams"] = {}
+
+    for name, tasks in task_streams(recorder, url_for_preview, url_for_source, steps).items():
+        if name not in streams:
+            continue
+
+        report["streams"][name] = measure_stream(generator, recorder, tasks(), timeout)
+        report["peak_rss"][name] = round(peak_rss(), 1)
+
+    report["embeddings"] = generator.embeddings_stats
+
+    return report
+
+# Numeric results by their dotted paths
+def flatten(report : dict, prefix : str = "") -> dict:
+    values = {}
+
+    for name, value in report.items():
+        if isinstance(value, dict):
+            values.update(flatten(value, f"{prefix}{name}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[f"{prefix}{name}"] = value
+
+    return values
+
+def compare(report : dict, baseline : dict) -> dict:
+    current = flatten(report)
+    previous = flatten(baseline)
+
+    changes = {}
+
+    for name, value in current.items():
+        if name.startswith("environment.") or name not in previous:
+            continue
+
+        change = (value - previous[name]) / previous[name] if previous[name] != 0 else None
+        changes[name] = { "baseline" : previous[name], "current" : value, "change" : round(change, 4) if change is not None else None }
+
+    return changes
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the image generator with tiny stand-in models")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--dimension", type=int, default=64, help="Size of generated images (in pixels)")
+    parser.add_argument("--steps", type=int, default=10)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--streams", default="uniform,mixed,upscales", help="Comma separated task streams to run")
+    parser.add_argument("--timeout", type=float, default=600, help="Maximum time of every generation (in seconds)")
+    parser.add_argument("--models", default=None, help="Folder of tiny models, built in a temporary folder if not specified")
+    parser.add_argument("--output", default=None, help="Path of the JSON file with results (printed otherwise)")
+    parser.add_argument("--baseline", default=None, help="Path of the JSON file with results to compare with")
+
+    args = parser.parse_args()
+
+    url_for_work = tempfile.mkdtemp(prefix="varnava-benchmark-")
+
+    try:
+        # Logs of the generator would break JSON printed to stdout
+        with redirect_stdout(sys.stderr):
+            report = run(
+                url_for_work,
+                url_for_models=args.models or os.path.join(url_for_work, "models"),
+                device=args.device,
+                dimension=args.dimension,
+                steps=args.steps,
+                repeats=args.repeats,
+                streams=[stream.strip() for stream in args.streams.split(",")],
+                timeout=args.timeout
+            )
+    finally:
+        shutil.rmtree(url_for_work, ignore_errors=True)
+
+    if args.baseline is not None:
+        with open(args.baseline) as file:
+            report["comparison"] = compare(report, json.load(file))
+
+        for name, change in report["comparison"].items():
+            if change["change"] is not None:
+                print(f"[BENCH] {name}: {change['baseline']} -> {change['current']} ({change['change'] * 100:+.1f}%)", file=sys.stderr)
+
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=4)
+    else:
+        print(json.dumps(report, indent=4))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+import os
+import sys
+import gc
+import json
+import shutil
+import resource
+import argparse
+import tempfile
+import subprocess
+from time import perf_counter
+
+# Benchmark of loading a downloaded model from pickle and safetensors weights, every format is loaded
+# by a new process so peak host memory is its own, run from the server folder:
+#
+#   python -m benchmarks.model_loading <model folder> [--device cuda:0] [--output results.json]
+
+FORMATS = ["pickle", "safetensors"]
+
+# Peak resident memory of the process (in MB)
+def peak_rss() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Linux reports kilobytes, macOS reports bytes
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+# Copy of a model folder made of links to its files, without weights of the other format
+def prepare_model(url_for_model : str, url_for_copy : str, format : str):
+    for root, directories, filenames in os.walk(url_for_model):
+        relative = os.path.relpath(root, url_for_model)
+        os.makedirs(os.path.join(url_for_copy, relative), exist_ok=True)
+
+        for filename in filenames:
+            if format == "pickle" and filename.endswith(".safetensors"):
+                continue
+
+            os.symlink(os.path.realpath(os.path.join(root, filename)), os.path.join(url_for_copy, relative, filename))
+
+    # Weights are converted inside the copy, so the model itself is left as is
+    if format == "safetensors":
+        from rendering.weights import convert_to_safetensors
+        convert_to_safetensors(url_for_copy)
+
+        for root, directories, filenames in os.walk(url_for_copy):
+            for filename in filenames:
+                if filename.endswith(".bin"):
+                    os.remove(os.path.join(root, filename))
+
+def load_model(url_for_model : str, device : str):
+    import torch
+    from diffusers import DiffusionPipeline
+
+    with open(os.path.join(url_for_model, "model_index.json")) as file:
+        index = json.load(file)
+
+    arguments = { "safety_checker" : None } if "safety_checker" in index else {}
+    dtype = torch.float16 if torch.device(device).type == "cuda" else torch.float32
+
+    pipe = DiffusionPipeline.from_pretrained(url_for_model, torch_dtype=dtype, local_files_only=True, **arguments)
+    pipe = pipe.to(device)
+
+    if torch.device(device).type == "cuda":
+        torch.cuda.synchronize()
+
+    return pipe
+
+# Loads the model in this process twice, the second load being the reload of an evicted model
+def run_child(url_for_model : str, device : str) -> dict:
+    start = perf_counter()
+    import torch
+    import diffusers
+    imports = perf_counter() - start
+
+    start = perf_counter()
+    pipe = load_model(url_for_model, device)
+    cold = perf_counter() - start
+    cold_peak_rss = peak_rss()
+
+    del pipe
+    gc.collect()
+
+    start = perf_counter()
+    pipe = load_model(url_for_model, device)
+    reload = perf_counter() - start
+
+    return {
+        "imports" : round(imports, 3),
+        "cold_load" : round(cold, 3),
+        "reload" : round(reload, 3),
+        "cold_peak_rss" : round(cold_peak_rss, 1),
+        "peak_rss" : round(peak_rss(), 1)
+    }
+
+def run(url_for_model : str, device : str, formats : list[str]) -> dict:
+    results = {}
+
+    for format in formats:
+        url_for_copy = tempfile.mkdtemp(prefix=f"varnava-benchmark-{format}-")
+
+        try:
+            prepare_model(url_for_model, url_for_copy, format)
+
+            process = subprocess.run(
+                [sys.executable, "-m", "benchmarks.model_loading", url_for_copy, "--device", device, "--child"],
+                cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                capture_output=True,
+                text=True
+            )
+
+            if process.returncode != 0:
+                print(process.stderr, file=sys.stderr)
+                results[format] = { "error" : process.returncode }
+                continue
+
+            results[format] = json.loads(process.stdout.strip().splitlines()[-1])
+        finally:
+            shutil.rmtree(url_for_copy, ignore_errors=True)
+
+        print(f"[BENCH] {format}: {json.dumps(results[format])}", file=sys.stderr)
+
+    return {
+        "model" : url_for_model,
+        "device" : device,
+        "results" : results
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of model loading from pickle and safetensors weights")
+    parser.add_argument("model", help="Folder of a downloaded model")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--formats", default=",".join(FORMATS), help="Comma separated formats to load")
+    parser.add_argument("--output", default=None, help="Path of the JSON file with results (printed otherwise)")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+
+    if args.child == True:
+        print(json.dumps(run_child(args.model, args.device)))
+        return
+
+    report = run(os.path.abspath(args.model), args.device, [format.strip() for format in args.formats.split(",")])
+
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=4)
+    else:
+        print(json.dumps(report, indent=4))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+import os
+import json
+import torch
+
+# Tiny randomly initialised stand-ins of the preview and upscaling models, which have the same components
+# and are loaded the same way as downloaded models, but generate noise in milliseconds on CPU
+
+TEXT_ENCODER_DIMENSION = 32
+
+def build_tokenizer(url_for_model : str):
+    from transformers import CLIPTokenizer
+
+    url_for_files = os.path.join(url_for_model, "tokenizer-files")
+    os.makedirs(url_for_files, exist_ok=True)
+
+    with open(os.path.join(url_for_files, "vocab.json"), "w") as file:
+        json.dump({ "<|startoftext|>" : 0, "<|endoftext|>" : 1, "a</w>" : 2 }, file)
+
+    with open(os.path.join(url_for_files, "merges.txt"), "w") as file:
+        file.write("#version: 0.2\n")
+
+    return CLIPTokenizer(os.path.join(url_for_files, "vocab.json"), os.path.join(url_for_files, "merges.txt"), model_max_length=77)
+
+def build_text_encoder():
+    from transformers import CLIPTextModel, CLIPTextConfig
+
+    return CLIPTextModel(CLIPTextConfig(
+        bos_token_id=0,
+        eos_token_id=1,
+        hidden_size=TEXT_ENCODER_DIMENSION,
+        intermediate_size=37,
+        num_attention_heads=4,
+        num_hidden_layers=2,
+        vocab_size=1000,
+        max_position_embeddings=77
+    ))
+
+def build_unet(in_channels : int = 4, num_class_embeds : int | None = None):
+    from diffusers import UNet2DConditionModel
+
+    return UNet2DConditionModel(
+        block_out_channels=(32, 64),
+        layers_per_block=1,
+        sample_size=32,
+        in_channels=in_channels,
+        out_channels=4,
+        down_block_types=("DownBlock2D", "CrossAttnDownBlock2D"),
+        up_block_types=("CrossAttnUpBlock2D", "UpBlock2D"),
+        cross_attention_dim=TEXT_ENCODER_DIMENSION,
+        attention_head_dim=4,
+        num_class_embeds=num_class_embeds
+    )
+
+def build_vae(levels : int):
+    from diffusers import AutoencoderKL
+
+    return AutoencoderKL(
+        block_out_channels=[32] * (levels - 1) + [64],
+        in_channels=3,
+        out_channels=3,
+        down_block_types=["DownEncoderBlock2D"] * levels,
+        up_block_types=["UpDecoderBlock2D"] * levels,
+        latent_channels=4
+    )
+
+def build_preview_model(url_for_model : str):
+    from diffusers import StableDiffusionPipeline, DDIMScheduler
+
+    torch.manual_seed(0)
+
+    pipe = StableDiffusionPipeline(
+        unet=build_unet(),
+        vae=build_vae(levels=2),
+        text_encoder=build_text_encoder(),
+        tokenizer=build_tokenizer(url_for_model),
+        scheduler=DDIMScheduler(beta_start=0.00085, beta_end=0.012, beta_schedule="scaled_linear", clip_sample=False, set_alpha_to_one=False),
+        safety_checker=None,
+        feature_extractor=None,
+        requires_safety_checker=False
+    )
+
+    pipe.save_pretrained(url_for_model)
+
+# Latents of the upscaling model have the size of the source image, so its VAE upscales 4 times
+def build_upscale_model(url_for_model : str):
+    from diffusers import StableDiffusionUpscalePipeline, DDIMScheduler, DDPMScheduler
+
+    torch.manual_seed(0)
+
+    pipe = StableDiffusionUpscalePipeline(
+        unet=build_unet(in_channels=7, num_class_embeds=1000),
+        vae=build_vae(levels=3),
+        text_encoder=build_text_encoder(),
+        tokenizer=build_tokenizer(url_for_model),
+        scheduler=DDIMScheduler(beta_start=0.00085, beta_end=0.012, beta_schedule="scaled_linear", clip_sample=False, set_alpha_to_one=False, prediction_type="v_prediction"),
+        low_res_scheduler=DDPMScheduler()
+    )
+
+    pipe.save_pretrained(url_for_model)
+
+# Builds both models inside the folder unless they are built already, returns their paths
+def build_models(url_for_models : str) -> tuple[str, str]:
+    url_for_preview = os.path.join(url_for_models, "tiny-preview")
+    url_for_upscale = os.path.join(url_for_models, "tiny-upscale")
+
+    if os.path.exists(os.path.join(url_for_preview, "model_index.json")) == False:
+        build_preview_model(url_for_preview)
+
+    if os.path.exists(os.path.join(url_for_upscale, "model_index.json")) == False:
+        build_upscale_model(url_for_upscale)
+
+    return url_for_preview, url_for_upscale
@@ -1,9 +1,17 @@
 import os
 import json
+import asyncio
+import traceback
 from dataclasses import dataclass
-from rendering.generator import ImageGenerator
-from db.models import db, Project, Prompt, Output
+from threading import Thread, Event
+from rendering.models import ModelManager
+from db.models import db, Project, Prompt, Output, QueuedTask, CachedResult
+from db.migrations import migrate_tables
+from db.progress import OutputProgressAggregator
+from db.queue import PersistentTaskQueue
+from db.results import ResultCache
 from lib.channel import Channel
+from lib.timing import startup
 
 # Context with all relevant objects and constants
 
@@ -14,10 +22,10 @@ class __Context(object):
     @property
     def url_for_db(self):
         return os.path.join(self.url_for_root, "data.db")
-    
+
     @property
     def url_for_outputs(self):
-        return os.path.join(self.generator.models.url_for_data, "outputs")
+        return os.path.join(self.models.url_for_data, "outputs")
 
     def url_for_output(self, *parts):
         path = self.url_for_outputs
@@ -27,34 +35,113 @@ class __Context(object):
 
         return path
 
+    @property
+    def is_generator_ready(self) -> bool:
+        return self.generator_ready.is_set()
+
     def __init__(self):
         print("[SRV] Loading configuration data")
 
-        self.url_for_root = os.path.join(os.getenv("VARNAVA_DATA_PATH"), "veralomna", "varnava") 
-    
+        self.url_for_root = os.path.join(os.getenv("VARNAVA_DATA_PATH"), "veralomna", "varnava")
+
         print("[SRV] Initialising database")
 
-        self.db = db
-        self.db.init(self.url_for_db)
-        self.db.connect()
-        self.db.create_tables([Project, Prompt, Output])
+        with startup.measure("database"):
+            self.db = db
+            self.db.init(self.url_for_db)
+            self.db.connect()
+            self.db.create_tables([Project, Prompt, Output, QueuedTask, CachedResult])
+
+            migrate_tables(self.db)
+
+            print("[SRV] Clearing unfinished tasks")
+
+            # Outputs of queued tasks are generated again after restart unless they were cancelled
+            queued_ids = list(PersistentTaskQueue.queued_output_ids())
 
-        print("[SRV] Clearing unfinished tasks")
+            query = Output.delete().where(Output.progress < 1.0, (Output.id.not_in(queued_ids)) | (Output.isCancelled == True))
+            query.execute()
 
-        query = Output.delete().where(Output.progress < 1.0)
-        query.execute()
-        
         self.channel = Channel()
 
-        print("[SRV] Initialising generator")
+        # Progress of outputs is stored and announced periodically instead of every denoising step
+        self.progress = OutputProgressAggregator(self.channel)
+        self.progress.start()
+
+        with startup.measure("models"):
+            self.models = ModelManager(self.url_for_root, download_callback=lambda: self.channel.send("resources.update", {}))
+
+        # Images of fixed seeds are reused instead of generating them again
+        self.results = ResultCache(self.url_for_output, self.models)
 
-        self.generator = ImageGenerator(
-            url_for_root=self.url_for_root, 
-            models_download_callback=lambda: self.channel.send("resources.update", {})
-        )
+        # Tasks are stored until completed, they are generated once the generator is started
+        self.queue = PersistentTaskQueue(self.progress, self.results, self.url_for_output)
 
-        self.generator.start()
+        # Generator is initialised in the background, so requests are served while torch and models are loading
+        self.generator = None
+        self.generator_ready = Event()
+
+        Thread(target=self.start_generator, daemon=True, name="varnava-generator-startup").start()
 
         print("[SRV] Ready")
 
-context = __Context()
\ No newline at end of file
+    def start_generator(self):
+        print("[SRV] Initialising generator")
+
+        try:
+            with startup.measure("generator"):
+                # Comma separated list of devices to generate with, e.g. "cuda:0,cuda:1" (all GPUs by default)
+                devices = [device.strip() for device in os.getenv("VARNAVA_DEVICES", "").split(",") if device.strip() != ""]
+
+                # Generator runs in a separate process unless VARNAVA_GENERATOR_PROCESS is set to 0,
+                # generation modules import torch and are imported only when needed
+                if os.getenv("VARNAVA_GENERATOR_PROCESS", "1") != "0":
+                    from rendering.remote import RemoteImageGenerator as generator_class
+                else:
+                    from rendering.generator import ImageGenerator as generator_class
+
+                # Last used model is loaded in the background unless VARNAVA_WARM_UP is set to 0,
+                # models are compiled for image sizes in use if VARNAVA_OPTIMIZED is set to 1
+                generator = generator_class(
+                    url_for_root=self.url_for_root,
+                    models=self.models,
+                    warm_up_callback=lambda info: self.channel.send("generator.ready", info),
+                    warm_up_enabled=os.getenv("VARNAVA_WARM_UP", "1") != "0",
+                    devices=devices,
+                    optimized=os.getenv("VARNAVA_OPTIMIZED", "0") == "1"
+                )
+
+                generator.start()
+
+            self.generator = generator
+
+            # Results are keyed by devices and precisions generating them
+            self.results.execution_identity = generator.execution_identity
+
+            # Tasks left from the previous run and added while starting are generated now
+            with startup.measure("queue"):
+                self.queue.attach(generator)
+        except Exception:
+            print("[SRV] Failed to initialise generator")
+            traceback.print_exc()
+            return
+
+        self.generator_ready.set()
+        self.channel.send("generator.started", {})
+
+        print("[SRV] Generator is ready")
+
+    # Waits for the generator to start without blocking other requests
+    async def wait_for_generator(self, timeout : float | None = None) -> bool:
+        waited = 0.0
+
+        while self.is_generator_ready == False:
+            if timeout is not None and waited >= timeout:
+                return False
+
+            await asyncio.sleep(0.1)
+            waited += 0.1
+
+        return True
+
+context = __Context()
@@ -0,0 +1,24 @@
+from peewee import Database
+from playhouse.migrate import SqliteMigrator, migrate
+from db.models import Output
+
+# Columns added to existing tables after their creation
+COLUMNS = [
+    (Output, "isCancelled"),
+    (Output, "resultKey"),
+    (Output, "isFailed"),
+]
+
+def migrate_tables(db : Database):
+    migrator = SqliteMigrator(db)
+
+    for model, name in COLUMNS:
+        table = model._meta.table_name
+        columns = [column.name for column in db.get_columns(table)]
+
+        if name in columns:
+            continue
+
+        print(f"[SRV] Adding column '{name}' to '{table}'")
+
+        migrate(migrator.add_column(table, name, model._meta.fields[name]))
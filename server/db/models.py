@@ -1,6 +1,6 @@
 import datetime
-from rendering.generator import ImageGeneratorTaskType
-from peewee import SqliteDatabase, Model, CharField, BooleanField, UUIDField, DateTimeField, ForeignKeyField, TextField, BigIntegerField, FloatField
+from rendering.tasks import ImageGeneratorTaskType
+from peewee import SqliteDatabase, Model, CharField, BooleanField, UUIDField, DateTimeField, ForeignKeyField, TextField, BigIntegerField, IntegerField, FloatField
 from db.fields import EnumField, JSONField, generate_uuid
 
 # Database models
@@ -34,3 +34,21 @@ class Output(BaseModel):
     url = TextField()
     isArchived = BooleanField(default=False)
     isFavorite = BooleanField(default=False)
+    isCancelled = BooleanField(default=False)
+    isFailed = BooleanField(default=False)
+    resultKey = CharField(max_length=64, null=True)
+
+class QueuedTask(BaseModel):
+    id = UUIDField(primary_key=True, default=generate_uuid)
+    createdAt = DateTimeField(default=datetime.datetime.now)
+    prompt = ForeignKeyField(Prompt, field="id", backref="tasks")
+    priority = CharField(max_length=32)
+    settings = JSONField(default={})
+    outputs = JSONField(default=[])
+
+class CachedResult(BaseModel):
+    key = CharField(max_length=64, primary_key=True)
+    createdAt = DateTimeField(default=datetime.datetime.now)
+    url = TextField()
+    seed = BigIntegerField(default=0)
+    references = IntegerField(default=0)
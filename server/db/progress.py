@@ -0,0 +1,76 @@
+from threading import Thread, Lock
+from time import sleep
+from uuid import UUID
+from playhouse.shortcuts import model_to_dict
+from db.models import db, Output
+from lib.channel import Channel
+
+class OutputProgressAggregator:
+    """Keeps progress of generated outputs in memory and persists it periodically.
+    All outputs changed since the last flush are written in a single transaction
+    and every one of them is announced with one `output.updated` message.
+    Completed outputs are flushed right away.
+    """
+
+    def __init__(self, channel : Channel, interval : float = 0.5):
+        self.channel = channel
+        self.interval = interval
+
+        # Output identifier -> (progress, seed) not written to the database yet
+        self.changes : dict[UUID, tuple[float, int]] = {}
+        self.lock = Lock()
+
+        # Flushes never interleave, so progress taken earlier is never written after later one
+        self.write_lock = Lock()
+
+        self.daemon : Thread | None = None
+
+    def start(self):
+        self.daemon = Thread(target=self.flush_periodically, daemon=True, name="varnava-progress")
+        self.daemon.start()
+
+    def update(self, seeds : dict[UUID, int], progress : float):
+        with self.lock:
+            for id, seed in seeds.items():
+                self.changes[id] = (progress, seed)
+
+        if progress >= 1.0:
+            self.flush()
+
+    # Marks outputs which cannot be generated, their pending progress is dropped
+    def fail(self, ids : list[UUID]):
+        with self.write_lock:
+            with self.lock:
+                for id in ids:
+                    self.changes.pop(id, None)
+
+            Output.update(isFailed=True).where(Output.id.in_(ids), Output.progress < 1.0).execute()
+
+            for output in Output.select().where(Output.id.in_(ids)):
+                self.channel.send("output.updated", model_to_dict(output))
+
+    def flush_periodically(self):
+        while True:
+            sleep(self.interval)
+
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"[SRV] Failed to store outputs progress: {e}")
+
+    # Called both periodically and on completion, changes are taken, written and announced as a whole
+    def flush(self):
+        with self.write_lock:
+            with self.lock:
+                changes = self.changes
+                self.changes = {}
+
+            if len(changes) == 0:
+                return
+
+            with db.atomic():
+                for id, (progress, seed) in changes.items():
+                    Output.update(progress=progress, seed=seed).where(Output.id == id).execute()
+
+            for output in Output.select().where(Output.id.in_(list(changes.keys()))):
+                self.channel.send("output.updated", model_to_dict(output))
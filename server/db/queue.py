@@ -0,0 +1,129 @@
+from typing import Callable
+from threading import RLock
+from uuid import UUID
+from lib.metrics import metrics
+from db.models import Prompt, Output, QueuedTask
+from db.progress import OutputProgressAggregator
+from db.results import ResultCache
+from rendering.tasks import ImageGeneratorTask, ImageGeneratorOutput, ImageGeneratorTaskSettings, ImageGeneratorTaskPriority
+
+PROGRESS_CALLBACK = metrics.histogram("varnava_progress_callback_seconds", "Time of storing progress of tasks", labels=("stage",))
+
+class PersistentTaskQueue:
+    """Stores generation tasks in the database until they are completed, so queued tasks survive restarts.
+    A task is removed once its outputs are done. Tasks added before the generator is started are only stored,
+    once it is attached all stored tasks are added to it with only their unfinished, not cancelled and not failed outputs.
+    """
+
+    def __init__(self, progress : OutputProgressAggregator, results : ResultCache, url_for_output : Callable[..., str]):
+        self.generator = None
+        self.progress = progress
+        self.results = results
+        self.url_for_output = url_for_output
+
+        # Adding and restoring tasks never interleave, so every stored task is added to the generator once
+        self.lock = RLock()
+
+    # Identifiers of outputs that still have to be generated by stored tasks
+    @staticmethod
+    def queued_output_ids() -> set[UUID]:
+        return set(UUID(id) for queued_task in QueuedTask.select() for id in queued_task.outputs)
+
+    def add(self, task : ImageGeneratorTask, prompt : Prompt):
+        with self.lock:
+            QueuedTask.create(
+                id=task.id,
+                prompt=prompt,
+                priority=task.priority.value,
+                settings=task.settings.to_dict(),
+                outputs=[str(output.id) for output in task.outputs]
+            )
+
+            task.callback = self.update_outputs_progress
+
+            if self.generator is not None:
+                self.generator.add_task(task)
+
+    # Starts generating stored tasks, both left from the previous run and added while the generator was starting
+    def attach(self, generator):
+        with self.lock:
+            self.generator = generator
+            self.restore()
+
+    # Cancels outputs in the generator, or only in the database while the generator is starting, returns identifiers of cancelled outputs
+    def cancel_outputs(self, ids : set[UUID] | None = None) -> list[UUID]:
+        with self.lock:
+            generator = self.generator
+
+            if generator is None:
+                # Cancelled outputs are skipped once stored tasks are restored
+                cancelled = [id for id in self.queued_output_ids() if ids is None or id in ids]
+
+                Output.update(isCancelled=True).where(Output.id.in_(cancelled), Output.progress < 1.0).execute()
+
+                return cancelled
+
+        # Remote generator waits on its process, tasks are still added meanwhile
+        return generator.cancel_outputs(ids)
+
+    # Callback to update outputs, every output is generated with its own seed derived from the task seed
+    def update_outputs_progress(self, task : ImageGeneratorTask, progress : float, seed : int, error : str | None = None):
+        # Failed tasks are removed, so they do not fail again after restart
+        if error is not None:
+            print(f"[SRV] Failed generating task {task.id}: {error}")
+
+            self.progress.fail([taskOutput.id for taskOutput in task.outputs if taskOutput.is_cancelled == False])
+            QueuedTask.delete().where(QueuedTask.id == task.id).execute()
+            return
+
+        with PROGRESS_CALLBACK.time(stage="final" if progress >= 1.0 else "step"):
+            self.store_outputs_progress(task, progress, seed)
+
+    def store_outputs_progress(self, task : ImageGeneratorTask, progress : float, seed : int):
+        seeds = { 
+            taskOutput.id : seed + taskOutput.seed_offset for taskOutput in task.outputs if taskOutput.is_cancelled == False
+        }
+
+        self.progress.update(seeds, progress)
+
+        # Completed outputs are already stored, so the task is never run again
+        if progress >= 1.0:
+            QueuedTask.delete().where(QueuedTask.id == task.id).execute()
+
+            # Images of fixed seeds are kept for requests of the same settings
+            if task.settings.seed != -1:
+                for taskOutput in task.outputs:
+                    if taskOutput.is_cancelled == False:
+                        self.results.store(taskOutput.id, self.results.key_for(task.prompt, task.settings, taskOutput.seed_offset), seed + taskOutput.seed_offset)
+
+    def restore(self):
+        restored = 0
+
+        for queued_task in QueuedTask.select().order_by(QueuedTask.createdAt):
+            ids = [UUID(id) for id in queued_task.outputs]
+            outputs = { output.id : output for output in Output.select().where(Output.id.in_(ids)) }
+
+            # Seeds are derived from positions of outputs in the stored task, so restored outputs keep them as seed offsets
+            remaining = [
+                (index, outputs[id]) for index, id in enumerate(ids)
+                if id in outputs and outputs[id].progress < 1.0 and outputs[id].isCancelled == False and outputs[id].isFailed == False
+            ]
+
+            if len(remaining) == 0:
+                queued_task.delete_instance()
+                continue
+
+            task = ImageGeneratorTask(
+                id=queued_task.id,
+                prompt=queued_task.prompt.value,
+                outputs=[ImageGeneratorOutput(id=output.id, url=self.url_for_output(output.url), seed_offset=index) for index, output in remaining],
+                settings=ImageGeneratorTaskSettings.from_dict(queued_task.settings),
+                callback=self.update_outputs_progress,
+                priority=ImageGeneratorTaskPriority(queued_task.priority)
+            )
+
+            self.generator.add_task(task)
+            restored += 1
+
+        if restored > 0:
+            print(f"[SRV] Restored {restored} queued tasks")
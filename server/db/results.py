@@ -0,0 +1,174 @@
+import os
+import json
+import shutil
+import hashlib
+from typing import Callable
+from uuid import uuid4
+from db.models import db, Output, CachedResult
+from rendering.tasks import ImageGeneratorTaskType, ImageGeneratorTaskSettings
+
+# Settings which do not change generated images, the model is replaced with the one it resolves to
+IGNORED_SETTINGS = ["seed", "batch", "model"]
+
+# Places a file at the destination as a hard link, or as a copy where links are not supported
+def link_file(source : str, destination : str):
+    temporary_url = f"{destination}.{uuid4().hex}.tmp"
+
+    try:
+        try:
+            os.link(source, temporary_url)
+        except OSError:
+            shutil.copyfile(source, temporary_url)
+
+        os.replace(temporary_url, destination)
+    finally:
+        if os.path.exists(temporary_url):
+            os.remove(temporary_url)
+
+class ResultCache:
+    """Content addressed store of images generated with fixed seeds, which are the same every time they are requested.
+    Images are stored as hard links of output files, so removing any of the files never breaks other ones,
+    and are referenced by every not archived output having them. Images no longer referenced are removed from the store.
+    """
+
+    def __init__(self, url_for_output : Callable[..., str], models):
+        self.url_for_output = url_for_output
+
+        # Models manager, or a snapshot of its configuration, resolving models of settings
+        self.models = models
+
+        # Kinds of devices and precisions of the generator, images of other devices are never reused, unknown until it is started
+        self.execution_identity : list[list[str]] | None = None
+
+        # Statistics
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def stats(self) -> dict:
+        return {
+            "hits" : self.hits,
+            "misses" : self.misses,
+            "results" : CachedResult.select().count()
+        }
+
+    # Path and revision of the model generating images of the settings, the same way generators pick it,
+    # so images are never reused once the default model or the revision of a model changes
+    def model_identity(self, settings : ImageGeneratorTaskSettings) -> list:
+        if settings.type == ImageGeneratorTaskType.upscale:
+            models = self.models.upscale_models
+        else:
+            model = self.models.get_preview_model_by_id(settings.model)
+            models = [model] if model is not None else self.models.preview_models
+
+        if len(models) == 0:
+            return [settings.model, None]
+
+        return [models[0].path, models[0].revision]
+
+    # Canonical hash of everything determining the image at the index of a task, none if the seed is random or the generator is not started
+    def key_for(self, prompt : str, settings : ImageGeneratorTaskSettings, index : int) -> str | None:
+        if settings.seed == -1 or self.execution_identity is None:
+            return None
+
+        canonical = {
+            "prompt" : prompt,
+            "settings" : { name : value for name, value in settings.to_dict().items() if name not in IGNORED_SETTINGS },
+            "model" : self.model_identity(settings),
+            "execution" : self.execution_identity,
+            "seed" : settings.seed + index
+        }
+
+        return hashlib.sha256(json.dumps(canonical, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def relative_url_for_key(self, key : str, extension : str = ".jpg") -> str:
+        return "/".join(["results", key[:2], f"{key}{extension}"])
+
+    # Stored result for the key if its image is still present
+    def lookup(self, key : str | None) -> CachedResult | None:
+        result = CachedResult.get_or_none(key=key) if key is not None else None
+
+        if result is not None and os.path.exists(self.url_for_output(result.url)) == False:
+            result.delete_instance()
+            result = None
+
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+
+        return result
+
+    # Completes an output with the stored image without generating it
+    def apply(self, result : CachedResult, output : Output):
+        link_file(self.url_for_output(result.url), self.url_for_output(output.url))
+
+        output.progress = 1.0
+        output.seed = result.seed
+        output.resultKey = result.key
+
+        CachedResult.update(references=CachedResult.references + 1).where(CachedResult.key == result.key).execute()
+
+    # Adds the image of a generated output to the store, or references the stored one
+    def store(self, output_id, key : str | None, seed : int):
+        output = Output.get_or_none(id=output_id)
+
+        if key is None or output is None or output.resultKey is not None:
+            return
+
+        url = self.relative_url_for_key(key, os.path.splitext(output.url)[1])
+        absolute_url = self.url_for_output(url)
+
+        try:
+            if os.path.exists(absolute_url) == False:
+                os.makedirs(os.path.dirname(absolute_url), exist_ok=True)
+                link_file(self.url_for_output(output.url), absolute_url)
+        except OSError as e:
+            print(f"[SRV] Failed to store generated image: {e}")
+            return
+
+        with db.atomic():
+            result = CachedResult.get_or_none(key=key)
+
+            if result is None:
+                CachedResult.create(key=key, url=url, seed=seed, references=1)
+            else:
+                CachedResult.update(references=CachedResult.references + 1).where(CachedResult.key == key).execute()
+
+            Output.update(resultKey=key).where(Output.id == output.id).execute()
+
+    # Drops the reference of an archived output, removing the stored image once nothing references it
+    def release(self, output : Output):
+        if output.resultKey is None:
+            return
+
+        key = output.resultKey
+        output.resultKey = None
+
+        with db.atomic():
+            Output.update(resultKey=None).where(Output.id == output.id).execute()
+            CachedResult.update(references=CachedResult.references - 1).where(CachedResult.key == key).execute()
+
+            result = CachedResult.get_or_none(key=key)
+
+            if result is None or result.references > 0:
+                return
+
+            result.delete_instance()
+
+        try:
+            os.remove(self.url_for_output(result.url))
+        except OSError:
+            pass
+
+    # References the image of an output again once it is restored from the archive
+    def retain(self, output : Output, prompt : str):
+        if output.progress < 1.0 or output.isCancelled == True or output.settings.get("seed", -1) == -1:
+            return
+
+        settings = ImageGeneratorTaskSettings.from_dict({**output.settings, "seed" : output.seed})
+
+        if output.parent is not None:
+            settings.initial_url = self.url_for_output(output.parent.url)
+
+        self.store(output.id, self.key_for(prompt, settings, 0), output.seed)
@@ -16,5 +16,5 @@ class CustomJSONEncoder(json.JSONEncoder):
 def custom_dumps(o):
     return dumps(o, cls=CustomJSONEncoder)
 
-def json(dict):
-    return sanic.response.json(dict, dumps=custom_dumps)
\ No newline at end of file
+def json(dict, status=200):
+    return sanic.response.json(dict, status=status, dumps=custom_dumps)
\ No newline at end of file
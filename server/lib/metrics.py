@@ -0,0 +1,160 @@
+from contextlib import contextmanager
+from threading import Lock
+from time import monotonic
+
+# Upper bounds of histogram buckets (in seconds), from a preview frame to a model load
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+class Counter:
+    """Monotonically increasing value per combination of label values."""
+
+    type = "counter"
+
+    def __init__(self, name : str, documentation : str, labels : tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+
+        self.values : dict[tuple, float] = {}
+        self.lock = Lock()
+
+    def inc(self, amount : float = 1, **labels):
+        key = tuple(str(labels[label]) for label in self.labels)
+
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> list:
+        with self.lock:
+            return [[list(key), value] for key, value in self.values.items()]
+
+class Histogram:
+    """Distribution of observed values per combination of label values, counted by buckets."""
+
+    type = "histogram"
+
+    def __init__(self, name : str, documentation : str, labels : tuple[str, ...] = (), buckets : tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+
+        # Label values -> (counts per bucket, sum, count)
+        self.values : dict[tuple, tuple[list[int], float, int]] = {}
+        self.lock = Lock()
+
+    def observe(self, value : float, **labels):
+        key = tuple(str(labels[label]) for label in self.labels)
+
+        with self.lock:
+            counts, total, count = self.values.get(key, ([0] * len(self.buckets), 0.0, 0))
+
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+
+            self.values[key] = (counts, total + value, count + 1)
+
+    @contextmanager
+    def time(self, **labels):
+        start = monotonic()
+
+        try:
+            yield
+        finally:
+            self.observe(monotonic() - start, **labels)
+
+    def samples(self) -> list:
+        with self.lock:
+            return [[list(key), [list(counts), total, count]] for key, (counts, total, count) in self.values.items()]
+
+def escape(value : str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def format_labels(names : list[str], values : list[str], extra : dict[str, str] = {}) -> str:
+    pairs = list(zip(names, values)) + list(extra.items())
+
+    if len(pairs) == 0:
+        return ""
+
+    return "{" + ",".join(f"{name}=\"{escape(value)}\"" for name, value in pairs) + "}"
+
+def format_value(value : float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class MetricsRegistry:
+    """Metrics of the process, rendered in the Prometheus text format together with snapshots of other processes."""
+
+    def __init__(self):
+        self.metrics : dict[str, Counter | Histogram] = {}
+        self.lock = Lock()
+
+    def register(self, metric : Counter | Histogram) -> Counter | Histogram:
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name : str, documentation : str, labels : tuple[str, ...] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labels))
+
+    def histogram(self, name : str, documentation : str, labels : tuple[str, ...] = (), buckets : tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    # Values of all metrics, which can be sent to another process
+    def snapshot(self) -> dict:
+        with self.lock:
+            metrics = list(self.metrics.values())
+
+        return {
+            metric.name : {
+                "type" : metric.type,
+                "documentation" : metric.documentation,
+                "labels" : list(metric.labels),
+                "buckets" : list(metric.buckets) if isinstance(metric, Histogram) else None,
+                "samples" : metric.samples()
+            }
+            for metric in metrics
+        }
+
+    # Prometheus text format of snapshots, values of the same metric and labels are summed up
+    @staticmethod
+    def render(snapshots : list[dict]) -> str:
+        merged : dict[str, dict] = {}
+
+        for snapshot in snapshots:
+            for name, metric in snapshot.items():
+                target = merged.setdefault(name, { **metric, "values" : {} })
+
+                for labels, value in metric["samples"]:
+                    key = tuple(labels)
+
+                    if metric["type"] == "histogram":
+                        counts, total, count = target["values"].get(key, ([0] * len(metric["buckets"]), 0.0, 0))
+                        target["values"][key] = ([a + b for a, b in zip(counts, value[0])], total + value[1], count + value[2])
+                    else:
+                        target["values"][key] = target["values"].get(key, 0) + value
+
+        lines = []
+
+        for name, metric in sorted(merged.items()):
+            lines.append(f"# HELP {name} {metric['documentation']}")
+            lines.append(f"# TYPE {name} {metric['type']}")
+
+            for key, value in sorted(metric["values"].items()):
+                if metric["type"] == "histogram":
+                    counts, total, count = value
+
+                    for bound, bucket_count in zip(metric["buckets"], counts):
+                        lines.append(f"{name}_bucket{format_labels(metric['labels'], key, { 'le' : format_value(float(bound)) })} {bucket_count}")
+
+                    lines.append(f"{name}_bucket{format_labels(metric['labels'], key, { 'le' : '+Inf' })} {count}")
+                    lines.append(f"{name}_sum{format_labels(metric['labels'], key)} {format_value(float(total))}")
+                    lines.append(f"{name}_count{format_labels(metric['labels'], key)} {count}")
+                else:
+                    lines.append(f"{name}{format_labels(metric['labels'], key)} {format_value(value)}")
+
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
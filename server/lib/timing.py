@@ -0,0 +1,55 @@
+from contextlib import contextmanager
+from threading import Lock
+from time import monotonic
+
+class StartupTimings:
+    """Durations of startup phases of the server, measured from the import of this module
+    which is the first import of the server.
+    """
+
+    def __init__(self):
+        self.started_at = monotonic()
+
+        # Phase name -> (start, end) in seconds since the start
+        self.phases : dict[str, tuple[float, float]] = {}
+        self.lock = Lock()
+
+    @property
+    def elapsed(self) -> float:
+        return monotonic() - self.started_at
+
+    # Phase ending now which started with the server or at the end of another phase
+    def mark(self, name : str, after : str | None = None):
+        with self.lock:
+            start = self.phases[after][1] if after in self.phases else 0.0
+            end = self.elapsed
+
+            self.phases[name] = (start, end)
+
+        print(f"[SRV] Startup phase '{name}' took {end - start:.2f}s")
+
+    @contextmanager
+    def measure(self, name : str):
+        start = self.elapsed
+
+        try:
+            yield
+        finally:
+            end = self.elapsed
+
+            with self.lock:
+                self.phases[name] = (start, end)
+
+            print(f"[SRV] Startup phase '{name}' took {end - start:.2f}s")
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            return {
+                "phases" : [
+                    { "name" : name, "start" : round(start, 3), "duration" : round(end - start, 3) }
+                    for name, (start, end) in sorted(self.phases.items(), key=lambda item: item[1][0])
+                ],
+                "elapsed" : round(self.elapsed, 3)
+            }
+
+startup = StartupTimings()
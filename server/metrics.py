@@ -0,0 +1,19 @@
+from sanic import Blueprint
+from sanic.response import text
+from lib.metrics import MetricsRegistry, metrics as registry
+from context import context
+
+metrics = Blueprint("metrics")
+
+# Getting metrics of the server and the generator process in the Prometheus text format
+@metrics.get("/metrics")
+async def get_metrics(request):
+    snapshots = [registry.snapshot()]
+
+    if context.is_generator_ready == True:
+        process_metrics = context.generator.process_metrics
+
+        if process_metrics is not None:
+            snapshots.append(process_metrics)
+
+    return text(MetricsRegistry.render(snapshots), content_type="text/plain; version=0.0.4; charset=utf-8")
@@ -1,10 +1,11 @@
 import os
+from dataclasses import replace
 from sanic import Blueprint
 from uuid import uuid4, UUID
 from playhouse.shortcuts import model_to_dict
 from db.models import Project, Prompt, Output
 from context import context
-from rendering.generator import ImageGeneratorTask, ImageGeneratorOutput, ImageGeneratorTaskSettings, ImageGeneratorTaskType
+from rendering.tasks import ImageGeneratorTask, ImageGeneratorOutput, ImageGeneratorTaskSettings, ImageGeneratorTaskType, ImageGeneratorTaskPriority
 from lib.json import json
 
 outputs = Blueprint("outputs")
@@ -88,6 +89,12 @@ async def set_archived(request, project_id : UUID, output_id : UUID):
     output.isArchived = input["is_archived"] if "is_archived" in input else False
     output.save()
 
+    # Archived outputs no longer keep their images in the results cache, their own files stay intact
+    if output.isArchived == True:
+        context.results.release(output)
+    else:
+        context.results.retain(output, output.prompt.value)
+
     return json({
         "output" : model_to_dict(output, recurse=True, backrefs=True)
     })
@@ -154,40 +161,54 @@ async def add_output(request, project_id: UUID, prompt_id: UUID):
 
     size = settings["batch"] if "batch" in settings else 1
 
-    # Callback to update outputs
-    def update_outputs_progress(task : ImageGeneratorTask, progress : float, seed : int):
-        for taskOutput in task.outputs:
-            output = Output.get_or_none(id = taskOutput.id)
-
-            if output is None:
-                continue
-
-            output.seed = seed
-            output.progress = progress
-            output.save()
-
-            context.channel.send("output.updated", model_to_dict(output))
+    # Getting scheduling priority (derived from the output type if missing)
+    try:
+        priority = ImageGeneratorTaskPriority(input["priority"]) if "priority" in input else None
+    except ValueError:
+        return json({
+            "error" : "invalid-field",
+            "error-details" : {
+                "name" : "priority"
+            }
+        }, status=400)
 
     # Scheduling generator task to the backend generator
     task = ImageGeneratorTask(
         prompt=prompt.value,
         outputs=[],
         settings=ImageGeneratorTaskSettings.from_dict(settings),
-        callback=update_outputs_progress,
+        priority=priority
     )
 
+    # Last used model is warmed up first after restart
+    if task.settings.type == ImageGeneratorTaskType.preview:
+        context.models.use_preview_model(task.settings.model)
+
     # Getting parent if present
     parent = None 
     
     if "parent_id" in input:
         parent_id = input["parent_id"]
         parent = Output.get_or_none(id = parent_id)
+
+        # Images of parents are generated from, so parents without images are rejected
+        if parent is None or os.path.exists(context.url_for_output(parent.url)) == False:
+            return json({
+                "error" : "not-found",
+                "error-details" : {
+                    "kind" : "parent"
+                }
+            }, status=404)
+
         task.settings.initial_url = context.url_for_output(parent.url)
 
+    # Outputs generated before with the same fixed seed are completed from the results cache
+    missing = []
+
     # Adding outputs according to the supplied size
     for i in range(size):
         id = uuid4()
-        relative_url = str(prompt.id) + "/" + str(id) + ".jpg"
+        relative_url = str(prompt.id) + "/" + str(id) + task.settings.output.format.extension
         absolute_url = context.url_for_output(relative_url)
 
         # Ensuring the output directory exists
@@ -203,16 +224,34 @@ async def add_output(request, project_id: UUID, prompt_id: UUID):
             settings=settings
         )
 
+        result = context.results.lookup(context.results.key_for(prompt.value, task.settings, i)) if task.settings.seed != -1 else None
+
+        if result is not None:
+            context.results.apply(result, output)
+        else:
+            missing.append(i)
+
         output.save(force_insert=True)
 
         context.channel.send("output.created", model_to_dict(output))
 
         task.outputs.append(ImageGeneratorOutput(
             id=id,
-            url=absolute_url
+            url=absolute_url,
+            seed_offset=i
         ))
 
-    context.generator.add_task(task)
+    if len(missing) == size:
+        context.queue.add(task, prompt)
+    else:
+        # Every missing output is generated by its own task with the seed it would have in the whole task
+        for i in missing:
+            context.queue.add(ImageGeneratorTask(
+                prompt=task.prompt,
+                outputs=[replace(task.outputs[i], seed_offset=0)],
+                settings=replace(task.settings, seed=task.settings.seed + i),
+                priority=task.priority
+            ), prompt)
 
     return json({
         "prompt" : model_to_dict(prompt, recurse=False)
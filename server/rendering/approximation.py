@@ -1,13 +1,81 @@
-import einops
+import os
+import json
 import PIL.Image
 import torch
+import torch.nn.functional as F
 
-class ApproximateDecoder:
+class LatentDecoder:
+    """Decodes a batch of latents to preview images.
+    Subclasses map latents to RGB on the device, the whole batch is then downsampled if needed
+    and copied to the host in a single transfer.
+    """
+
+    # Name of the decoder tier
+    name = "base"
+
+    # Relative cost of decoding a frame, linear decoders cost 1
+    cost = 1.0
+
+    def __init__(self, device : torch.device):
+        self.device = torch.device(device)
+
+        # Page-locked host buffer reused between transfers
+        self.host_buffer : torch.Tensor | None = None
+
+    # Maps latents (N x 4 x H x W) to RGB values in 0..1 range (N x 3 x H' x W')
+    def decode(self, latents : torch.Tensor) -> torch.Tensor:
+        raise NotImplementedError()
+
+    def __call__(self, latents : torch.Tensor, max_dimension : int | None = None) -> list[PIL.Image.Image] | PIL.Image.Image:
+        # Single latent is decoded to a single image
+        if latents.dim() == 3:
+            return self(latents.unsqueeze(0), max_dimension=max_dimension)[0]
+
+        try:
+            with torch.no_grad():
+                tensor = self.decode(latents)
+
+                if max_dimension is not None and max(tensor.shape[-2:]) > max_dimension:
+                    scale = max_dimension / max(tensor.shape[-2:])
+                    size = (max(round(tensor.shape[-2] * scale), 1), max(round(tensor.shape[-1] * scale), 1))
+                    tensor = F.interpolate(tensor, size=size, mode="area")
+
+                tensor = (tensor
+                      .clamp(0, 1)
+                      .mul(0xFF)  # to 0..255
+                      .round()
+                      .byte()
+                      .permute(0, 2, 3, 1)  # to N x H x W x C
+                      .contiguous())
+
+                array = self.to_host(tensor).numpy()
+
+            # Images are copied out of the host buffer for RGB mode
+            return [PIL.Image.fromarray(array[index]) for index in range(array.shape[0])]
+        except NotImplementedError:
+            return [PIL.Image.new("RGB", (256, 256)) for _ in range(latents.shape[0])]
+
+    def to_host(self, tensor : torch.Tensor) -> torch.Tensor:
+        if tensor.device.type != "cuda":
+            return tensor.cpu()
+
+        if self.host_buffer is None or self.host_buffer.shape != tensor.shape:
+            self.host_buffer = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=True)
+
+        self.host_buffer.copy_(tensor, non_blocking=True)
+        torch.cuda.current_stream(tensor.device).synchronize()
+
+        return self.host_buffer
+
+class ApproximateDecoder(LatentDecoder):
     """Decodes latent data to an approximate representation in RGB.
     Values determined experimentally for Stable Diffusion 1.4.
     See https://discuss.huggingface.co/t/decoding-latents-to-rgb-without-upscaling/23204/2
     """
 
+    name = "linear"
+    cost = 1.0
+
     # grayscale_factors = torch.tensor([
     #    #    R       G       B
     #    [ 0.342,  0.341,  0.343 ], # L1
@@ -16,29 +84,190 @@ class ApproximateDecoder:
     #    [-0.208, -0.209, -0.208 ]  # L4
     # ])
 
-    def __init__(self, device: torch.device, dtype: torch.dtype):
-        self.latent_rgb_factors = torch.tensor([
-            #   R        G        B
-            [0.298, 0.207, 0.208],  # L1
-            [0.187, 0.286, 0.173],  # L2
-            [-0.158, 0.189, 0.264],  # L3
-            [-0.184, -0.271, -0.473],  # L4
-        ], dtype=dtype, device=device)
+    latent_rgb_factors = [
+        #   R        G        B
+        [0.298, 0.207, 0.208],  # L1
+        [0.187, 0.286, 0.173],  # L2
+        [-0.158, 0.189, 0.264],  # L3
+        [-0.184, -0.271, -0.473],  # L4
+    ]
+
+    latent_rgb_bias = [0.0, 0.0, 0.0]
+
+    def __init__(self, device : torch.device, dtype : torch.dtype, factors : list[list[float]] | None = None, bias : list[float] | None = None):
+        super().__init__(device)
+
+        self.latent_rgb_factors = torch.tensor(factors or self.latent_rgb_factors, dtype=dtype, device=device)
+        self.latent_rgb_bias = torch.tensor(bias or self.latent_rgb_bias, dtype=dtype, device=device)
 
     @classmethod
-    def for_pipeline(cls, pipeline: "diffusers.DiffusionPipeline"):
+    def for_pipeline(cls, pipeline : "diffusers.DiffusionPipeline"):
         return cls(device=pipeline.device, dtype=pipeline.unet.dtype)
 
-    def __call__(self, latents) -> PIL.Image.Image:
-        tensor = torch.einsum('...lhw,lr -> ...rhw', latents, self.latent_rgb_factors)
+    def decode(self, latents : torch.Tensor) -> torch.Tensor:
+        tensor = torch.einsum('nlhw,lr -> nrhw', latents.to(self.latent_rgb_factors.dtype), self.latent_rgb_factors)
+        tensor = tensor + self.latent_rgb_bias.view(1, 3, 1, 1)
+
+        # Change scale from -1..1 to 0..1
+        return (tensor + 1) / 2
+
+class CalibratedDecoder(ApproximateDecoder):
+    """Linear decoder with factors fitted for a particular model.
+    Factors are found with least squares between latents of calibration images encoded by the model VAE
+    and the same images downsampled to the latent resolution.
+    """
+
+    name = "calibrated"
+    cost = 1.0
+
+    @classmethod
+    def calibrate(cls, pipeline : "diffusers.DiffusionPipeline", scaling_factor : float) -> tuple[list[list[float]], list[float]]:
+        vae = pipeline.vae
+        device = pipeline.device
+        size = 64
+
+        # Calibration images are color gradients and solid color patches covering the RGB cube
+        ramp = torch.linspace(-1, 1, size)
+        x, y = torch.meshgrid(ramp, ramp, indexing="xy")
+        images = [
+            torch.stack([x, y, -x]),
+            torch.stack([y, -x, x]),
+            torch.stack([-y, x, y]),
+            torch.stack([x * y, -y, x]),
+        ]
+
+        for r in [-1.0, 1.0]:
+            for g in [-1.0, 1.0]:
+                for b in [-1.0, 1.0]:
+                    images.append(torch.tensor([r, g, b]).view(3, 1, 1).expand(3, size, size))
+
+        images = torch.stack(images).to(device=device, dtype=vae.dtype)
+
+        with torch.no_grad():
+            latents = vae.encode(images).latent_dist.mean * scaling_factor
+
+        targets = F.interpolate(images.float(), size=latents.shape[-2:], mode="area")
 
-        tensor = (((tensor + 1) / 2)
-              .clamp(0, 1)  # change scale from -1..1 to 0..1
-              .mul(0xFF)  # to 0..255
-              .byte())
-        tensor = einops.rearrange(tensor, 'c h w -> h w c')
-        
+        # Solving latents (with a bias column) x factors = RGB
+        inputs = latents.float().permute(0, 2, 3, 1).reshape(-1, latents.shape[1]).cpu()
+        inputs = torch.cat([inputs, torch.ones(inputs.shape[0], 1)], dim=1)
+        outputs = targets.permute(0, 2, 3, 1).reshape(-1, 3).cpu()
+
+        solution = torch.linalg.lstsq(inputs, outputs).solution
+
+        return solution[:-1].tolist(), solution[-1].tolist()
+
+class TinyDecoderBlock(torch.nn.Module):
+    def __init__(self, n_in : int, n_out : int):
+        super().__init__()
+
+        self.conv = torch.nn.Sequential(
+            torch.nn.Conv2d(n_in, n_out, 3, padding=1), torch.nn.ReLU(),
+            torch.nn.Conv2d(n_out, n_out, 3, padding=1), torch.nn.ReLU(),
+            torch.nn.Conv2d(n_out, n_out, 3, padding=1)
+        )
+        self.skip = torch.nn.Conv2d(n_in, n_out, 1, bias=False) if n_in != n_out else torch.nn.Identity()
+        self.fuse = torch.nn.ReLU()
+
+    def forward(self, x):
+        return self.fuse(self.conv(x) + self.skip(x))
+
+class TinyDecoderClamp(torch.nn.Module):
+    def forward(self, x):
+        return torch.tanh(x / 3) * 3
+
+class TinyDecoder(LatentDecoder):
+    """Small learned decoder producing full resolution previews (TAESD architecture).
+    See https://github.com/madebyollin/taesd
+    """
+
+    name = "tiny"
+    cost = 25.0
+
+    # File with decoder weights inside models directory
+    weights_path = os.path.join("taesd", "taesd_decoder.pth")
+
+    def __init__(self, device : torch.device, dtype : torch.dtype, url_for_weights : str):
+        super().__init__(device)
+
+        self.model = torch.nn.Sequential(
+            TinyDecoderClamp(), torch.nn.Conv2d(4, 64, 3, padding=1), torch.nn.ReLU(),
+            TinyDecoderBlock(64, 64), TinyDecoderBlock(64, 64), TinyDecoderBlock(64, 64), torch.nn.Upsample(scale_factor=2), torch.nn.Conv2d(64, 64, 3, padding=1, bias=False),
+            TinyDecoderBlock(64, 64), TinyDecoderBlock(64, 64), TinyDecoderBlock(64, 64), torch.nn.Upsample(scale_factor=2), torch.nn.Conv2d(64, 64, 3, padding=1, bias=False),
+            TinyDecoderBlock(64, 64), TinyDecoderBlock(64, 64), TinyDecoderBlock(64, 64), torch.nn.Upsample(scale_factor=2), torch.nn.Conv2d(64, 64, 3, padding=1, bias=False),
+            TinyDecoderBlock(64, 64), torch.nn.Conv2d(64, 3, 3, padding=1),
+        )
+
+        self.model.load_state_dict(torch.load(url_for_weights, map_location="cpu"))
+        self.model = self.model.to(device=device, dtype=dtype).eval()
+
+    @classmethod
+    def is_available(cls, url_for_models : str) -> bool:
+        return os.path.exists(os.path.join(url_for_models, cls.weights_path))
+
+    def decode(self, latents : torch.Tensor) -> torch.Tensor:
+        return self.model(latents.to(next(self.model.parameters()).dtype))
+
+class LatentDecoders:
+    """Picks the best preview decoder tier for a pipeline within a cost budget.
+    Tiers from the most to the least expensive: tiny learned decoder, linear factors calibrated for the model,
+    default linear factors. Calibrated factors are stored in a file, so every model is calibrated once.
+    """
+
+    def __init__(self, models : "ModelManager", budget : float):
+        self.models = models
+        self.budget = budget
+
+        # Tiny decoders are loaded once per device
+        self.tiny_decoders : dict[str, TinyDecoder] = {}
+
+    @property
+    def url_for_models(self):
+        return self.models.url_for_models
+
+    @property
+    def url_for_factors(self):
+        return os.path.join(self.url_for_models, "decoders.json")
+
+    def read_factors(self) -> dict:
         try:
-            return PIL.Image.fromarray(tensor.cpu().numpy())
-        except NotImplementedError:
-            return PIL.Image.new("RGB", (256, 256))
\ No newline at end of file
+            with open(self.url_for_factors, "r") as file:
+                return json.load(file)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def write_factors(self, factors : dict):
+        with open(self.url_for_factors, "w+") as file:
+            json.dump(factors, file)
+
+    def decoder_for_pipeline(self, pipeline : "diffusers.DiffusionPipeline", id : str, scaling_factor : float = 0.18215, is_tiny_compatible : bool = True) -> LatentDecoder:
+        device = pipeline.device
+        dtype = pipeline.unet.dtype
+
+        if is_tiny_compatible == True and TinyDecoder.cost <= self.budget and TinyDecoder.is_available(self.url_for_models):
+            try:
+                if str(device) not in self.tiny_decoders:
+                    self.tiny_decoders[str(device)] = TinyDecoder(device, dtype, os.path.join(self.url_for_models, TinyDecoder.weights_path))
+
+                return self.tiny_decoders[str(device)]
+            except Exception as e:
+                print(f"[GEN] Failed to load tiny preview decoder: {e}")
+
+        if CalibratedDecoder.cost <= self.budget and hasattr(pipeline, "vae"):
+            factors = self.read_factors()
+
+            if id not in factors:
+                try:
+                    print(f"[GEN] Calibrating preview decoder for '{id}'")
+
+                    weights, bias = CalibratedDecoder.calibrate(pipeline, scaling_factor)
+                    factors[id] = { "weights" : weights, "bias" : bias }
+
+                    self.write_factors(factors)
+                except Exception as e:
+                    print(f"[GEN] Failed to calibrate preview decoder: {e}")
+
+            if id in factors:
+                return CalibratedDecoder(device, dtype, factors=factors[id]["weights"], bias=factors[id]["bias"])
+
+        return ApproximateDecoder.for_pipeline(pipeline)
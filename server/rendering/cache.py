@@ -0,0 +1,281 @@
+import gc
+import itertools
+import torch
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from threading import RLock
+from typing import Any
+
+@dataclass(frozen=True)
+class PipelineKey:
+    model : str
+    revision : str | None
+    type : str
+    dtype : str
+
+    # Model identity shared by pipelines of the same model loaded with different precision
+    @property
+    def identity(self) -> tuple:
+        return (self.model, self.revision, self.type)
+
+@dataclass
+class CachedPipeline:
+    key : PipelineKey
+    pipe : Any
+
+    # Number of bytes taken by weights of all pipeline components
+    size : int = 0
+
+    # Device the pipeline currently resides at
+    device : str = "cpu"
+
+    # Schedulers for every sampling method used with the pipeline
+    schedulers : Any = None
+
+    # Whether convolutions are currently padded for seamless tiling
+    is_seamless : bool = False
+
+    # Decoder of latents to preview images
+    decoder : Any = None
+
+    # Memory saving options currently applied to the pipeline
+    plan : Any = None
+
+    # Whether weights are offloaded to host memory and moved to the device only while used
+    is_offloaded : bool = False
+
+    # Compiled modules of the pipeline in the optimized mode
+    optimization : Any = None
+
+    # Hashes of weights of components, which are shared with pipelines of other models having the same hashes
+    component_hashes : dict[str, str] = field(default_factory=dict)
+
+    # Number of bytes taken by weights of every module by identity of the module, shared modules have the same identity
+    modules : dict[int, int] = field(default_factory=dict)
+
+def module_sizes(pipe) -> dict[int, int]:
+    sizes = {}
+
+    for component in pipe.components.values():
+        if not isinstance(component, torch.nn.Module):
+            continue
+
+        sizes[id(component)] = sum(tensor.numel() * tensor.element_size() for tensor in itertools.chain(component.parameters(), component.buffers()))
+
+    return sizes
+
+def pipeline_size(pipe) -> int:
+    return sum(module_sizes(pipe).values())
+
+class PipelineCache:
+    """Keeps several loaded pipelines resident within a memory budget.
+    Least recently used pipelines are evicted first and, if spilling is enabled,
+    moved to host memory instead of being dropped so that reloading them does not hit the disk.
+    Modules with identical weights are shared between pipelines of different models and counted once,
+    a shared module stays on the device while any pipeline using it is resident.
+    """
+
+    def __init__(self, device : str, memory_budget : int, spill_to_host : bool = False, host_memory_budget : int = 0):
+        self.device = device
+        self.memory_budget = memory_budget
+        self.spill_to_host = spill_to_host
+        self.host_memory_budget = host_memory_budget
+
+        # Pipelines on the device and spilled to host memory, ordered from least to most recently used
+        self.resident : OrderedDict[PipelineKey, CachedPipeline] = OrderedDict()
+        self.spilled : OrderedDict[PipelineKey, CachedPipeline] = OrderedDict()
+
+        self.lock = RLock()
+
+        # Statistics
+        self.hits = 0
+        self.host_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.spills = 0
+
+    @property
+    def resident_size(self) -> int:
+        return sum(self.modules_of(self.resident.values()).values())
+
+    # Modules of spilled pipelines shared with resident ones are on the device
+    @property
+    def spilled_size(self) -> int:
+        resident = self.modules_of(self.resident.values())
+
+        return sum(size for module, size in self.modules_of(self.spilled.values()).items() if module not in resident)
+
+    # Bytes saved by sharing modules between resident pipelines
+    @property
+    def shared_size(self) -> int:
+        return sum(cached.size for cached in self.resident.values()) - self.resident_size
+
+    @staticmethod
+    def modules_of(pipelines) -> dict[int, int]:
+        modules = {}
+
+        for cached in pipelines:
+            modules.update(cached.modules)
+
+        return modules
+
+    @property
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "hits" : self.hits,
+                "host_hits" : self.host_hits,
+                "misses" : self.misses,
+                "evictions" : self.evictions,
+                "spills" : self.spills,
+                "resident" : [cached.key.model for cached in self.resident.values()],
+                "spilled" : [cached.key.model for cached in self.spilled.values()],
+                "resident_bytes" : self.resident_size,
+                "spilled_bytes" : self.spilled_size,
+                "shared_bytes" : self.shared_size,
+                "memory_budget_bytes" : self.memory_budget,
+            }
+
+    def get(self, key : PipelineKey) -> CachedPipeline | None:
+        with self.lock:
+            if key in self.resident:
+                self.hits += 1
+                self.resident.move_to_end(key)
+                return self.resident[key]
+
+            if key in self.spilled:
+                self.host_hits += 1
+                cached = self.spilled.pop(key)
+
+                self.make_room(cached.size)
+
+                cached.pipe = cached.pipe.to(self.device)
+                cached.device = self.device
+                self.resident[key] = cached
+
+                return cached
+
+            self.misses += 1
+            return None
+
+    def put(self, key : PipelineKey, pipe, component_hashes : dict[str, str] | None = None) -> CachedPipeline:
+        component_hashes = dict(component_hashes) if component_hashes is not None else {}
+
+        with self.lock:
+            modules = module_sizes(pipe)
+            cached = CachedPipeline(key=key, pipe=pipe, size=sum(modules.values()), device=self.device, component_hashes=component_hashes, modules=modules)
+
+            self.resident[key] = cached
+            self.resident.move_to_end(key)
+
+            self.evict_if_needed(keep=key)
+
+            return cached
+
+    # Loaded components with the same hashes as components of a model, modules of offloaded pipelines are never shared
+    def shared_components(self, component_hashes : dict[str, str]) -> dict[str, Any]:
+        with self.lock:
+            shared = {}
+
+            for cached in itertools.chain(reversed(self.resident.values()), self.spilled.values()):
+                if cached.is_offloaded == True:
+                    continue
+
+                for name, hash in cached.component_hashes.items():
+                    if component_hashes.get(name) == hash and name not in shared:
+                        shared[name] = cached.pipe.components[name]
+
+            return shared
+
+    # Whether some modules of the pipeline are used by other pipelines as well
+    def is_shared(self, cached : CachedPipeline) -> bool:
+        with self.lock:
+            return any(other is not cached and len(other.modules.keys() & cached.modules.keys()) > 0 for other in itertools.chain(self.resident.values(), self.spilled.values()))
+
+    # Drops other pipelines sharing modules with the pipeline, so offloading its modules does not affect them
+    def unshare(self, cached : CachedPipeline):
+        with self.lock:
+            for storage in [self.resident, self.spilled]:
+                for key in [key for key, other in storage.items() if other is not cached and len(other.modules.keys() & cached.modules.keys()) > 0]:
+                    print(f"[GEN] Dropping model '{key.model}' sharing modules with model '{cached.key.model}'")
+
+                    del storage[key]
+
+            self.collect()
+
+    # Frees memory for a pipeline of the specified size (or the largest known one) before it gets loaded
+    def make_room(self, size : int | None = None):
+        with self.lock:
+            if size is None:
+                size = max([cached.size for cached in itertools.chain(self.resident.values(), self.spilled.values())], default=0)
+
+            while len(self.resident) > 0 and self.resident_size + size > self.memory_budget:
+                self.evict(next(iter(self.resident)))
+
+    def evict_if_needed(self, keep : PipelineKey | None = None):
+        with self.lock:
+            while self.resident_size > self.memory_budget:
+                candidates = [key for key in self.resident if key != keep]
+
+                if len(candidates) == 0:
+                    break
+
+                self.evict(candidates[0])
+
+    def evict(self, key : PipelineKey):
+        with self.lock:
+            cached = self.resident.pop(key)
+            self.evictions += 1
+
+            # Offloaded pipelines cannot be moved between devices
+            if self.spill_to_host == True and cached.is_offloaded == False and cached.size <= self.host_memory_budget:
+                print(f"[GEN] Spilling model '{key.model}' to host memory")
+
+                resident = self.modules_of(self.resident.values())
+
+                for component in cached.pipe.components.values():
+                    if isinstance(component, torch.nn.Module) and id(component) not in resident:
+                        component.to("cpu")
+
+                cached.device = "cpu"
+
+                self.spilled[key] = cached
+                self.spills += 1
+
+                while self.spilled_size > self.host_memory_budget:
+                    self.spilled.popitem(last=False)
+            else:
+                print(f"[GEN] Evicting model '{key.model}'")
+
+            del cached
+
+            self.collect()
+
+    # Drops a pipeline without spilling it to host memory
+    def discard(self, key : PipelineKey):
+        with self.lock:
+            self.resident.pop(key, None)
+            self.spilled.pop(key, None)
+
+            self.collect()
+
+    def remove(self, model : str):
+        with self.lock:
+            for storage in [self.resident, self.spilled]:
+                for key in [key for key in storage if key.model == model]:
+                    del storage[key]
+
+            self.collect()
+
+    def clear(self):
+        with self.lock:
+            self.resident.clear()
+            self.spilled.clear()
+
+            self.collect()
+
+    def collect(self):
+        gc.collect()
+
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
@@ -0,0 +1,209 @@
+import os
+import shutil
+import hashlib
+import torch
+from collections import OrderedDict
+from dataclasses import dataclass
+from threading import RLock
+
+@dataclass(frozen=True)
+class PromptEmbeddingKey:
+    model : str
+    revision : str | None
+    dtype : str
+    prompt : str
+    negative_prompt : str = ""
+
+    # Name of the file storing embeddings in the disk tier
+    @property
+    def digest(self) -> str:
+        return hashlib.sha256(repr((self.revision, self.dtype, self.prompt, self.negative_prompt)).encode("utf-8")).hexdigest()
+
+@dataclass
+class PromptEmbedding:
+    prompt_embeds : torch.Tensor
+    negative_prompt_embeds : torch.Tensor
+
+    @property
+    def size(self) -> int:
+        return sum(tensor.numel() * tensor.element_size() for tensor in [self.prompt_embeds, self.negative_prompt_embeds])
+
+# Directory of the disk tier storing embeddings of a model, so all of them are removed along with the model
+def model_directory_name(model : str) -> str:
+    return hashlib.sha256(model.encode("utf-8")).hexdigest()[:16]
+
+class PromptEmbeddingCache:
+    """Keeps text encoder outputs of recently used prompts, so batches of the same prompt skip encoding.
+    Embeddings are held in host memory within a byte budget, least recently used ones are evicted first.
+    If the disk tier is enabled, embeddings are also written to disk and survive restarts within their own budget.
+    """
+
+    def __init__(self, memory_budget : int, url_for_disk : str | None = None, disk_budget : int = 0):
+        self.memory_budget = memory_budget
+        self.url_for_disk = url_for_disk if disk_budget > 0 else None
+        self.disk_budget = disk_budget
+
+        # Embeddings in memory and files of the disk tier with their sizes, ordered from least to most recently used
+        self.entries : OrderedDict[PromptEmbeddingKey, PromptEmbedding] = OrderedDict()
+        self.files : OrderedDict[str, int] = OrderedDict()
+
+        self.lock = RLock()
+
+        # Statistics
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if self.url_for_disk is not None:
+            self.scan_disk()
+
+    @property
+    def memory_size(self) -> int:
+        return sum(embedding.size for embedding in self.entries.values())
+
+    @property
+    def disk_size(self) -> int:
+        return sum(self.files.values())
+
+    @property
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.disk_hits + self.misses
+
+            return {
+                "hits" : self.hits,
+                "disk_hits" : self.disk_hits,
+                "misses" : self.misses,
+                "evictions" : self.evictions,
+                "hit_rate" : (self.hits + self.disk_hits) / lookups if lookups > 0 else 0.0,
+                "entries" : len(self.entries),
+                "memory_bytes" : self.memory_size,
+                "memory_budget_bytes" : self.memory_budget,
+                "disk_entries" : len(self.files),
+                "disk_bytes" : self.disk_size,
+                "disk_budget_bytes" : self.disk_budget if self.url_for_disk is not None else 0,
+            }
+
+    def url_for_key(self, key : PromptEmbeddingKey) -> str:
+        return os.path.join(self.url_for_disk, model_directory_name(key.model), f"{key.digest}.pt")
+
+    # Indexing files left from previous runs, oldest first
+    def scan_disk(self):
+        files = []
+
+        for root, directories, names in os.walk(self.url_for_disk):
+            for name in names:
+                url = os.path.join(root, name)
+
+                # Files of interrupted writes are never complete
+                if name.endswith(".tmp"):
+                    self.remove_file(url)
+                    continue
+
+                try:
+                    info = os.stat(url)
+                except OSError:
+                    continue
+
+                files.append((info.st_mtime, url, info.st_size))
+
+        for mtime, url, size in sorted(files):
+            self.files[url] = size
+
+        self.evict_disk_if_needed()
+
+    def get(self, key : PromptEmbeddingKey) -> PromptEmbedding | None:
+        with self.lock:
+            if key in self.entries:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return self.entries[key]
+
+            if self.url_for_disk is not None:
+                url = self.url_for_key(key)
+
+                if url in self.files:
+                    try:
+                        stored = torch.load(url, map_location="cpu")
+                        embedding = PromptEmbedding(stored["prompt_embeds"], stored["negative_prompt_embeds"])
+                    except Exception as e:
+                        print(f"[GEN] Failed to read cached prompt embeddings: {e}")
+                        self.remove_file(url)
+                    else:
+                        self.disk_hits += 1
+                        self.files.move_to_end(url)
+                        self.insert(key, embedding)
+                        return embedding
+
+            self.misses += 1
+            return None
+
+    def put(self, key : PromptEmbeddingKey, embedding : PromptEmbedding):
+        embedding = PromptEmbedding(embedding.prompt_embeds.detach().cpu(), embedding.negative_prompt_embeds.detach().cpu())
+
+        with self.lock:
+            self.insert(key, embedding)
+
+            if self.url_for_disk is not None:
+                self.write(key, embedding)
+
+    def insert(self, key : PromptEmbeddingKey, embedding : PromptEmbedding):
+        self.entries[key] = embedding
+        self.entries.move_to_end(key)
+
+        while self.memory_size > self.memory_budget and len(self.entries) > 1:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def write(self, key : PromptEmbeddingKey, embedding : PromptEmbedding):
+        url = self.url_for_key(key)
+        temporary_url = f"{url}.tmp"
+
+        try:
+            os.makedirs(os.path.dirname(url), exist_ok=True)
+
+            torch.save({
+                "prompt_embeds" : embedding.prompt_embeds,
+                "negative_prompt_embeds" : embedding.negative_prompt_embeds
+            }, temporary_url)
+
+            os.replace(temporary_url, url)
+        except OSError as e:
+            print(f"[GEN] Failed to write cached prompt embeddings: {e}")
+            return
+
+        self.files[url] = os.path.getsize(url)
+        self.files.move_to_end(url)
+
+        self.evict_disk_if_needed()
+
+    def evict_disk_if_needed(self):
+        while self.disk_size > self.disk_budget and len(self.files) > 0:
+            self.remove_file(next(iter(self.files)))
+
+    def remove_file(self, url : str):
+        self.files.pop(url, None)
+
+        try:
+            os.remove(url)
+        except OSError:
+            pass
+
+    # Drops embeddings of a model both from memory and disk
+    def remove(self, model : str):
+        with self.lock:
+            for key in [key for key in self.entries if key.model == model]:
+                del self.entries[key]
+
+            if self.url_for_disk is not None:
+                url_for_model = os.path.join(self.url_for_disk, model_directory_name(model))
+
+                for url in [url for url in self.files if os.path.dirname(url) == url_for_model]:
+                    del self.files[url]
+
+                shutil.rmtree(url_for_model, ignore_errors=True)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
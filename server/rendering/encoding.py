@@ -0,0 +1,117 @@
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from typing import Callable
+from PIL import Image
+from .images import save_image, save_options_for
+from .previews import IMAGE_ENCODE
+from .tasks import ImageGeneratorTaskOutputSettings
+
+class ImageEncodingPool:
+    """Encodes and writes final images on a pool of threads, so workers start denoising the next batch right away.
+    Images are moved in place once written, callbacks waiting for images run after all of them are in place.
+    Callbacks waiting for images which failed to be written are replaced with their failure callbacks, called with the error.
+    """
+
+    def __init__(self, workers : int = 2):
+        self.workers = workers
+        self.executor : ThreadPoolExecutor | None = None
+
+        # Writes in progress for every url, and callbacks with urls they are waiting for
+        self.pending : dict[str, int] = {}
+        self.waiting : list[tuple[set[str], Callable, Callable | None]] = []
+        self.lock = Lock()
+
+        # Errors of images which failed to be written before callbacks waited for them
+        self.errors : dict[str, str] = {}
+
+        # Statistics
+        self.written = 0
+        self.failed = 0
+
+    def start(self):
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="varnava-image-encoder")
+
+    # Waits for pending images to be written
+    def stop(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+
+    def write(self, url : str, image : Image.Image, output : ImageGeneratorTaskOutputSettings = ImageGeneratorTaskOutputSettings()):
+        with self.lock:
+            self.pending[url] = self.pending.get(url, 0) + 1
+
+        self.executor.submit(self.encode, url, image, output)
+
+    # Runs the callback once images of the urls are written, right away if none of them is pending,
+    # or the failure callback with the error once any of them fails to be written
+    def after_written(self, urls : list[str], callback : Callable, failure_callback : Callable | None = None):
+        with self.lock:
+            errors = [self.errors.pop(url) for url in urls if url in self.errors]
+            waiting = set(url for url in urls if url in self.pending)
+
+            if len(errors) == 0 and len(waiting) > 0:
+                self.waiting.append((waiting, callback, failure_callback))
+                return
+
+        if len(errors) == 0:
+            callback()
+        elif failure_callback is not None:
+            failure_callback(errors[0])
+
+    def encode(self, url : str, image : Image.Image, output : ImageGeneratorTaskOutputSettings):
+        is_successful = False
+        error = None
+
+        try:
+            with IMAGE_ENCODE.time(kind="final"):
+                save_image(image, url, **save_options_for(output))
+
+            is_successful = True
+        except Exception as e:
+            print(f"[GEN] Failed to write image '{url}': {e}")
+            error = f"Failed to write image: {e}"
+
+        ready = []
+
+        with self.lock:
+            if is_successful == True:
+                self.written += 1
+            else:
+                self.failed += 1
+
+            is_waited = any(url in urls for urls, _, _ in self.waiting)
+
+            if is_successful == False and is_waited == False:
+                self.errors[url] = error
+
+            self.pending[url] -= 1
+
+            if self.pending[url] == 0:
+                del self.pending[url]
+
+            for entry in list(self.waiting):
+                urls, callback, failure_callback = entry
+
+                if url not in urls:
+                    continue
+
+                if is_successful == False:
+                    self.waiting.remove(entry)
+
+                    if failure_callback is not None:
+                        ready.append(lambda failure_callback=failure_callback: failure_callback(error))
+
+                    continue
+
+                if url not in self.pending:
+                    urls.discard(url)
+
+                if len(urls) == 0:
+                    self.waiting.remove(entry)
+                    ready.append(callback)
+
+        for callback in ready:
+            try:
+                callback()
+            except Exception as e:
+                print(f"[GEN] Failed to notify about written images: {e}")
@@ -0,0 +1,88 @@
+import os
+from dataclasses import dataclass
+from multiprocessing import shared_memory, resource_tracker
+from threading import Condition
+from PIL import Image
+
+@dataclass
+class SharedFrame:
+    """Description of an image stored in a shared memory block, sent instead of the pixels."""
+
+    name : str
+    mode : str
+    width : int
+    height : int
+    length : int
+
+class SharedFrameWriter:
+    """Copies images to shared memory blocks for another process.
+    Blocks are reused once the reader releases them, at most `max_blocks` are allocated,
+    writers wait for a released block after that.
+    """
+
+    def __init__(self, max_blocks : int = 32):
+        self.max_blocks = max_blocks
+
+        self.blocks : dict[str, shared_memory.SharedMemory] = {}
+        self.free : set[str] = set()
+        self.condition = Condition()
+
+    def write(self, image : Image.Image) -> SharedFrame:
+        data = image.tobytes()
+
+        with self.condition:
+            block = self.acquire(len(data))
+
+        block.buf[:len(data)] = data
+
+        return SharedFrame(name=block.name, mode=image.mode, width=image.width, height=image.height, length=len(data))
+
+    def acquire(self, size : int) -> shared_memory.SharedMemory:
+        while True:
+            fitting = [name for name in self.free if self.blocks[name].size >= size]
+
+            if len(fitting) > 0:
+                name = min(fitting, key=lambda name: self.blocks[name].size)
+                self.free.remove(name)
+                return self.blocks[name]
+
+            # Replacing a free block which is too small
+            if len(self.free) > 0:
+                self.unlink(self.free.pop())
+
+            if len(self.blocks) < self.max_blocks:
+                block = shared_memory.SharedMemory(create=True, size=size)
+                self.blocks[block.name] = block
+                return block
+
+            self.condition.wait()
+
+    def release(self, name : str):
+        with self.condition:
+            if name in self.blocks:
+                self.free.add(name)
+                self.condition.notify_all()
+
+    def unlink(self, name : str):
+        block = self.blocks.pop(name)
+        block.close()
+        block.unlink()
+
+    def close(self):
+        with self.condition:
+            for name in list(self.blocks.keys()):
+                self.unlink(name)
+
+            self.free.clear()
+
+def read_shared_frame(frame : SharedFrame) -> Image.Image:
+    block = shared_memory.SharedMemory(name=frame.name)
+
+    # Blocks are owned by the writing process, the reader must not unlink them on exit
+    if os.name == "posix":
+        resource_tracker.unregister(block._name, "shared_memory")
+
+    try:
+        return Image.frombytes(frame.mode, (frame.width, frame.height), bytes(block.buf[:frame.length]))
+    finally:
+        block.close()
@@ -1,288 +1,301 @@
+import os
 import torch
-import gc
-import sys
-from dataclasses import dataclass
-from queue import SimpleQueue
-from threading import Thread
-from time import sleep
-from typing import Callable, Any
 from uuid import UUID
-from enum import Enum, unique
-from diffusers import StableDiffusionUpscalePipeline, StableDiffusionPipeline, DPMSolverMultistepScheduler, DDIMScheduler, LMSDiscreteScheduler, DEISMultistepScheduler, HeunDiscreteScheduler, DPMSolverSinglestepScheduler
-from mashumaro import DataClassDictMixin
-from .approximation import ApproximateDecoder
-from PIL import Image
+from .approximation import LatentDecoders
 from .models import ModelManager
+from .tasks import ImageGeneratorTaskType, ImageGeneratorTaskSettings, ImageGeneratorTask
+from .scheduling import TaskScheduler
+from .previews import PreviewEncoder
+from .encoding import ImageEncodingPool
+from .embeddings import PromptEmbeddingCache
+from .optimization import bucket_length, is_optimization_supported
+from .worker import ImageGeneratorWorker
 
-@unique
-class ImageGeneratorTaskType(str, Enum):
-    preview = "preview"
-    upscale = "upscale"
-    variation = "variation"
-
-@dataclass 
-class ImageGeneratorTaskUpscaleSettings(DataClassDictMixin):
-    dimension : int = 1024
-
-@dataclass
-class ImageGeneratorTaskSettings(DataClassDictMixin):
-    model : str = ""
-    seed : int = -1
-    dimensions : float = 1.0
-    batch : int = 2
-    method : str = "dpm"
-    strength : float = 0.6
-    steps : int = 30
-    seamless : int = 0
-    type : ImageGeneratorTaskType = ImageGeneratorTaskType("preview")
-    initial_url : str | None = None
-
-    # Settings for upscaling
-    upscale : ImageGeneratorTaskUpscaleSettings = ImageGeneratorTaskUpscaleSettings()
-
-    def is_structurally_equal(self, other : Any) -> bool:
-        if not isinstance(other, ImageGeneratorTaskSettings):
-            return False
-        
-        return self.model == other.model and self.method == other.method and self.type.value == other.type.value and self.seamless == other.seamless
-
-@dataclass
-class ImageGeneratorOutput:
-    id : UUID
-    url : str
+# Devices used for generation when none are specified: every CUDA GPU or Apple GPU otherwise
+def default_devices() -> list[str]:
+    if torch.cuda.is_available():
+        return [f"cuda:{index}" for index in range(torch.cuda.device_count())]
 
-@dataclass
-class ImageGeneratorTask:
-    prompt : str
-    outputs : list[ImageGeneratorOutput]
-    settings : ImageGeneratorTaskSettings = ImageGeneratorTaskSettings()
-    callback : Callable = lambda *args: None
+    return ["mps"]
 
 class ImageGenerator:
     # custom pytorch needs libzwapi.dll, nvToolsExt64_1.dll, libiomp5md.dll
 
-    def __init__(self, url_for_root : str, models_download_callback = None):
-        # Models manager
-        self.models = ModelManager(url_for_root, download_callback=models_download_callback)
+    def __init__(
+        self, 
+        url_for_root : str, 
+        models_download_callback = None,
+        warm_up_callback = None,
+        warm_up_enabled : bool = True,
+        models : ModelManager | None = None,
+        devices : list[str] | None = None,
+        pipelines_memory_budget : float | None = None,
+        pipelines_spill_to_host : bool | None = None,
+        pipelines_host_memory_budget : float = 8,
+        max_batch_size : int | None = None,
+        max_batch_pixels : int | None = None,
+        aging_interval : float = 20.0,
+        affinity_window : float = 0.5,
+        preview_every_steps : int = 1,
+        preview_every_ms : float = 250,
+        preview_max_dimension : int = 384,
+        preview_decoder_budget : float | None = None,
+        upscale_tile_size : int = 128,
+        upscale_tile_overlap : int = 32,
+        embeddings_memory_budget : float = 0.25,
+        embeddings_disk_budget : float = 1,
+        image_encoding_workers : int = 2,
+        optimized : bool = False
+    ):
+        # Models manager, or a snapshot of its configuration when models are managed by another process
+        self.models = models if models is not None else ModelManager(url_for_root, download_callback=models_download_callback)
+
+        if isinstance(self.models, ModelManager):
+            self.models.removal_callback = self.remove_model
+
+        # Models are loaded in the background on start, once downloaded, and readiness is reported with the callback
+        self.warm_up_callback = warm_up_callback
+        self.warm_up_enabled = warm_up_enabled
+        self.is_warm_up_requested = False
 
-        # Preparing current queue
-        self.tasks = SimpleQueue()
+        # Hashes of components computed by workers are reported with the callback when models are managed by another process
+        self.component_hashes_callback = None
 
-        # Last task to compare
-        self.last_task : ImageGeneratorTask | None = None
+        # Preparing current queue ordered by priority and loaded models, shared by all workers
+        self.tasks = TaskScheduler(aging_interval=aging_interval, affinity_window=affinity_window)
 
-        # Our processing daemon
-        self.daemon : Thread | None = None
+        if devices is None or len(devices) == 0:
+            devices = default_devices()
 
-        # No processing pipe in the beginning
-        self.pipe : StableDiffusionPipeline | StableDiffusionUpscalePipeline | None = None
+        self.device_name = devices[0]
+        device_type = torch.device(self.device_name).type
 
-        # Max memory available (in GB)
-        if torch.cuda.is_available():
-            self.device_name = "cuda"
-            self.total_vram_amount = torch.cuda.get_device_properties(0).total_memory / 1024 / 1024 / 1024
+        # Dimensions are the same for all devices, so outputs do not depend on the worker generating them
+        if device_type == "cuda":
             self.base_dimension = 768
             self.upscaled_dimension = 2048
         else:
-            self.device_name = "mps"
-            self.total_vram_amount = 16
             self.base_dimension = 512
             self.upscaled_dimension = 968
 
-        # Approximate image decoder
-        self.approximate_image_decoder : ApproximateDecoder | None = None
+        # Approximate image decoder chosen among available tiers within the cost budget
+        if preview_decoder_budget is None:
+            preview_decoder_budget = 25 if device_type == "cuda" else 1
+
+        self.latent_decoders = LatentDecoders(self.models, budget=preview_decoder_budget)
+
+        # Preview frames are encoded off the generation threads at a limited cadence
+        self.preview_encoder = PreviewEncoder()
+        self.preview_every_steps = preview_every_steps
+        self.preview_every_ms = preview_every_ms
+        self.preview_max_dimension = preview_max_dimension
+
+        # Final images are encoded and written by a pool of threads
+        self.image_encoder = ImageEncodingPool(workers=image_encoding_workers)
+
+        # Optimized mode compiles models for every image size, so sizes are rounded to buckets,
+        # compiled kernels are stored on disk and reused after restart
+        self.is_optimized = optimized == True and is_optimization_supported()
+
+        if optimized == True and self.is_optimized == False:
+            print("[GEN] Optimized mode is not supported by the installed torch")
+
+        if self.is_optimized == True:
+            os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", os.path.join(url_for_root, "cache", "compiled"))
+
+        # Upscaling is done by tiles of the source image (in pixels, multiples of 64)
+        self.upscale_tile_size = upscale_tile_size
+        self.upscale_tile_overlap = upscale_tile_overlap
+
+        # Text encoder outputs of recent prompts shared by all workers (budgets are in GB, no disk tier if 0)
+        self.prompt_embeddings = PromptEmbeddingCache(
+            memory_budget=int(embeddings_memory_budget * 1024 * 1024 * 1024),
+            url_for_disk=os.path.join(url_for_root, "cache", "embeddings"),
+            disk_budget=int(embeddings_disk_budget * 1024 * 1024 * 1024)
+        )
+
+        # Every device is driven by its own worker with its own loaded pipelines
+        self.workers = [
+            ImageGeneratorWorker(
+                self,
+                device=device,
+                index=index,
+                pipelines_memory_budget=pipelines_memory_budget,
+                pipelines_spill_to_host=pipelines_spill_to_host,
+                pipelines_host_memory_budget=pipelines_host_memory_budget,
+                max_batch_size=max_batch_size,
+                max_batch_pixels=max_batch_pixels
+            )
+            for index, device in enumerate(devices)
+        ]
+
+        # Downloaded models may be warmed up
+        if isinstance(self.models, ModelManager):
+            download_callback = self.models.download_callback
+            self.models.download_callback = lambda: self.handle_models_update(download_callback)
+
+        print(f"[GEN] Generator is ready with {len(self.workers)} workers at {', '.join(devices)}.")
+
+    @property
+    def stats(self) -> list[dict]:
+        return [
+            {
+                "device" : worker.device_name,
+                "is_running" : worker.running is not None,
+                "pipelines" : worker.pipelines.stats,
+                "planner" : worker.planner.stats,
+                "optimization" : worker.cached.optimization.stats if worker.cached is not None and worker.cached.optimization is not None else None
+            }
+            for worker in self.workers
+        ]
+
+    @property
+    def embeddings_stats(self) -> dict:
+        return self.prompt_embeddings.stats
+
+    # Kinds of devices and precisions of workers, images of the same settings slightly differ between them
+    @property
+    def execution_identity(self) -> list[list[str]]:
+        return [list(pair) for pair in sorted(set((worker.device.type, str(worker.dtype)) for worker in self.workers))]
+
+    # Metrics are recorded by this process, so there are none of another process
+    @property
+    def process_metrics(self) -> dict | None:
+        return None
 
-        # Original convolution initialiser
-        self._original_conv_init = torch.nn.Conv2d.__init__
+    def start(self):
+        self.preview_encoder.start()
+        self.image_encoder.start()
 
-        print(f"[GEN] Generator is ready at '{self.device_name}' with {self.total_vram_amount}GB VRAM available.")
+        for worker in self.workers:
+            worker.start()
 
-    def start(self):
-        self.daemon = Thread(target=self.execute_tasks, daemon=True, name="varnava-image-generator")
-        self.daemon.start()
+        self.warm_up_if_needed()
+
+    def handle_models_update(self, callback):
+        if callback is not None:
+            callback()
+
+        self.warm_up_if_needed()
+
+    # Warms up the last used or default preview model once it is downloaded, models of other processes are warmed up by request
+    def warm_up_if_needed(self):
+        if self.warm_up_enabled == False or self.is_warm_up_requested == True or isinstance(self.models, ModelManager) == False:
+            return
+
+        model = self.models.warm_up_model
+
+        if model is None:
+            return
+
+        self.is_warm_up_requested = True
+        self.warm_up(model.path)
+
+    # Requests every worker to load the model and run a tiny generation while idle
+    def warm_up(self, model : str):
+        for worker in self.workers:
+            worker.warm_up_settings = ImageGeneratorTaskSettings(model=model, steps=2)
+
+        self.tasks.interrupt()
+
+    def notify_warmed_up(self, info : dict):
+        # Failed warm-ups are retried on the next models update
+        if info["is_successful"] == False:
+            self.is_warm_up_requested = False
+
+        if self.warm_up_callback is not None:
+            self.warm_up_callback(info)
+
+    def notify_component_hashes(self, path : str, revision : str | None, hashes : dict[str, str]):
+        self.models.update_component_hashes(path, revision, hashes)
+
+        if self.component_hashes_callback is not None:
+            self.component_hashes_callback(path, revision, hashes)
 
     def stop(self):
-        self.pipe = None
+        for worker in self.workers:
+            worker.stop()
+
+        self.image_encoder.stop()
 
     def add_task(
         self,
         task : ImageGeneratorTask
     ):
-        self.tasks.put(task)
-
-    def execute_tasks(self):
-        while True:
-            sleep(0.5)
-
-            task : ImageGeneratorTask = self.tasks.get(block=True, timeout=None)
-
-            self.prepare_model_if_needed(task.settings)
-            
-            if self.device_name == "cuda":
-                generator = torch.Generator(device=self.device_name)
-            else:
-                generator = None
-
-            max_steps = task.settings.steps
-            guidance_scale = task.settings.strength * 40
-            aspect = task.settings.dimensions
-            
-            if self.device_name == "cuda":
-                seed = task.settings.seed if task.settings.seed != -1 else torch.Generator(device=self.device_name).seed()
-                generator = generator.manual_seed(seed)
-            else:
-                seed = 0
-
-            if task.settings.type == ImageGeneratorTaskType.upscale:
-                max_steps = 75
-
-            width = self.base_dimension
-            height = self.base_dimension
-
-            if aspect < 1:
-                width = round(width * aspect)
-            elif aspect > 1:
-                height = round(height / aspect)
-
-            print(f"[GEN] Generating output {width}x{height}: type={task.settings.type} steps={max_steps}, scale={guidance_scale}, aspect={aspect}.")
-    
-            def handle_callback(step, timestep, latents):
-                # Storing progress images at a particular index
-                # latents = 1 / 0.18215 * latents
-                for index, latent in enumerate(latents):
-                    if self.approximate_image_decoder is not None:
-                        preview = self.approximate_image_decoder(latent)
-                        preview.save(task.outputs[index].url)  
-
-                # Progress calculation
-                progress = 1.0 - float(timestep.item()) / float(self.pipe.scheduler.config.num_train_timesteps)
-
-                # Notifying about callback datas
-                task.callback(task, progress, seed)
-
-            # Executing the model itself
-            images = []
-
-            if task.settings.type == ImageGeneratorTaskType.preview and isinstance(self.pipe, StableDiffusionPipeline):
-                images = self.pipe(  
-                    prompt=task.prompt, 
-                    width=width,
-                    height=height,
-                    num_inference_steps=max_steps,
-                    guidance_scale=guidance_scale,
-                    num_images_per_prompt=len(task.outputs),
-                    callback=handle_callback,
-                    callback_steps=1,
-                    generator=generator
-                ).images 
-
-            elif task.settings.type == ImageGeneratorTaskType.upscale and isinstance(self.pipe, StableDiffusionUpscalePipeline):
-                source_image = Image.open(task.settings.initial_url).convert("RGB")
-
-                # TODO: detect automatically the maximum scale supported by the current GPU device
-                # For now it is hardcoded for 24GB memory GPUs.
-                upscale_dimension = task.settings.upscale.dimension
-                supplied_dimension = int(float(upscale_dimension) / float(512)) * 128
-                
-                source_image = source_image.resize((supplied_dimension, 
-                                                    supplied_dimension))
-
-                images = self.pipe(
-                    prompt=task.prompt,
-                    callback=handle_callback,
-                    callback_steps=1,
-                    image=source_image
-                ).images
-
-            if torch.cuda.is_available():            
-                torch.cuda.empty_cache()
-                torch.cuda.ipc_collect()
-
-            gc.collect()
-
-            self.last_task = task
-
-            for index, image in enumerate(images):
-                image.save(task.outputs[index].url)
-
-            task.callback(task, 1.0, seed)
-    
-    def prepare_model_if_needed(self, settings : ImageGeneratorTaskSettings):
-        if self.last_task is not None:
-            is_same_model = settings.is_structurally_equal(self.last_task.settings)
-        else:
-            is_same_model = False
+        self.tasks.put(task, key=self.pipeline_identity(task.settings))
 
-        if is_same_model == True:
-            print("[GEN] Reusing last model")
-            return
+    # Cancels outputs both in the queue and in the running batch, returns identifiers of cancelled outputs
+    def cancel_outputs(self, ids : set[UUID] | None = None) -> list[UUID]:
+        cancelled = []
 
-        self.pipe = None
+        def cancel(task : ImageGeneratorTask) -> bool:
+            for output in task.outputs:
+                if (ids is None or output.id in ids) and output.is_cancelled == False:
+                    output.is_cancelled = True
+                    cancelled.append(output.id)
 
-        print(f"[GEN] Reloading model")
-        
-        torch.nn.Conv2d.__init__ = self._original_conv_init
+            return task.is_cancelled
 
-        if settings.type == ImageGeneratorTaskType.preview:
-            model = self.models.get_preview_model_by_id(settings.model)
+        # Pending tasks are dropped once all their outputs are cancelled, other ones skip cancelled outputs
+        def remove_if_cancelled(task : ImageGeneratorTask) -> bool:
+            if cancel(task) == True:
+                return True
 
-            if model is None:
-                model = self.models.preview_models[0]
+            task.outputs = [output for output in task.outputs if output.is_cancelled == False]
+            return False
 
-            if settings.seamless == 1:
-                init = torch.nn.Conv2d.__init__
-                def __init__(self, *args, **kwargs):
-                    return init(self, *args, **kwargs, padding_mode='circular')
-                torch.nn.Conv2d.__init__ = __init__
-
-            pipe = StableDiffusionPipeline.from_pretrained(
-                model.path,
-                torch_dtype=torch.float16 if self.device_name == "cuda" else torch.float32, 
-                revision=model.revision,
-                safety_checker=None,
-                cache_dir=self.models.url_for_models,
-                local_files_only=True
-            )
+        with self.tasks.condition:
+            self.tasks.remove(remove_if_cancelled)
 
-        elif settings.type == ImageGeneratorTaskType.upscale:
-            pipe = StableDiffusionUpscalePipeline.from_pretrained(
-                self.models.upscale_models[0].path,
-                torch_dtype=torch.float16 if self.device_name == "cuda" else torch.float32, 
-                revision=self.models.upscale_model.revision,
-                cache_dir=self.models.url_for_models,
-                local_files_only=True
-            )
+            # Running tasks are stopped at the next denoising step
+            for worker in self.workers:
+                if worker.running is not None:
+                    for task in worker.running.tasks:
+                        cancel(task)
+
+        return cancelled
 
-        if settings.method == "dpm":
-            pipe.scheduler = DPMSolverMultistepScheduler.from_config(pipe.scheduler.config)
-        elif settings.method == "ddim":
-            pipe.scheduler = DDIMScheduler.from_config(pipe.scheduler.config)
-        elif settings.method == "k-lms":
-            pipe.scheduler = LMSDiscreteScheduler.from_config(pipe.scheduler.config)
-        elif settings.method == "heun":
-            pipe.scheduler = HeunDiscreteScheduler.from_config(pipe.scheduler.config)
-        elif settings.method == "dpm-ss":
-            pipe.scheduler = DPMSolverSinglestepScheduler.from_config(pipe.scheduler.config)
-        elif settings.method == "deis-ms":
-            pipe.scheduler = DEISMultistepScheduler.from_config(pipe.scheduler.config)
-
-        pipe = pipe.to(self.device_name)
+    # Drops everything derived from a removed model
+    def remove_model(self, model : str):
+        self.prompt_embeddings.remove(model)
 
+        for worker in self.workers:
+            worker.remove_model(model)
+
+    def dimensions_for_settings(self, settings : ImageGeneratorTaskSettings) -> tuple[int, int]:
+        aspect = settings.dimensions
+
+        width = self.base_dimension
+        height = self.base_dimension
+
+        if aspect < 1:
+            width = round(width * aspect)
+        elif aspect > 1:
+            height = round(height / aspect)
+
+        if self.is_optimized == True:
+            return bucket_length(width), bucket_length(height)
+
+        return width, height
+
+    # Identity of the model needed for a task, which is the same for all workers
+    def pipeline_identity(self, settings : ImageGeneratorTaskSettings) -> tuple:
         if settings.type == ImageGeneratorTaskType.upscale:
-            print("[GEN] Attention slicing is enabled")
-            pipe.enable_attention_slicing()
+            model = self.models.upscale_models[0]
+        else:
+            model = self.models.get_preview_model_by_id(settings.model)
 
-        # TODO: create better mapping for this size
-        if self.total_vram_amount <= 17:
-            print("[GEN] Attention slicing is enabled")
-            pipe.enable_attention_slicing()
+            if model is None:
+                model = self.models.preview_models[0]
 
-        self.pipe = pipe
-        self.approximate_image_decoder = ApproximateDecoder.for_pipeline(pipe)
+        # Variations are denoised by the pipeline of the preview model, so its weights are loaded once
+        if settings.type == ImageGeneratorTaskType.variation:
+            return (model.path, model.revision, ImageGeneratorTaskType.preview.value)
 
-        print("[GEN] Reloaded model")
+        return (model.path, model.revision, settings.type.value)
 
     def wait(self):
-        self.daemon.join()
+        for worker in self.workers:
+            worker.wait()
 
 from uuid import uuid4
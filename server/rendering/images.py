@@ -0,0 +1,41 @@
+import os
+from time import sleep
+from uuid import uuid4
+from PIL import Image
+from .tasks import ImageGeneratorImageFormat, ImageGeneratorTaskOutputSettings
+
+# Compression level of PNG images, lower levels are encoded several times faster at large sizes with slightly larger files
+PNG_COMPRESS_LEVEL = 3
+
+# Format and options of Pillow for output settings, both previews and final images of an output are written in its format
+def save_options_for(output : ImageGeneratorTaskOutputSettings) -> dict:
+    if output.format == ImageGeneratorImageFormat.png:
+        return { "format" : "PNG", "compress_level" : PNG_COMPRESS_LEVEL }
+    elif output.format == ImageGeneratorImageFormat.webp:
+        return { "format" : "WEBP", "quality" : output.quality }
+
+    return { "format" : "JPEG", "quality" : output.quality }
+
+def save_image(image : Image.Image, url : str, format : str = "JPEG", attempts : int = 5, **options):
+    """Writes an image next to its destination and moves it in place,
+    so readers never see a partially written file.
+    """
+
+    temporary_url = f"{url}.{uuid4().hex}.tmp"
+
+    try:
+        image.save(temporary_url, format=format, **options)
+
+        # Destination can be briefly locked by a reader on Windows
+        for attempt in range(attempts):
+            try:
+                os.replace(temporary_url, url)
+                return
+            except PermissionError:
+                if attempt == attempts - 1:
+                    raise
+
+                sleep(0.05)
+    finally:
+        if os.path.exists(temporary_url):
+            os.remove(temporary_url)
@@ -12,7 +12,7 @@ from huggingface_hub._snapshot_download import snapshot_download
 from huggingface_hub.file_download import repo_folder_name
 from huggingface_hub.utils import scan_cache_dir
 from mashumaro import DataClassDictMixin
-from diffusers.pipelines.pipeline_utils import variant_compatible_siblings
+from .weights import is_safetensors_available, is_safetensors_complete
 
 @dataclass
 class RemoteModel(DataClassDictMixin):
@@ -21,6 +21,7 @@ class RemoteModel(DataClassDictMixin):
     revision : str | None = None
     downloaded_file_bytes : int = 0 # Current number of bytes on local device
     total_file_bytes : int = 0 # Total number of bytes to be downloaded from remote
+    component_hashes : dict[str, str] = field(default_factory=dict) # Hashes of weights of components shared between models
 
 @dataclass 
 class ModelsConfiguration(DataClassDictMixin):
@@ -29,6 +30,36 @@ class ModelsConfiguration(DataClassDictMixin):
     preview_models : list[RemoteModel] = field(default_factory=list) 
     upscale_models : list[RemoteModel] = field(default_factory=list) 
 
+    # Path of the preview model used by the latest generation
+    last_used_model : str | None = None
+
+@dataclass
+class ModelsSnapshot(DataClassDictMixin):
+    """Models configuration needed for generation, used in place of the manager
+    by generators running outside of the process managing models.
+    """
+
+    url_for_models : str
+
+    preview_models : list[RemoteModel] = field(default_factory=list)
+    upscale_models : list[RemoteModel] = field(default_factory=list)
+
+    # Getting model info by its path (id)
+    def get_preview_model_by_id(self, id):
+        models = { model.path : model for model in self.preview_models }
+        return models.get(id)
+
+    def update(self, snapshot : "ModelsSnapshot"):
+        self.url_for_models = snapshot.url_for_models
+        self.preview_models = snapshot.preview_models
+        self.upscale_models = snapshot.upscale_models
+
+    # Hashes are kept until the next snapshot, which has them once the managing process stores them
+    def update_component_hashes(self, path : str, revision : str | None, hashes : dict[str, str]):
+        for model in self.preview_models + self.upscale_models:
+            if model.path == path and model.revision == revision:
+                model.component_hashes = dict(hashes)
+
 class ModelManager:
 
     # Various paths that are model storages and data storages.
@@ -75,6 +106,19 @@ class ModelManager:
             revision="fp16"
         )
     
+    # Preview model loaded ahead of the first generation: the last used one or the default one, once downloaded
+    @property
+    def warm_up_model(self) -> RemoteModel | None:
+        model = self.get_preview_model_by_id(self.__config.last_used_model) if self.__config.last_used_model is not None else None
+
+        if model is None and len(self.preview_models) > 0:
+            model = self.preview_models[0]
+
+        if model is None or self.is_model_downloaded(model) == False:
+            return None
+
+        return model
+
     # Download state
 
     @property
@@ -110,6 +154,9 @@ class ModelManager:
         # Storing channel to send quick updates
         self.download_callback = download_callback
 
+        # Called with the path of a removed model, so generators drop everything derived from it
+        self.removal_callback = None
+
         # HF API instance
         self.api = HfApi()
 
@@ -119,11 +166,14 @@ class ModelManager:
         # Downloading thread
         self.download_process : Process | None = None
 
-        # Ignored file extensions inside repositories
-        self.ignored_patterns = ["*.ckpt", "*.safetensors"]
+        # Ignored file extensions inside repositories, weights of components are downloaded
+        # either as safetensors or as pickle files (see `ignored_patterns_for`)
+        self.ignored_patterns = ["*.ckpt"]
         
         self.fetch_resources_local_information()
-        self.fetch_resources_remote_information()
+
+        # Remote sizes are fetched in the background, so the server starts without waiting for the hub
+        Thread(target=self.fetch_resources_remote_information_in_background, daemon=True, name="varnava-models-remote").start()
 
     # Updating state of the manager
 
@@ -138,6 +188,9 @@ class ModelManager:
         self.__config.preview_models = [model for model in self.__config.preview_models if model.path != id]
         self.write_config()
 
+        if self.removal_callback is not None:
+            self.removal_callback(id)
+
         if self.download_callback is not None:
             self.download_callback()
 
@@ -189,8 +242,49 @@ class ModelManager:
         models = { model.path : model for model in self.preview_models }
         return models.get(id)
 
+    # Remembering the model of a generation, so it is loaded first after restart
+    def use_preview_model(self, id):
+        model = self.get_preview_model_by_id(id)
+
+        if model is None and len(self.preview_models) > 0:
+            model = self.preview_models[0]
+
+        if model is None or model.path == self.__config.last_used_model:
+            return
+
+        self.__config.last_used_model = model.path
+        self.write_config()
+
+    # Sizes on disk are never smaller than sizes of downloaded files, sizes are unknown if remote information is missing
+    def is_model_downloaded(self, model : RemoteModel) -> bool:
+        if model.downloaded_file_bytes == 0:
+            return False
+
+        if model.total_file_bytes == 0:
+            return self.is_downloading == False
+
+        return model.downloaded_file_bytes >= model.total_file_bytes
+
+    # Current models configuration for generators in other processes
+    def snapshot(self) -> ModelsSnapshot:
+        return ModelsSnapshot(
+            url_for_models=self.url_for_models,
+            preview_models=list(self.preview_models),
+            upscale_models=list(self.upscale_models)
+        )
+
     # Fetching remote resource information about file sizes
 
+    def fetch_resources_remote_information_in_background(self):
+        try:
+            self.fetch_resources_remote_information()
+        except Exception as e:
+            print(f"[SRV] Failed to fetch remote models information: {e}")
+            return
+
+        if self.download_callback is not None:
+            self.download_callback()
+
     def fetch_resources_remote_information(self):
         for index, resource in enumerate(self.preview_models):
             if resource.total_file_bytes != 0:
@@ -216,11 +310,47 @@ class ModelManager:
     
         self.write_config()
 
+    # Safetensors weights are preferred, as they are memory mapped when loaded instead of being unpickled,
+    # unless some component has only pickle weights or pickle weights are downloaded already (they are converted locally)
+    def ignored_patterns_for(self, filenames : list[str], local_filenames : list[str] | None = None) -> list[str]:
+        if local_filenames is None:
+            local_filenames = []
+
+        # Single file checkpoints at the root of repositories are not used by pipelines
+        patterns = self.ignored_patterns + [name for name in filenames if "/" not in name and (name.endswith(".safetensors") or name.endswith(".bin"))]
+
+        is_pickle_downloaded = any(name.endswith(".bin") and "/" in name for name in local_filenames)
+
+        if is_safetensors_available() and is_safetensors_complete(filenames) and is_pickle_downloaded == False:
+            return patterns + ["*.bin"]
+
+        return patterns + ["*.safetensors"]
+
+    # Relative paths of files of the downloaded model revision
+    def local_filenames_for(self, resource : RemoteModel) -> list[str]:
+        try:
+            repos = { repo.repo_id : repo for repo in list(scan_cache_dir(self.url_for_models).repos) }
+            revision = repos[resource.path].refs[resource.revision]
+        except:
+            return []
+
+        return [str(file.file_path.relative_to(revision.snapshot_path)).replace(os.sep, "/") for file in revision.files]
+
+    def ignored_patterns_for_model(self, resource : RemoteModel) -> list[str]:
+        try:
+            info = self.api.repo_info(repo_id=resource.path, repo_type="model", revision=resource.revision)
+        except:
+            return self.ignored_patterns + ["*.safetensors"]
+
+        return self.ignored_patterns_for([file.rfilename for file in info.siblings], self.local_filenames_for(resource))
+
     def __get_model_network_size(self, info):
         total_file_bytes = 0
-            
+
+        ignored_patterns = self.ignored_patterns_for([file.rfilename for file in info.siblings])
+
         for file in info.siblings:
-            if any(fnmatch(file.rfilename, pattern) for pattern in self.ignored_patterns):
+            if any(fnmatch(file.rfilename, pattern) for pattern in ignored_patterns):
                 continue
 
             if file.lfs is not None:
@@ -271,9 +401,8 @@ class ModelManager:
                         resume_download=True,
                         cache_dir=self.url_for_models,
                         max_workers=1,
-                        ignore_patterns=self.ignored_patterns
+                        ignore_patterns=self.ignored_patterns_for_model(resource)
                     )
-                    
                 except:
                     pass
 
@@ -297,6 +426,21 @@ class ModelManager:
         loop = asyncio.get_event_loop()
         loop.create_task(fetch_resources_local_information_periodically())
 
+    # Stores hashes of components computed by generators on the first load of a model, once its weights are converted,
+    # so components identical to ones of other models are loaded only once
+    def update_component_hashes(self, path : str, revision : str | None, hashes : dict[str, str]):
+        models = [model for model in self.preview_models + self.upscale_models if model.path == path and model.revision == revision]
+
+        if len(models) == 0 or all(model.component_hashes == hashes for model in models):
+            return
+
+        for model in models:
+            model.component_hashes = dict(hashes)
+
+        print(f"[SRV] Hashed components of model '{path}': {', '.join(hashes)}")
+
+        self.write_config()
+
     def stop_downloading(self):
         if self.download_process is None:
             return
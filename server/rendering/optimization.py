@@ -0,0 +1,105 @@
+import copy
+import torch
+import torch.nn.functional as F
+from dataclasses import dataclass
+
+# Side of resolution buckets (in pixels), generated sizes are rounded to its multiples so compiled graphs are reused
+BUCKET_SIZE = 64
+
+# Compiled graphs kept per compiled module, every bucket, batch size and pipeline state needs its own
+COMPILED_GRAPHS_LIMIT = 64
+
+def bucket_length(length : float, bucket_size : int = BUCKET_SIZE) -> int:
+    return max(round(length / bucket_size), 1) * bucket_size
+
+def is_optimization_supported() -> bool:
+    return hasattr(torch, "compile") and hasattr(F, "scaled_dot_product_attention")
+
+# Fused attention processor of the installed diffusers, none if it is not available
+def fused_attention_processor():
+    try:
+        from diffusers.models.cross_attention import AttnProcessor2_0
+    except ImportError:
+        return None
+
+    return AttnProcessor2_0() if hasattr(F, "scaled_dot_product_attention") else None
+
+@dataclass(frozen=True)
+class CompiledShape:
+    """Everything compiled graphs of a pipeline call are specialised to."""
+
+    width : int
+    height : int
+    images : int
+
+    # Sampling method, timesteps of some schedulers are integers and of other ones are floats
+    method : str = ""
+
+    is_seamless : bool = False
+    vae_slicing : bool = False
+
+class PipelineOptimization:
+    """Channels-last layout, fused attention and compiled UNet and VAE decoder of a loaded pipeline.
+    Compiled graphs are specialised to shapes, calls of shapes which are not compiled yet run eagerly
+    while the shapes are compiled in the background by a copy of the pipeline sharing its modules.
+    """
+
+    def __init__(self, pipe):
+        self.pipe = pipe
+
+        # Compiled shapes, and shapes requested to be compiled including them
+        self.shapes : set[CompiledShape] = set()
+        self.requested : set[CompiledShape] = set()
+
+        # Optimization is dropped for good once compiling fails or weights are offloaded
+        self.is_enabled = True
+
+        if torch._dynamo.config.cache_size_limit < COMPILED_GRAPHS_LIMIT:
+            torch._dynamo.config.cache_size_limit = COMPILED_GRAPHS_LIMIT
+
+        pipe.unet.to(memory_format=torch.channels_last)
+        pipe.vae.to(memory_format=torch.channels_last)
+
+        # Same processor is kept, so compiled graphs are not invalidated when it is applied again
+        self.processor = fused_attention_processor()
+        self.apply_fused_attention()
+
+        self.unet = torch.compile(pipe.unet, dynamic=False)
+        self.decoder = torch.compile(pipe.vae.decoder, dynamic=False)
+
+    @property
+    def stats(self) -> dict:
+        return {
+            "is_enabled" : self.is_enabled,
+            "compiled" : len(self.shapes),
+            "pending" : len(self.requested) - len(self.shapes)
+        }
+
+    def apply_fused_attention(self):
+        if self.processor is not None:
+            self.pipe.unet.set_attn_processor(self.processor)
+
+    # Copy of the pipeline calling compiled modules, weights and state of modules are shared with the pipeline
+    def compiled_pipe(self, scheduler, vae_slicing : bool | None = None):
+        vae = copy.copy(self.pipe.vae)
+        vae._modules = { **vae._modules, "decoder" : self.decoder }
+
+        if vae_slicing is not None and hasattr(vae, "use_slicing"):
+            vae.use_slicing = vae_slicing
+
+        pipe = copy.copy(self.pipe)
+        pipe.unet = self.unet
+        pipe.vae = vae
+        pipe.scheduler = scheduler
+
+        return pipe
+
+    # Pipeline with compiled modules for a compiled shape, none otherwise
+    def pipe_for(self, shape : CompiledShape):
+        if self.is_enabled == False or shape not in self.shapes:
+            return None
+
+        return self.compiled_pipe(self.pipe.scheduler)
+
+    def disable(self):
+        self.is_enabled = False
@@ -0,0 +1,189 @@
+from dataclasses import dataclass
+from threading import Lock
+from typing import Hashable
+
+@dataclass(frozen=True)
+class ExecutionPlan:
+    """Memory saving options for a pipeline call, from the fastest to the most frugal ones."""
+
+    # Whether attention is computed in slices of heads
+    attention_slicing : bool = False
+
+    # Whether images are decoded by the VAE one by one (or by tiles, where supported)
+    vae_slicing : bool = False
+
+    # Whether weights are kept in host memory and moved to the device module by module
+    cpu_offload : bool = False
+
+    # Maximum number of images denoised by a single pipeline call, larger batches are split
+    max_images : int = 1
+
+    # Expected peak memory (in bytes) of the call on top of the loaded weights
+    estimated_peak : int = 0
+
+@dataclass
+class ExecutionShape:
+    """What is generated by a pipeline call, as far as memory is concerned."""
+
+    # Pipeline type ("preview", "upscale", "variation")
+    type : str
+
+    # Size of latents of a single image
+    latent_width : int
+    latent_height : int
+
+    # Scale of decoded images relative to latents
+    scale : int
+
+    # Number of images
+    images : int
+
+    # Number of attention heads at the highest resolution and how much the resolution is reduced there
+    heads : int = 8
+    attention_reduction : int = 1
+
+    # Bytes per element of activations
+    element_size : int = 2
+
+    # Whether the pipeline can decode images one by one, plans of other pipelines never slice the VAE
+    is_vae_slicing_supported : bool = True
+
+class ExecutionPlanner:
+    """Estimates peak memory of pipeline calls and picks the fastest execution plan which fits available memory.
+    Estimates come from a rough model of activation sizes which is corrected by peaks recorded on every call,
+    separately for every model.
+    """
+
+    # Elements of UNet activations kept per latent pixel of an image (with classifier free guidance)
+    unet_elements_per_pixel = 40 * 1024
+
+    # Elements of VAE decoder activations per decoded pixel
+    vae_elements_per_pixel = 512
+
+    # Part of available memory plans are allowed to use
+    headroom = 0.85
+
+    def __init__(self, is_offload_supported : bool = False):
+        self.is_offload_supported = is_offload_supported
+
+        # Ratio of recorded and estimated peaks for every model
+        self.corrections : dict[Hashable, float] = {}
+        self.lock = Lock()
+
+        # Statistics
+        self.planned = 0
+        self.recorded = 0
+        self.splits = 0
+        self.offloads = 0
+
+    @property
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "planned" : self.planned,
+                "recorded" : self.recorded,
+                "splits" : self.splits,
+                "offloads" : self.offloads,
+                "corrections" : { str(key) : round(value, 3) for key, value in self.corrections.items() },
+            }
+
+    def estimate(self, key : Hashable, shape : ExecutionShape, plan : ExecutionPlan) -> int:
+        images = min(shape.images, plan.max_images)
+        pixels = shape.latent_width * shape.latent_height
+
+        # Activations of both guided and unguided images
+        unet = images * 2 * pixels * self.unet_elements_per_pixel
+
+        # Attention scores of all heads at once, or of half of the heads of a single image when sliced
+        tokens = pixels // (shape.attention_reduction ** 2)
+
+        if plan.attention_slicing == True:
+            attention = max(shape.heads // 2, 1) * tokens * tokens
+        else:
+            attention = images * 2 * shape.heads * tokens * tokens
+
+        # Decoding, including the single head attention of the VAE at the latent resolution
+        decoded_images = 1 if plan.vae_slicing == True and shape.is_vae_slicing_supported == True else images
+        vae = decoded_images * (pixels * shape.scale * shape.scale * self.vae_elements_per_pixel + pixels * pixels)
+
+        peak = max(unet + attention, vae) * shape.element_size
+
+        with self.lock:
+            return int(peak * self.corrections.get(key, 1.0))
+
+    # Plans from the fastest to the most frugal one, made only of options the pipeline supports
+    def candidates(self, shape : ExecutionShape) -> list[ExecutionPlan]:
+        vae_slicing = shape.is_vae_slicing_supported
+
+        plans = [ExecutionPlan(max_images=shape.images)]
+
+        if vae_slicing == True:
+            plans.append(ExecutionPlan(vae_slicing=True, max_images=shape.images))
+
+        plans.append(ExecutionPlan(attention_slicing=True, vae_slicing=vae_slicing, max_images=shape.images))
+
+        images = shape.images
+
+        while images > 1:
+            images = (images + 1) // 2
+            plans.append(ExecutionPlan(attention_slicing=True, vae_slicing=vae_slicing, max_images=images))
+
+        if self.is_offload_supported == True:
+            plans.append(ExecutionPlan(attention_slicing=True, vae_slicing=vae_slicing, cpu_offload=True, max_images=1))
+
+        return plans
+
+    # Picks the fastest plan fitting the available memory (in bytes), weights of the model are freed by offloading
+    def plan(self, key : Hashable, shape : ExecutionShape, available : int, weights : int = 0) -> ExecutionPlan:
+        candidates = self.candidates(shape)
+        chosen = candidates[-1]
+
+        for candidate in candidates:
+            limit = (available + weights if candidate.cpu_offload == True else available) * self.headroom
+            estimated = self.estimate(key, shape, candidate)
+
+            if estimated <= limit:
+                chosen = candidate
+                break
+
+        chosen = ExecutionPlan(
+            attention_slicing=chosen.attention_slicing,
+            vae_slicing=chosen.vae_slicing,
+            cpu_offload=chosen.cpu_offload,
+            max_images=chosen.max_images,
+            estimated_peak=self.estimate(key, shape, chosen)
+        )
+
+        with self.lock:
+            self.planned += 1
+
+            if chosen.max_images < shape.images:
+                self.splits += 1
+
+            if chosen.cpu_offload == True:
+                self.offloads += 1
+
+        return chosen
+
+    # Records the measured peak of a call executed with the plan
+    def record(self, key : Hashable, shape : ExecutionShape, plan : ExecutionPlan, peak : int):
+        if peak <= 0:
+            return
+
+        with self.lock:
+            correction = self.corrections.get(key, 1.0)
+
+        estimated = self.estimate(key, shape, plan) / correction
+
+        if estimated <= 0:
+            return
+
+        with self.lock:
+            # Moving averages follow changes without jumping on outliers, recorded corrections start from the measurement
+            ratio = peak / estimated
+            self.corrections[key] = ratio if key not in self.corrections else correction * 0.5 + ratio * 0.5
+            self.recorded += 1
+
+    # Whether freeing cached allocations is worth it before running a call needing the memory
+    def is_cleanup_needed(self, available : int, total : int) -> bool:
+        return available < total * (1 - self.headroom)
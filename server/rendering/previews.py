@@ -0,0 +1,99 @@
+from collections import OrderedDict
+from dataclasses import replace
+from threading import Thread, Condition
+from time import monotonic
+from PIL import Image
+from lib.metrics import metrics
+from .images import save_image, save_options_for
+from .tasks import ImageGeneratorTaskOutputSettings
+
+IMAGE_ENCODE = metrics.histogram("varnava_image_encode_seconds", "Time of encoding and writing images", labels=("kind",))
+
+class PreviewCadence:
+    """Decides which denoising steps produce preview frames: every N steps and not more often than every X ms."""
+
+    def __init__(self, every_steps : int = 1, every_ms : float = 0):
+        self.every_steps = max(every_steps, 1)
+        self.every_ms = every_ms
+        self.last_time : float | None = None
+
+    def is_due(self, step : int) -> bool:
+        if step % self.every_steps != 0:
+            return False
+
+        now = monotonic()
+
+        if self.last_time is not None and (now - self.last_time) * 1000 < self.every_ms:
+            return False
+
+        self.last_time = now
+        return True
+
+class PreviewEncoder:
+    """Encodes and writes preview frames on a background thread.
+    Only the latest frame of every output is kept, older frames which were not written yet are dropped,
+    as well as the oldest outputs once more than `max_pending` are waiting.
+    Frames are written at the url of their output, so they are encoded in its format with a lower quality.
+    """
+
+    def __init__(self, max_pending : int = 16, quality : int = 80):
+        self.max_pending = max_pending
+        self.quality = quality
+
+        self.pending : OrderedDict[str, tuple[Image.Image, ImageGeneratorTaskOutputSettings]] = OrderedDict()
+        self.writing : str | None = None
+        self.condition = Condition()
+
+        # Statistics
+        self.written = 0
+        self.dropped = 0
+
+        self.daemon : Thread | None = None
+
+    def start(self):
+        self.daemon = Thread(target=self.encode_frames, daemon=True, name="varnava-preview-encoder")
+        self.daemon.start()
+
+    def submit(self, url : str, image : Image.Image, output : ImageGeneratorTaskOutputSettings = ImageGeneratorTaskOutputSettings()):
+        with self.condition:
+            if url in self.pending:
+                self.dropped += 1
+
+            self.pending[url] = (image, output)
+            self.pending.move_to_end(url)
+
+            while len(self.pending) > self.max_pending:
+                self.pending.popitem(last=False)
+                self.dropped += 1
+
+            self.condition.notify_all()
+
+    # Drops pending frames of the outputs and waits until none of them is being written
+    def discard(self, urls : list[str]):
+        with self.condition:
+            for url in urls:
+                self.pending.pop(url, None)
+
+            while self.writing in urls:
+                self.condition.wait()
+
+    def encode_frames(self):
+        while True:
+            with self.condition:
+                while len(self.pending) == 0:
+                    self.condition.wait()
+
+                url, (image, output) = self.pending.popitem(last=False)
+                self.writing = url
+
+            try:
+                with IMAGE_ENCODE.time(kind="preview"):
+                    save_image(image, url, attempts=1, **save_options_for(replace(output, quality=self.quality)))
+
+                self.written += 1
+            except Exception as e:
+                print(f"[GEN] Failed to write preview '{url}': {e}")
+            finally:
+                with self.condition:
+                    self.writing = None
+                    self.condition.notify_all()
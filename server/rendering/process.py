@@ -0,0 +1,185 @@
+import os
+import traceback
+from multiprocessing.connection import Client, Connection
+from threading import Thread, Lock
+from time import sleep
+from PIL import Image
+from lib.metrics import metrics
+from .frames import SharedFrameWriter
+from .generator import ImageGenerator
+from .models import ModelsSnapshot
+from .tasks import ImageGeneratorTask, ImageGeneratorTaskOutputSettings
+
+# Seconds between stats pushed to the web process
+STATS_INTERVAL = 1.0
+
+class RemoteFrames:
+    """Hands preview and final images over to the web process through shared memory,
+    the web process encodes and writes them.
+    """
+
+    def __init__(self, process : "ImageGeneratorProcess"):
+        self.process = process
+        self.writer = SharedFrameWriter()
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def submit(self, url : str, image : Image.Image, output : ImageGeneratorTaskOutputSettings = ImageGeneratorTaskOutputSettings()):
+        self.process.send("frame", url, self.writer.write(image), False, output.to_dict())
+
+    # Frames are handled in order, so discarded previews never replace images written afterwards
+    def discard(self, urls : list[str]):
+        self.process.send("discard", urls)
+
+    def write(self, url : str, image : Image.Image, output : ImageGeneratorTaskOutputSettings = ImageGeneratorTaskOutputSettings()):
+        self.process.send("frame", url, self.writer.write(image), True, output.to_dict())
+
+    # Web process completes tasks once it has written their images
+    def after_written(self, urls : list[str], callback, failure_callback = None):
+        callback()
+
+class ImageGeneratorProcess:
+    """Runs the image generator in a separate process serving requests of the web process.
+    Requests arrive as calls or events over the connection, progress, frames and stats are sent back as events.
+    """
+
+    def __init__(self, connection : Connection):
+        self.connection = connection
+        self.lock = Lock()
+
+        self.generator : ImageGenerator | None = None
+        self.frames = RemoteFrames(self)
+
+        self.is_running = False
+
+        # Calls available to the web process
+        self.handlers = {
+            "cancel_outputs" : self.cancel_outputs,
+        }
+
+        # Events of the web process, which never waits for them
+        self.events = {
+            "add_task" : self.add_task,
+            "remove_model" : lambda model: self.generator.remove_model(model),
+            "warm_up" : self.warm_up,
+        }
+
+    # State read by the web process, stats of pipelines wait for loading models so they are never read on request
+    @property
+    def stats(self) -> dict:
+        return {
+            "workers" : self.generator.stats,
+            "embeddings" : self.generator.embeddings_stats,
+            "metrics" : metrics.snapshot(),
+            "tasks" : {
+                "policy" : self.generator.tasks.policy,
+                "stats" : self.generator.tasks.stats,
+                "pending" : [task.id for task in self.generator.tasks.pending()]
+            }
+        }
+
+    def send(self, *message):
+        with self.lock:
+            self.connection.send(message)
+
+    def run(self):
+        name, options, snapshot = self.connection.recv()
+
+        self.generator = ImageGenerator(models=ModelsSnapshot.from_dict(snapshot), **options)
+        self.generator.preview_encoder = self.frames
+        self.generator.image_encoder = self.frames
+        self.generator.warm_up_callback = lambda info: self.send("warmed_up", info)
+        self.generator.component_hashes_callback = lambda path, revision, hashes: self.send("component_hashes", path, revision, hashes)
+
+        self.send("ready", {
+            "base_dimension" : self.generator.base_dimension,
+            "upscaled_dimension" : self.generator.upscaled_dimension,
+            "execution_identity" : self.generator.execution_identity,
+            "stats" : self.stats
+        })
+
+        self.generator.start()
+
+        self.is_running = True
+        Thread(target=self.push_stats, daemon=True, name="varnava-generator-stats").start()
+
+        while True:
+            try:
+                message = self.connection.recv()
+            except (EOFError, OSError):
+                break
+
+            if message[0] == "call":
+                self.handle_call(*message[1:])
+            elif message[0] == "release":
+                self.frames.writer.release(message[1])
+            elif message[0] == "stop":
+                break
+            elif message[0] in self.events:
+                self.handle_event(*message)
+
+        self.is_running = False
+        self.generator.stop()
+        self.frames.writer.close()
+
+    def handle_call(self, id : int, name : str, args : tuple):
+        try:
+            self.send("result", id, True, self.handlers[name](*args))
+        except Exception as e:
+            traceback.print_exc()
+            self.send("result", id, False, str(e))
+
+    def handle_event(self, name : str, *args):
+        try:
+            self.events[name](*args)
+        except Exception:
+            traceback.print_exc()
+
+    def push_stats(self):
+        while self.is_running == True:
+            try:
+                self.send("stats", self.stats)
+            except OSError:
+                break
+            except Exception as e:
+                print(f"[GEN] Failed to collect stats: {e}")
+
+            sleep(STATS_INTERVAL)
+
+    def add_task(self, task : ImageGeneratorTask, snapshot : dict):
+        self.generator.models.update(ModelsSnapshot.from_dict(snapshot))
+
+        def notify_progress(task : ImageGeneratorTask, progress : float, seed : int, error : str | None = None):
+            self.send("progress", task.id, [output.id for output in task.outputs], progress, seed, error)
+
+        task.callback = notify_progress
+
+        # Web process does not wait for tasks to be added, so tasks which can not be added fail
+        try:
+            self.generator.add_task(task)
+        except Exception as e:
+            traceback.print_exc()
+            notify_progress(task, 1.0, task.settings.seed, error=str(e))
+
+    def warm_up(self, model : str, snapshot : dict):
+        self.generator.models.update(ModelsSnapshot.from_dict(snapshot))
+        self.generator.warm_up(model)
+
+    def cancel_outputs(self, ids):
+        return self.generator.cancel_outputs(ids)
+
+# Entry point of the generator process, connecting to the web process which started it
+def main():
+    host, port = os.environ["VARNAVA_GENERATOR_ADDRESS"].rsplit(":", 1)
+    authkey = bytes.fromhex(os.environ["VARNAVA_GENERATOR_AUTHKEY"])
+
+    connection = Client((host, int(port)), authkey=authkey)
+
+    ImageGeneratorProcess(connection).run()
+
+    # Generation threads are never joined
+    os._exit(0)
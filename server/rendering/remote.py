@@ -0,0 +1,435 @@
+import os
+import sys
+import subprocess
+from dataclasses import replace
+from itertools import count
+from multiprocessing.connection import Listener, Connection
+from threading import Thread, Condition, Lock
+from time import sleep, monotonic
+from uuid import UUID
+from .frames import SharedFrame, read_shared_frame
+from .models import ModelManager
+from .previews import PreviewEncoder
+from .encoding import ImageEncodingPool
+from .tasks import ImageGeneratorTask, ImageGeneratorTaskOutputSettings
+
+# Started with the directory (or zip archive) containing the server modules on the path
+BOOTSTRAP = "import sys; sys.path.insert(0, sys.argv[1]); from rendering.process import main; main()"
+
+# Seconds to wait for results of calls, and between attempts to restart an exited generator process
+CALL_TIMEOUT = 30.0
+RESTART_DELAY = 5.0
+
+class RemoteTaskScheduler:
+    """Queue state of the generator process, mirroring the parts of `TaskScheduler` used by the web process.
+    State is the last one pushed by the generator process, so reading it never waits for generation.
+    """
+
+    def __init__(self, generator : "RemoteImageGenerator"):
+        self.generator = generator
+
+    @property
+    def policy(self) -> dict:
+        return self.generator.state["tasks"]["policy"]
+
+    @property
+    def stats(self) -> dict:
+        return self.generator.state["tasks"]["stats"]
+
+    def pending(self) -> list[ImageGeneratorTask]:
+        ids = self.generator.state["tasks"]["pending"]
+
+        with self.generator.condition:
+            return [self.generator.active_tasks[id] for id in ids if id in self.generator.active_tasks]
+
+class RemoteImageGenerator:
+    """Image generator running in a separate process, so generation never competes with request handling.
+    Tasks and progress are exchanged over a local connection, images are handed over through shared memory
+    and written by the encoders of this process. Stats are pushed by the generator process and kept here,
+    an exited generator process is restarted and given all unfinished tasks again.
+    """
+
+    def __init__(
+        self,
+        url_for_root : str,
+        models_download_callback = None,
+        warm_up_callback = None,
+        warm_up_enabled : bool = True,
+        models : ModelManager | None = None,
+        **options
+    ):
+        # Models are managed by the web process, the generator process gets a snapshot with every task
+        self.models = models if models is not None else ModelManager(url_for_root, download_callback=models_download_callback)
+        self.models.removal_callback = self.remove_model
+
+        # Models are loaded in the background on start, once downloaded, and readiness is reported with the callback
+        self.warm_up_callback = warm_up_callback
+        self.warm_up_enabled = warm_up_enabled
+        self.is_warm_up_requested = False
+
+        # Options of the generator in the generator process
+        self.options = { "url_for_root" : url_for_root, **options }
+
+        self.tasks = RemoteTaskScheduler(self)
+
+        # Tasks which are queued or running by the generator process
+        self.active_tasks : dict[UUID, ImageGeneratorTask] = {}
+
+        self.preview_encoder = PreviewEncoder()
+        self.image_encoder = ImageEncodingPool(workers=options.get("image_encoding_workers", 2))
+
+        self.process : subprocess.Popen | None = None
+        self.connection : Connection | None = None
+        self.daemon : Thread | None = None
+        self.is_stopping = False
+
+        # Last stats pushed by the generator process
+        self.state : dict = {}
+
+        # Calls waiting for their results
+        self.calls = count()
+        self.waiting : set[int] = set()
+        self.results : dict[int, tuple[bool, object]] = {}
+        self.condition = Condition()
+        self.lock = Lock()
+
+        self.base_dimension : int | None = None
+        self.upscaled_dimension : int | None = None
+        self.execution_identity : list[list[str]] | None = None
+
+        # Downloaded models may be warmed up
+        download_callback = self.models.download_callback
+        self.models.download_callback = lambda: self.handle_models_update(download_callback)
+
+    @property
+    def stats(self) -> list[dict]:
+        return self.state["workers"]
+
+    @property
+    def embeddings_stats(self) -> dict:
+        return self.state["embeddings"]
+
+    # Metrics recorded by the generator process
+    @property
+    def process_metrics(self) -> dict:
+        return self.state["metrics"]
+
+    def start(self):
+        self.connect()
+
+        self.preview_encoder.start()
+        self.image_encoder.start()
+
+        self.daemon = Thread(target=self.receive_messages, daemon=True, name="varnava-generator-connection")
+        self.daemon.start()
+
+        self.warm_up_if_needed()
+
+    # Starts the generator process and waits until it is ready
+    def connect(self):
+        authkey = os.urandom(32)
+        listener = Listener(("127.0.0.1", 0), authkey=authkey)
+
+        host, port = listener.address
+        url_for_modules = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+        self.process = subprocess.Popen([sys.executable, "-c", BOOTSTRAP, url_for_modules], env={
+            **os.environ,
+            "VARNAVA_GENERATOR_ADDRESS" : f"{host}:{port}",
+            "VARNAVA_GENERATOR_AUTHKEY" : authkey.hex(),
+            "PYTHONUNBUFFERED" : "1"
+        })
+
+        try:
+            connection = self.accept(listener)
+        finally:
+            listener.close()
+
+        connection.send(("init", self.options, self.models.snapshot().to_dict()))
+
+        name, info = connection.recv()
+
+        self.base_dimension = info["base_dimension"]
+        self.upscaled_dimension = info["upscaled_dimension"]
+        self.execution_identity = info["execution_identity"]
+        self.state = info["stats"]
+
+        with self.condition:
+            self.connection = connection
+
+        print(f"[GEN] Generator process {self.process.pid} is ready")
+
+    # Starts a new generator process once the previous one exited, its unfinished tasks are generated from the start
+    def restart(self):
+        if self.process.poll() is None:
+            self.process.kill()
+
+        self.process.wait()
+
+        print(f"[GEN] Generator process exited with code {self.process.returncode}, restarting")
+
+        while self.is_stopping == False:
+            try:
+                self.connect()
+                break
+            except Exception as e:
+                print(f"[GEN] Failed to restart generator process: {e}")
+                sleep(RESTART_DELAY)
+        else:
+            return
+
+        with self.condition:
+            tasks = list(self.active_tasks.values())
+
+        for task in tasks:
+            self.send_task(task)
+
+        if len(tasks) > 0:
+            print(f"[GEN] Restarted {len(tasks)} tasks")
+
+        # Models are warmed up again by the new process
+        self.is_warm_up_requested = False
+        self.warm_up_if_needed()
+
+    # Waits for the generator process to connect, failing if it exits before
+    def accept(self, listener : Listener) -> Connection:
+        connections = []
+
+        thread = Thread(target=lambda: connections.append(listener.accept()), daemon=True)
+        thread.start()
+
+        while thread.is_alive():
+            thread.join(0.5)
+
+            if self.process.poll() is not None:
+                raise RuntimeError(f"Generator process exited with code {self.process.returncode}")
+
+        if len(connections) == 0:
+            raise RuntimeError("Generator process failed to connect")
+
+        return connections[0]
+
+    def stop(self):
+        self.is_stopping = True
+
+        try:
+            self.send("stop")
+        except OSError:
+            pass
+
+        try:
+            self.process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+        self.image_encoder.stop()
+
+    def wait(self):
+        self.process.wait()
+
+    def send(self, *message):
+        with self.lock:
+            if self.connection is None:
+                raise OSError("Generator process is not connected")
+
+            self.connection.send(message)
+
+    # Calls the generator process and waits for the result, calls are made only outside of the event loop
+    def call(self, name : str, *args, timeout : float = CALL_TIMEOUT):
+        with self.condition:
+            id = next(self.calls)
+            connection = self.connection
+            deadline = monotonic() + timeout
+
+            try:
+                self.send("call", id, name, args)
+            except OSError:
+                raise RuntimeError("Generator process is not running")
+
+            self.waiting.add(id)
+
+            try:
+                while id not in self.results:
+                    # Calls are lost with an exited generator process
+                    if self.connection is not connection or self.daemon.is_alive() == False:
+                        raise RuntimeError("Generator process is not running")
+
+                    if monotonic() >= deadline:
+                        raise TimeoutError(f"Generator process did not respond to '{name}'")
+
+                    self.condition.wait(1)
+            finally:
+                self.waiting.discard(id)
+
+            is_successful, value = self.results.pop(id)
+
+        if is_successful == False:
+            raise RuntimeError(value)
+
+        return value
+
+    def add_task(
+        self,
+        task : ImageGeneratorTask
+    ):
+        with self.condition:
+            self.active_tasks[task.id] = task
+
+        self.send_task(task)
+
+    # Tasks are sent without waiting for the generator process, failures are reported as progress
+    def send_task(self, task : ImageGeneratorTask):
+        try:
+            # Callbacks stay in this process
+            self.send("add_task", replace(task, callback=None), self.models.snapshot().to_dict())
+        except OSError:
+            # Active tasks are sent again once the generator process is restarted
+            pass
+
+    def remove_model(self, model : str):
+        if self.daemon is not None:
+            try:
+                self.send("remove_model", model)
+            except OSError:
+                pass
+
+    def handle_models_update(self, callback):
+        if callback is not None:
+            callback()
+
+        if self.daemon is not None:
+            self.warm_up_if_needed()
+
+    # Warms up the last used or default preview model once it is downloaded
+    def warm_up_if_needed(self):
+        if self.warm_up_enabled == False or self.is_warm_up_requested == True:
+            return
+
+        model = self.models.warm_up_model
+
+        if model is None:
+            return
+
+        self.is_warm_up_requested = True
+
+        try:
+            self.send("warm_up", model.path, self.models.snapshot().to_dict())
+        except OSError:
+            self.is_warm_up_requested = False
+
+    def notify_warmed_up(self, info : dict):
+        # Failed warm-ups are retried on the next models update
+        if info["is_successful"] == False:
+            self.is_warm_up_requested = False
+
+        if self.warm_up_callback is not None:
+            self.warm_up_callback(info)
+
+    # Cancels outputs both in the queue and in the running batch, returns identifiers of cancelled outputs
+    def cancel_outputs(self, ids : set[UUID] | None = None) -> list[UUID]:
+        cancelled = self.call("cancel_outputs", ids)
+
+        with self.condition:
+            for task in list(self.active_tasks.values()):
+                for output in task.outputs:
+                    if output.id in cancelled:
+                        output.is_cancelled = True
+
+                if task.is_cancelled == True:
+                    del self.active_tasks[task.id]
+
+        return cancelled
+
+    def receive_messages(self):
+        while True:
+            try:
+                message = self.connection.recv()
+            except (EOFError, OSError):
+                # Waiting calls fail once the connection is replaced
+                with self.condition:
+                    self.connection = None
+                    self.condition.notify_all()
+
+                if self.is_stopping == True:
+                    break
+
+                print("[GEN] Generator process has disconnected")
+                self.restart()
+
+                if self.connection is None:
+                    break
+
+                continue
+
+            try:
+                self.handle_message(*message)
+            except Exception as e:
+                print(f"[GEN] Failed to handle generator message '{message[0]}': {e}")
+
+        with self.condition:
+            self.condition.notify_all()
+
+    def handle_message(self, name : str, *args):
+        if name == "result":
+            id, is_successful, value = args
+
+            with self.condition:
+                # Results of calls which timed out are dropped
+                if id in self.waiting:
+                    self.results[id] = (is_successful, value)
+                    self.condition.notify_all()
+
+        elif name == "stats":
+            self.state = args[0]
+
+        elif name == "progress":
+            self.handle_progress(*args)
+
+        elif name == "frame":
+            self.handle_frame(*args)
+
+        elif name == "discard":
+            self.preview_encoder.discard(args[0])
+
+        elif name == "warmed_up":
+            self.notify_warmed_up(args[0])
+
+        elif name == "component_hashes":
+            self.models.update_component_hashes(*args)
+
+    def handle_progress(self, id : UUID, output_ids : list[UUID], progress : float, seed : int, error : str | None = None):
+        with self.condition:
+            task = self.active_tasks.get(id)
+
+            if task is None:
+                return
+
+            # Outputs cancelled while queued are removed from the task in the generator process
+            outputs = { output.id : output for output in task.outputs }
+            task.outputs = [outputs[output_id] for output_id in output_ids if output_id in outputs]
+
+            if progress >= 1.0:
+                del self.active_tasks[id]
+
+        # Final images are written before, tasks are completed once they are in place
+        if error is not None:
+            task.callback(task, progress, seed, error=error)
+        elif progress >= 1.0:
+            self.image_encoder.after_written(
+                [output.url for output in task.outputs],
+                lambda: task.callback(task, progress, seed),
+                lambda error: task.callback(task, progress, seed, error=error)
+            )
+        else:
+            task.callback(task, progress, seed)
+
+    def handle_frame(self, url : str, frame : SharedFrame, is_final : bool, output : dict):
+        try:
+            image = read_shared_frame(frame)
+        finally:
+            self.send("release", frame.name)
+
+        if is_final == True:
+            self.image_encoder.write(url, image, ImageGeneratorTaskOutputSettings.from_dict(output))
+        else:
+            self.preview_encoder.submit(url, image, ImageGeneratorTaskOutputSettings.from_dict(output))
@@ -0,0 +1,33 @@
+from diffusers import DPMSolverMultistepScheduler, DDIMScheduler, LMSDiscreteScheduler, DEISMultistepScheduler, HeunDiscreteScheduler, DPMSolverSinglestepScheduler
+
+# Sampling methods available in the settings mapped to their schedulers
+SCHEDULERS = {
+    "dpm" : DPMSolverMultistepScheduler,
+    "ddim" : DDIMScheduler,
+    "k-lms" : LMSDiscreteScheduler,
+    "heun" : HeunDiscreteScheduler,
+    "dpm-ss" : DPMSolverSinglestepScheduler,
+    "deis-ms" : DEISMultistepScheduler,
+}
+
+class SchedulerSet:
+    """Keeps one scheduler per sampling method for a loaded pipeline.
+    Schedulers are built lazily from the base scheduler config the pipeline was loaded with,
+    so changing the method never touches the model weights.
+    """
+
+    def __init__(self, base_scheduler):
+        self.base_scheduler = base_scheduler
+        self.schedulers = {}
+
+    def get(self, method : str):
+        scheduler_class = SCHEDULERS.get(method)
+
+        # Unknown methods are using the scheduler shipped with the model
+        if scheduler_class is None:
+            return self.base_scheduler
+
+        if method not in self.schedulers:
+            self.schedulers[method] = scheduler_class.from_config(self.base_scheduler.config)
+
+        return self.schedulers[method]
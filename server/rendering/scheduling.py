@@ -0,0 +1,160 @@
+from dataclasses import dataclass, field
+from itertools import count
+from threading import Condition
+from time import monotonic
+from typing import Callable, Hashable
+from lib.metrics import metrics
+from .tasks import ImageGeneratorTask, ImageGeneratorTaskPriority
+
+QUEUE_WAIT = metrics.histogram("varnava_queue_wait_seconds", "Time tasks spend in the queue until a worker takes them", labels=("type",))
+
+@dataclass
+class ScheduledTask:
+    task : ImageGeneratorTask
+
+    # Identity of the pipeline needed to run the task
+    key : Hashable
+
+    sequence : int = 0
+    enqueued_at : float = field(default_factory=monotonic)
+
+class TaskScheduler:
+    """Orders pending tasks by priority class while grouping them by pipeline identity.
+    Tasks get promoted by one priority class for every `aging_interval` seconds spent in the queue,
+    so lower classes never starve. Among the tasks within `affinity_window` classes of the most urgent one,
+    tasks using an already loaded pipeline are preferred to avoid reloading models.
+    """
+
+    def __init__(self, aging_interval : float = 20.0, affinity_window : float = 0.5):
+        self.aging_interval = aging_interval
+        self.affinity_window = affinity_window
+
+        self.entries : list[ScheduledTask] = []
+        self.sequence = count()
+        self.condition = Condition()
+
+        # Statistics
+        self.scheduled = 0
+        self.reordered = 0
+        self.reloads_avoided = 0
+
+    def __len__(self):
+        with self.condition:
+            return len(self.entries)
+
+    @property
+    def policy(self) -> dict:
+        return {
+            "priorities" : [priority.value for priority in ImageGeneratorTaskPriority],
+            "aging_interval" : self.aging_interval,
+            "affinity_window" : self.affinity_window,
+        }
+
+    @property
+    def stats(self) -> dict:
+        with self.condition:
+            return {
+                "pending" : len(self.entries),
+                "scheduled" : self.scheduled,
+                "reordered" : self.reordered,
+                "reloads_avoided" : self.reloads_avoided,
+            }
+
+    def put(self, task : ImageGeneratorTask, key : Hashable):
+        with self.condition:
+            self.entries.append(ScheduledTask(task=task, key=key, sequence=next(self.sequence)))
+            self.condition.notify()
+
+    # Time the task waited for, recorded when a worker takes it
+    def record_wait(self, entry : ScheduledTask, now : float):
+        wait = now - entry.enqueued_at
+
+        entry.task.add_timing("queue", wait)
+        QUEUE_WAIT.observe(wait, type=entry.task.settings.type.value)
+
+    def effective_priority(self, entry : ScheduledTask, now : float) -> float:
+        return entry.task.priority.rank - (now - entry.enqueued_at) / self.aging_interval
+
+    def ordered_entries(self) -> list[ScheduledTask]:
+        now = monotonic()
+        return sorted(self.entries, key=lambda entry: (self.effective_priority(entry, now), entry.sequence))
+
+    # Takes the next task to run, preferring tasks which pipelines are already loaded by the caller
+    # and avoiding tasks which pipelines are loaded by other workers (`busy_keys`),
+    # waiting for a task stops once `is_interrupted` is true after the condition is notified
+    def take(
+        self,
+        loaded_keys : list[Hashable] = (),
+        busy_keys : list[Hashable] = (),
+        block : bool = True,
+        is_interrupted : Callable[[], bool] | None = None
+    ) -> ImageGeneratorTask | None:
+        with self.condition:
+            while len(self.entries) == 0:
+                if block == False or (is_interrupted is not None and is_interrupted() == True):
+                    return None
+
+                self.condition.wait()
+
+            now = monotonic()
+            ordered = self.ordered_entries()
+            head = ordered[0]
+
+            chosen = head
+
+            if head.key not in loaded_keys:
+                limit = self.effective_priority(head, now) + self.affinity_window
+                candidates = [entry for entry in ordered if self.effective_priority(entry, now) <= limit]
+
+                loaded = [entry for entry in candidates if entry.key in loaded_keys]
+                free = [entry for entry in candidates if entry.key not in busy_keys]
+
+                if len(loaded) > 0:
+                    chosen = loaded[0]
+                    self.reloads_avoided += 1
+                elif head.key in busy_keys and len(free) > 0:
+                    chosen = free[0]
+                    self.reloads_avoided += 1
+
+            if chosen is not min(self.entries, key=lambda entry: entry.sequence):
+                self.reordered += 1
+
+            self.scheduled += 1
+            self.entries.remove(chosen)
+            self.record_wait(chosen, now)
+
+            return chosen.task
+
+    # Takes all pending tasks accepted by the predicate, most urgent first
+    def take_matching(self, predicate : Callable[[ImageGeneratorTask], bool]) -> list[ImageGeneratorTask]:
+        with self.condition:
+            taken = [entry for entry in self.ordered_entries() if predicate(entry.task)]
+
+            now = monotonic()
+
+            for entry in taken:
+                self.entries.remove(entry)
+                self.record_wait(entry, now)
+
+            self.scheduled += len(taken)
+
+            return [entry.task for entry in taken]
+
+    # Removes all pending tasks accepted by the predicate
+    def remove(self, predicate : Callable[[ImageGeneratorTask], bool]) -> list[ImageGeneratorTask]:
+        with self.condition:
+            removed = [entry for entry in self.entries if predicate(entry.task)]
+
+            for entry in removed:
+                self.entries.remove(entry)
+
+            return [entry.task for entry in removed]
+
+    # Wakes up callers waiting for tasks, so they can check their interruption
+    def interrupt(self):
+        with self.condition:
+            self.condition.notify_all()
+
+    def pending(self) -> list[ImageGeneratorTask]:
+        with self.condition:
+            return [entry.task for entry in self.ordered_entries()]
@@ -0,0 +1,22 @@
+import torch
+
+# Components of a pipeline which convolutions are made seamless
+SEAMLESS_COMPONENTS = ["unet", "vae"]
+
+def set_seamless(pipe, is_enabled : bool):
+    """Toggles seamless tiling of an already loaded pipeline.
+    Convolutions pad their inputs circularly so opposite edges of an image match,
+    only modules of the pipeline are affected.
+    """
+
+    padding_mode = "circular" if is_enabled == True else "zeros"
+
+    for name in SEAMLESS_COMPONENTS:
+        component = getattr(pipe, name, None)
+
+        if not isinstance(component, torch.nn.Module):
+            continue
+
+        for module in component.modules():
+            if isinstance(module, torch.nn.Conv2d):
+                module.padding_mode = padding_mode
@@ -0,0 +1,193 @@
+from dataclasses import dataclass, field
+from typing import Callable, Any
+from uuid import UUID, uuid4
+from enum import Enum, unique
+from mashumaro import DataClassDictMixin
+
+@unique
+class ImageGeneratorTaskType(str, Enum):
+    preview = "preview"
+    upscale = "upscale"
+    variation = "variation"
+
+@unique
+class ImageGeneratorImageFormat(str, Enum):
+    jpeg = "jpeg"
+    webp = "webp"
+    png = "png"
+
+    # Extension of files of images in the format
+    @property
+    def extension(self) -> str:
+        return ".jpg" if self == ImageGeneratorImageFormat.jpeg else f".{self.value}"
+
+@unique
+class ImageGeneratorTaskPriority(str, Enum):
+    interactive = "interactive"
+    variation = "variation"
+    upscale = "upscale"
+    bulk = "bulk"
+
+    # Lower rank is scheduled first
+    @property
+    def rank(self) -> int:
+        return list(ImageGeneratorTaskPriority).index(self)
+
+    @classmethod
+    def for_type(cls, type : ImageGeneratorTaskType) -> "ImageGeneratorTaskPriority":
+        if type == ImageGeneratorTaskType.upscale:
+            return cls.upscale
+        elif type == ImageGeneratorTaskType.variation:
+            return cls.variation
+        else:
+            return cls.interactive
+
+@dataclass 
+class ImageGeneratorTaskUpscaleSettings(DataClassDictMixin):
+    dimension : int = 1024
+
+@dataclass
+class ImageGeneratorTaskVariationSettings(DataClassDictMixin):
+    # Part of denoising steps run from the noised initial image, lower values keep more of it
+    strength : float = 0.5
+
+@dataclass
+class ImageGeneratorTaskOutputSettings(DataClassDictMixin):
+    # Format of final images, PNG is lossless (e.g. for textures)
+    format : ImageGeneratorImageFormat = ImageGeneratorImageFormat("jpeg")
+
+    # Quality of lossy formats
+    quality : int = 90
+
+@dataclass
+class ImageGeneratorTaskSettings(DataClassDictMixin):
+    model : str = ""
+    seed : int = -1
+    dimensions : float = 1.0
+    batch : int = 2
+    method : str = "dpm"
+    strength : float = 0.6
+    steps : int = 30
+    seamless : int = 0
+    type : ImageGeneratorTaskType = ImageGeneratorTaskType("preview")
+    initial_url : str | None = None
+
+    # Settings for upscaling
+    upscale : ImageGeneratorTaskUpscaleSettings = ImageGeneratorTaskUpscaleSettings()
+
+    # Settings for variations
+    variation : ImageGeneratorTaskVariationSettings = ImageGeneratorTaskVariationSettings()
+
+    # Settings for encoding final images
+    output : ImageGeneratorTaskOutputSettings = ImageGeneratorTaskOutputSettings()
+
+    def is_structurally_equal(self, other : Any) -> bool:
+        if not isinstance(other, ImageGeneratorTaskSettings):
+            return False
+        
+        return self.model == other.model and self.type.value == other.type.value
+
+    # Whether images for both settings can be denoised together in a single pipeline call
+    def is_batch_compatible(self, other : Any) -> bool:
+        if not isinstance(other, ImageGeneratorTaskSettings):
+            return False
+
+        if self.type != other.type or self.type not in [ImageGeneratorTaskType.preview, ImageGeneratorTaskType.variation]:
+            return False
+
+        # Variations are denoised together only from the same initial image
+        if self.type == ImageGeneratorTaskType.variation and (self.initial_url != other.initial_url or self.variation.strength != other.variation.strength):
+            return False
+
+        return (self.is_structurally_equal(other) 
+                and self.dimensions == other.dimensions 
+                and self.steps == other.steps 
+                and self.method == other.method 
+                and self.strength == other.strength 
+                and self.seamless == other.seamless)
+
+class ImageGeneratorTaskCancelled(Exception):
+    pass
+
+@dataclass
+class ImageGeneratorOutput:
+    id : UUID
+    url : str
+    is_cancelled : bool = False
+
+    # Output is generated with the task seed + the offset, which stays the same once other outputs are dropped from the task
+    seed_offset : int = 0
+
+@dataclass
+class ImageGeneratorTask:
+    prompt : str
+    outputs : list[ImageGeneratorOutput]
+    settings : ImageGeneratorTaskSettings = ImageGeneratorTaskSettings()
+    # Called with the task, its progress and seed, failed tasks are completed with an error
+    callback : Callable = lambda *args, **kwargs: None
+
+    # Scheduling class, derived from the task type if not specified
+    priority : ImageGeneratorTaskPriority | None = None
+
+    id : UUID = field(default_factory=uuid4)
+
+    # Seconds spent in every phase of generation (queue, model, denoising, preview_decode, encode, callback)
+    timings : dict[str, float] = field(default_factory=dict)
+
+    def __post_init__(self):
+        if self.priority is None:
+            self.priority = ImageGeneratorTaskPriority.for_type(self.settings.type)
+
+        # Outputs of new tasks are numbered by their positions, outputs of restored tasks keep their offsets
+        if len(self.outputs) > 1 and all(output.seed_offset == 0 for output in self.outputs):
+            for index, output in enumerate(self.outputs):
+                output.seed_offset = index
+
+    def add_timing(self, phase : str, duration : float):
+        self.timings[phase] = self.timings.get(phase, 0.0) + duration
+
+    @property
+    def is_cancelled(self) -> bool:
+        return all(output.is_cancelled for output in self.outputs)
+
+@dataclass
+class ImageGeneratorBatch:
+    """Tasks denoised together in a single pipeline call, one image per output."""
+
+    tasks : list[ImageGeneratorTask] = field(default_factory=list)
+
+    @property
+    def settings(self) -> ImageGeneratorTaskSettings:
+        return self.tasks[0].settings
+
+    @property
+    def size(self) -> int:
+        return sum(len(task.outputs) for task in self.tasks)
+
+    # Returns tasks with the range of images in the batch that belong to them
+    @property
+    def slices(self) -> list[tuple[ImageGeneratorTask, int, int]]:
+        slices = []
+        start = 0
+
+        for task in self.tasks:
+            slices.append((task, start, start + len(task.outputs)))
+            start += len(task.outputs)
+
+        return slices
+
+    @property
+    def is_cancelled(self) -> bool:
+        return all(task.is_cancelled for task in self.tasks)
+
+    def can_add(self, task : ImageGeneratorTask, max_size : int) -> bool:
+        if len(self.tasks) == 0:
+            return True
+
+        if self.size + len(task.outputs) > max_size:
+            return False
+
+        return self.settings.is_batch_compatible(task.settings)
+
+    def add(self, task : ImageGeneratorTask):
+        self.tasks.append(task)
@@ -0,0 +1,84 @@
+import numpy as np
+from PIL import Image
+
+def tile_positions(length : int, tile_size : int, overlap : int) -> list[int]:
+    """Offsets of tiles covering the length, spread evenly so neighbours overlap by at least `overlap`."""
+
+    if length <= tile_size:
+        return [0]
+
+    stride = tile_size - overlap
+    count = -(-(length - overlap) // stride)
+
+    return [round(index * (length - tile_size) / (count - 1)) for index in range(count)]
+
+class ImageTiles:
+    """Overlapping tiles of an image, all of the same size unless the image is smaller than a tile."""
+
+    def __init__(self, image : Image.Image, tile_size : int, overlap : int):
+        self.image = image
+
+        tile_width = min(tile_size, image.width)
+        tile_height = min(tile_size, image.height)
+
+        self.tile_size = (tile_width, tile_height)
+
+        self.boxes = [
+            (x, y, x + tile_width, y + tile_height)
+            for y in tile_positions(image.height, tile_height, overlap)
+            for x in tile_positions(image.width, tile_width, overlap)
+        ]
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def crop(self, boxes : list[tuple[int, int, int, int]]) -> list[Image.Image]:
+        return [self.image.crop(box) for box in boxes]
+
+class TileBlender:
+    """Assembles scaled tiles into a single image.
+    Tiles are weighted with ramps across their inner edges, so seams between overlapping tiles are feathered.
+    """
+
+    def __init__(self, width : int, height : int, scale : int, feather : int):
+        self.width = width * scale
+        self.height = height * scale
+        self.scale = scale
+        self.feather = feather * scale
+
+        self.canvas = np.zeros((self.height, self.width, 3), dtype=np.float32)
+        self.weights = np.zeros((self.height, self.width, 1), dtype=np.float32)
+
+    def ramp(self, length : int, is_start_inner : bool, is_end_inner : bool) -> np.ndarray:
+        ramp = np.ones(length, dtype=np.float32)
+        feather = min(self.feather, length // 2)
+
+        if feather > 0:
+            edge = np.arange(1, feather + 1, dtype=np.float32) / (feather + 1)
+
+            if is_start_inner == True:
+                ramp[:feather] = edge
+
+            if is_end_inner == True:
+                ramp[-feather:] = edge[::-1]
+
+        return ramp
+
+    # Adds a scaled tile of the box in source image coordinates
+    def add(self, image : Image.Image, box : tuple[int, int, int, int]):
+        x0, y0, x1, y1 = [value * self.scale for value in box]
+
+        if image.size != (x1 - x0, y1 - y0):
+            image = image.resize((x1 - x0, y1 - y0))
+
+        horizontal = self.ramp(x1 - x0, x0 > 0, x1 < self.width)
+        vertical = self.ramp(y1 - y0, y0 > 0, y1 < self.height)
+        mask = (vertical[:, None] * horizontal[None, :])[:, :, None]
+
+        self.canvas[y0:y1, x0:x1] += np.asarray(image.convert("RGB"), dtype=np.float32) * mask
+        self.weights[y0:y1, x0:x1] += mask
+
+    # Blended image, areas without tiles yet are black
+    def image(self) -> Image.Image:
+        pixels = self.canvas / np.maximum(self.weights, 1e-6)
+        return Image.fromarray(pixels.clip(0, 255).round().astype(np.uint8))
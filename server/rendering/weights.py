@@ -0,0 +1,174 @@
+import os
+import json
+import hashlib
+import importlib.util
+from uuid import uuid4
+
+# Components of different models loaded once when their weights are identical, fine-tuned models
+# mostly change only the UNet and keep the text encoder and the VAE of their base model
+SHARED_COMPONENTS = ["text_encoder", "vae"]
+
+# Configuration values which differ between copies of the same component
+IGNORED_CONFIG_KEYS = ["_name_or_path", "_diffusers_version", "transformers_version"]
+
+# Size of chunks weights are read by while hashing (in bytes)
+HASH_CHUNK_SIZE = 16 * 1024 * 1024
+
+# Whether weights can be loaded from safetensors files, checked without importing the package
+def is_safetensors_available() -> bool:
+    return importlib.util.find_spec("safetensors") is not None
+
+# Name of the safetensors file holding the same weights as a pickle file, none for sharded or unknown files
+def safetensors_name_for(name : str) -> str | None:
+    directory, filename = os.path.split(name)
+
+    if filename.endswith(".bin") == False or "-of-" in filename:
+        return None
+
+    stem = filename[:-len(".bin")]
+
+    # Diffusers and transformers name their weights differently, variants (e.g. ".fp16") are kept
+    if stem.startswith("diffusion_pytorch_model"):
+        converted = stem + ".safetensors"
+    elif stem.startswith("pytorch_model"):
+        converted = "model" + stem[len("pytorch_model"):] + ".safetensors"
+    else:
+        return None
+
+    return os.path.join(directory, converted) if directory != "" else converted
+
+# Whether weights of every component of a repository are available as safetensors files
+def is_safetensors_complete(filenames : list[str]) -> bool:
+    names = set(filenames)
+    pickles = [name for name in filenames if name.endswith(".bin") and "/" in name]
+
+    if any(name.endswith(".safetensors") and "/" in name for name in filenames) == False:
+        return False
+
+    return all(safetensors_name_for(name) in names for name in pickles)
+
+# Converts pickle weights of components in a local model folder to safetensors files next to them, once,
+# returns paths of converted files (workers converting the same model at once write the same files)
+def convert_to_safetensors(url_for_model : str) -> list[str]:
+    import torch
+    from safetensors.torch import save_file
+
+    converted = []
+
+    for root, directories, filenames in os.walk(url_for_model):
+        for filename in filenames:
+            name = safetensors_name_for(filename)
+
+            if name is None or os.path.exists(os.path.join(root, name)):
+                continue
+
+            url = os.path.join(root, filename)
+            converted_url = os.path.join(root, name)
+            temporary_url = f"{converted_url}.{uuid4().hex}.tmp"
+
+            print(f"[GEN] Converting '{url}' to safetensors")
+
+            state_dict = torch.load(url, map_location="cpu")
+
+            # Tensors sharing memory cannot be stored separately
+            pointers = set()
+
+            for key, tensor in state_dict.items():
+                pointer = tensor.untyped_storage().data_ptr() if hasattr(tensor, "untyped_storage") else tensor.storage().data_ptr()
+
+                if pointer in pointers:
+                    state_dict[key] = tensor.clone()
+
+                pointers.add(pointer)
+
+            try:
+                save_file({ key : tensor.contiguous() for key, tensor in state_dict.items() }, temporary_url, metadata={"format" : "pt"})
+                os.replace(temporary_url, converted_url)
+            finally:
+                if os.path.exists(temporary_url):
+                    os.remove(temporary_url)
+
+            del state_dict
+
+            converted.append(converted_url)
+
+    return converted
+
+# Adds names, types, shapes and data of tensors of a safetensors file to the digest in the order of their names,
+# so weights converted locally match the same weights shipped as safetensors whatever the layout of their files
+def update_tensors_digest(digest, url : str):
+    with open(url, "rb") as file:
+        length = int.from_bytes(file.read(8), "little")
+        header = json.loads(file.read(length))
+        offset = 8 + length
+
+        for name in sorted(key for key in header if key != "__metadata__"):
+            tensor = header[name]
+            begin, end = tensor["data_offsets"]
+
+            digest.update(json.dumps([name, tensor["dtype"], tensor["shape"]]).encode("utf-8"))
+
+            file.seek(offset + begin)
+            remaining = end - begin
+
+            while remaining > 0:
+                chunk = file.read(min(HASH_CHUNK_SIZE, remaining))
+
+                if len(chunk) == 0:
+                    break
+
+                digest.update(chunk)
+                remaining -= len(chunk)
+
+# Hash of configuration and weights of a component in a local model folder, none if it has no weights,
+# safetensors weights are hashed if present as they are the ones loaded
+def component_hash(url_for_component : str) -> str | None:
+    filenames = sorted(os.listdir(url_for_component))
+    weights = [name for name in filenames if name.endswith(".safetensors")] or [name for name in filenames if name.endswith(".bin")]
+
+    if len(weights) == 0:
+        return None
+
+    digest = hashlib.sha256()
+
+    for filename in [name for name in filenames if name.endswith(".json")]:
+        with open(os.path.join(url_for_component, filename)) as file:
+            config = { key : value for key, value in json.load(file).items() if key not in IGNORED_CONFIG_KEYS }
+
+        digest.update(filename.encode("utf-8"))
+        digest.update(json.dumps(config, sort_keys=True).encode("utf-8"))
+
+    for filename in weights:
+        if filename.endswith(".safetensors"):
+            update_tensors_digest(digest, os.path.join(url_for_component, filename))
+            continue
+
+        digest.update(filename.encode("utf-8"))
+
+        with open(os.path.join(url_for_component, filename), "rb") as file:
+            while True:
+                chunk = file.read(HASH_CHUNK_SIZE)
+
+                if len(chunk) == 0:
+                    break
+
+                digest.update(chunk)
+
+    return digest.hexdigest()
+
+# Hashes of shared components of a local model folder
+def component_hashes(url_for_model : str) -> dict[str, str]:
+    hashes = {}
+
+    for name in SHARED_COMPONENTS:
+        url_for_component = os.path.join(url_for_model, name)
+
+        if os.path.isdir(url_for_component) == False:
+            continue
+
+        hash = component_hash(url_for_component)
+
+        if hash is not None:
+            hashes[name] = hash
+
+    return hashes
@@ -0,0 +1,995 @@
+import os
+import torch
+import gc
+import random
+from dataclasses import replace
+from threading import Thread
+from time import sleep, monotonic
+from diffusers import StableDiffusionUpscalePipeline, StableDiffusionPipeline, StableDiffusionImg2ImgPipeline
+from PIL import Image
+from lib.metrics import metrics
+from .approximation import LatentDecoder
+from .cache import PipelineCache, PipelineKey, CachedPipeline
+from .samplers import SchedulerSet
+from .seamless import set_seamless
+from .tasks import ImageGeneratorTaskType, ImageGeneratorTaskSettings, ImageGeneratorTask, ImageGeneratorTaskCancelled, ImageGeneratorBatch
+from .previews import PreviewCadence
+from .tiling import ImageTiles, TileBlender
+from .planning import ExecutionPlan, ExecutionPlanner, ExecutionShape
+from .embeddings import PromptEmbeddingKey, PromptEmbedding
+from .weights import is_safetensors_available, convert_to_safetensors, component_hashes
+from .optimization import CompiledShape, PipelineOptimization, fused_attention_processor
+
+MODEL_REQUESTS = metrics.counter("varnava_model_requests_total", "Models needed by batches, reused when already loaded", labels=("type", "result"))
+MODEL_LOAD = metrics.histogram("varnava_model_load_seconds", "Time of loading models to devices", labels=("type",))
+DENOISING_STEP = metrics.histogram("varnava_denoising_step_seconds", "Time between denoising steps of batches", labels=("type",))
+PREVIEW_DECODE = metrics.histogram("varnava_preview_decode_seconds", "Time of decoding preview frames of batches from latents", labels=("decoder",))
+TASK_PHASES = metrics.histogram("varnava_task_phase_seconds", "Time spent by tasks in every phase of generation", labels=("type", "phase"))
+TASKS = metrics.counter("varnava_tasks_total", "Finished tasks by their result", labels=("type", "result"))
+IMAGES = metrics.counter("varnava_images_total", "Generated images", labels=("type",))
+
+# Total memory available to a device (in GB)
+def device_memory_amount(device : torch.device) -> float:
+    if device.type == "cuda":
+        return torch.cuda.get_device_properties(device.index or 0).total_memory / 1024 / 1024 / 1024
+    elif device.type == "cpu":
+        try:
+            return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 1024 / 1024 / 1024
+        except (AttributeError, ValueError, OSError):
+            return 16
+    else:
+        return 16
+
+# Memory available for new allocations at a device (in bytes), including memory cached by the allocator
+def device_available_memory(device : torch.device, budget : int) -> int:
+    if device.type == "cuda":
+        free, total = torch.cuda.mem_get_info(device)
+        return free + torch.cuda.memory_reserved(device) - torch.cuda.memory_allocated(device)
+    elif device.type == "cpu":
+        try:
+            return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_AVPHYS_PAGES")
+        except (AttributeError, ValueError, OSError):
+            return budget // 2
+    else:
+        return budget
+
+# Scale of images produced by the upscaling model
+UPSCALE_FACTOR = 4
+
+# Size of the source image for upscaling to the dimension of the longer side,
+# sides shorter than a tile are processed as a whole and must be multiples of 64 as required by the pipeline
+def upscaled_source_size(size : tuple[int, int], dimension : int, tile_size : int) -> tuple[int, int]:
+    width, height = size
+    scale = dimension / UPSCALE_FACTOR / max(width, height)
+
+    def fit(length : float) -> int:
+        if length >= tile_size:
+            return round(length)
+
+        return max(round(length / 64), 1) * 64
+
+    return fit(width * scale), fit(height * scale)
+
+class ImageGeneratorWorker:
+    """Generates batches of tasks on a single device with its own loaded pipelines.
+    Workers pull batches from the shared generator queue whenever they are idle,
+    preferring tasks for models they already have loaded.
+    """
+
+    def __init__(
+        self,
+        generator : "ImageGenerator",
+        device : str,
+        index : int = 0,
+        pipelines_memory_budget : float | None = None,
+        pipelines_spill_to_host : bool | None = None,
+        pipelines_host_memory_budget : float = 8,
+        max_batch_size : int | None = None,
+        max_batch_pixels : int | None = None,
+    ):
+        self.generator = generator
+        self.index = index
+
+        self.device = torch.device(device)
+        self.device_name = device
+
+        # Max memory available (in GB)
+        self.total_vram_amount = device_memory_amount(self.device)
+
+        self.dtype = torch.float16 if self.device.type == "cuda" else torch.float32
+
+        # Last task to compare
+        self.last_task : ImageGeneratorTask | None = None
+
+        # Batch being generated right now
+        self.running : ImageGeneratorBatch | None = None
+
+        # Our processing daemon
+        self.daemon : Thread | None = None
+
+        # No processing pipe in the beginning
+        self.pipe : StableDiffusionPipeline | StableDiffusionUpscalePipeline | None = None
+
+        # Loaded pipelines (budgets are in GB), spilling to host memory makes sense only for discrete GPUs
+        if pipelines_memory_budget is None:
+            pipelines_memory_budget = self.total_vram_amount * 0.75
+
+        if pipelines_spill_to_host is None:
+            pipelines_spill_to_host = self.device.type == "cuda"
+
+        self.pipelines = PipelineCache(
+            device=self.device_name,
+            memory_budget=int(pipelines_memory_budget * 1024 * 1024 * 1024),
+            spill_to_host=pipelines_spill_to_host,
+            host_memory_budget=int(pipelines_host_memory_budget * 1024 * 1024 * 1024)
+        )
+
+        # Limits for batching compatible tasks into a single pipeline call (number of images and their total pixels)
+        base_dimension = self.generator.base_dimension
+
+        if max_batch_size is None:
+            max_batch_size = 8 if self.device.type == "cuda" else 4
+
+        if max_batch_pixels is None:
+            max_batch_pixels = int(max(self.total_vram_amount / 24, 0.25) * 8 * base_dimension * base_dimension)
+
+        self.max_batch_size = max_batch_size
+        self.max_batch_pixels = max_batch_pixels
+
+        # Approximate image decoder of the current pipeline
+        self.approximate_image_decoder : LatentDecoder | None = None
+
+        # Loaded pipeline of the current batch
+        self.cached : CachedPipeline | None = None
+
+        # Settings of a warm-up generation requested while the worker is idle
+        self.warm_up_settings : ImageGeneratorTaskSettings | None = None
+
+        # Memory saving options are chosen per batch from estimated and recorded memory peaks
+        self.planner = ExecutionPlanner(is_offload_supported=self.device.type == "cuda")
+
+        # Image sizes of optimized pipelines waiting to be compiled while the worker is idle
+        self.compile_requests : list[tuple[CachedPipeline, CompiledShape]] = []
+
+        print(f"[GEN] Worker {self.index} is ready at '{self.device_name}' with {self.total_vram_amount:.1f}GB memory available.")
+
+    @property
+    def loaded_keys(self) -> list:
+        return [key.identity for key in list(self.pipelines.resident.keys())]
+
+    def start(self):
+        self.daemon = Thread(target=self.execute_tasks, daemon=True, name=f"varnava-image-generator-{self.index}")
+        self.daemon.start()
+
+    @property
+    def total_memory(self) -> int:
+        return int(self.total_vram_amount * 1024 * 1024 * 1024)
+
+    # Memory available for generation, unified memory of other devices is shared with loaded pipelines
+    def available_memory(self) -> int:
+        if self.device.type in ["cuda", "cpu"]:
+            return device_available_memory(self.device, self.total_memory)
+
+        return max(self.pipelines.memory_budget - self.pipelines.resident_size, 0)
+
+    def stop(self):
+        self.pipe = None
+        self.cached = None
+        self.approximate_image_decoder = None
+        self.pipelines.clear()
+
+    # Unloads pipelines of a removed model, the current one is kept by a running batch until it completes
+    def remove_model(self, model : str):
+        self.pipelines.remove(model)
+
+    # Frees memory cached by the allocator only when little of it is left
+    def collect_if_needed(self):
+        if self.planner.is_cleanup_needed(self.available_memory(), self.total_memory):
+            self.collect()
+
+    def collect(self):
+        if self.device.type == "cuda":
+            with torch.cuda.device(self.device):
+                torch.cuda.empty_cache()
+                torch.cuda.ipc_collect()
+
+        gc.collect()
+
+    # Takes the next task together with queued tasks that can be denoised along with it,
+    # returns nothing if waiting is interrupted by a warm-up request or there are sizes to compile
+    def next_batch(self) -> ImageGeneratorBatch | None:
+        tasks = self.generator.tasks
+        batch = ImageGeneratorBatch()
+
+        # Taking tasks and marking them as running at once, so cancellation never misses them
+        with tasks.condition:
+            busy_keys = [key for worker in self.generator.workers if worker is not self for key in worker.loaded_keys]
+
+            task = tasks.take(
+                loaded_keys=self.loaded_keys,
+                busy_keys=busy_keys,
+                is_interrupted=lambda: self.warm_up_settings is not None or len(self.compile_requests) > 0
+            )
+
+            if task is None:
+                return None
+
+            batch.add(task)
+
+            # Variations are batched only from the same initial image with the same strength
+            if batch.settings.type in [ImageGeneratorTaskType.preview, ImageGeneratorTaskType.variation]:
+                width, height = self.generator.dimensions_for_settings(batch.settings)
+                max_size = max(min(self.max_batch_size, self.max_batch_pixels // (width * height)), 1)
+
+                def add_if_possible(task : ImageGeneratorTask) -> bool:
+                    if batch.can_add(task, max_size=max_size) == False:
+                        return False
+
+                    batch.add(task)
+                    return True
+
+                tasks.take_matching(add_if_possible)
+
+            self.running = batch
+
+        return batch
+
+    def execute_tasks(self):
+        preview_encoder = self.generator.preview_encoder
+
+        while True:
+            sleep(0.5)
+
+            if self.warm_up_settings is not None:
+                self.warm_up()
+                continue
+
+            batch = self.next_batch()
+
+            # Sizes are compiled one at a time once there are no tasks, so compiling never runs along with generation
+            if batch is None:
+                if len(self.compile_requests) > 0:
+                    self.compile_shape(*self.compile_requests.pop(0))
+
+                continue
+
+            try:
+                self.execute_batch(batch)
+            except ImageGeneratorTaskCancelled:
+                preview_encoder.discard([output.url for task in batch.tasks for output in task.outputs])
+
+                print(f"[GEN] Cancelled generating {batch.size} outputs")
+
+                for task in batch.tasks:
+                    self.record_task(task, "cancelled")
+
+                self.collect_if_needed()
+            except Exception as e:
+                # Failed tasks are dropped and the worker keeps generating the following ones
+                preview_encoder.discard([output.url for task in batch.tasks for output in task.outputs])
+
+                print(f"[GEN] Failed generating {batch.size} outputs at '{self.device_name}': {e}")
+
+                for task in batch.tasks:
+                    self.fail_task(task, str(e))
+
+                self.collect_if_needed()
+            finally:
+                self.running = None
+
+    # Loads the model and runs a tiny generation, so kernels are selected and memory is allocated before the first task
+    def warm_up(self):
+        settings = self.warm_up_settings
+        self.warm_up_settings = None
+
+        started_at = monotonic()
+
+        try:
+            self.prepare_model_if_needed(settings)
+
+            width, height = self.generator.dimensions_for_settings(settings)
+
+            if isinstance(self.pipe, StableDiffusionPipeline):
+                self.plan_execution(settings, self.execution_shape(settings, width, height, 1))
+
+                self.pipe_for_call(settings, width, height, 1)(
+                    prompt="",
+                    width=width,
+                    height=height,
+                    num_inference_steps=settings.steps,
+                    guidance_scale=7.5,
+                    num_images_per_prompt=1
+                )
+
+            self.collect_if_needed()
+        except Exception as e:
+            print(f"[GEN] Failed to warm up model '{settings.model}' at '{self.device_name}': {e}")
+            is_successful = False
+        else:
+            print(f"[GEN] Warmed up model '{settings.model}' at '{self.device_name}' in {monotonic() - started_at:.1f}s")
+            is_successful = True
+
+        self.generator.notify_warmed_up({
+            "model" : settings.model,
+            "device" : self.device_name,
+            "is_successful" : is_successful,
+            "duration" : monotonic() - started_at
+        })
+
+    def execute_batch(self, batch : ImageGeneratorBatch):
+        preview_encoder = self.generator.preview_encoder
+
+        if batch.is_cancelled == True:
+            return
+
+        # Initial images can be removed while tasks are queued, such tasks fail without loading models
+        for task in list(batch.tasks):
+            if task.settings.initial_url is not None and os.path.exists(task.settings.initial_url) == False:
+                self.fail_task(task, f"Initial image '{task.settings.initial_url}' is missing")
+                batch.tasks.remove(task)
+
+        if len(batch.tasks) == 0:
+            return
+
+        settings = batch.settings
+        started_at = monotonic()
+
+        self.prepare_model_if_needed(settings)
+
+        for task in batch.tasks:
+            task.add_timing("model", monotonic() - started_at)
+
+        max_steps = settings.steps
+        guidance_scale = settings.strength * 40
+        aspect = settings.dimensions
+
+        # Every image has its own generator so images of different tasks do not affect each other,
+        # every image of a task is generated with the task seed + the seed offset of its output
+        is_seeded = self.device.type in ["cuda", "cpu"]
+
+        seeds = {}
+        generators = []
+
+        for task in batch.tasks:
+            if is_seeded == True:
+                seed = task.settings.seed if task.settings.seed != -1 else random.randrange(2 ** 32)
+            else:
+                seed = 0
+
+            seeds[id(task)] = seed
+
+            for output in task.outputs:
+                generators.append(torch.Generator(device=self.device).manual_seed(seed + output.seed_offset))
+
+        if is_seeded == False:
+            generators = None
+
+        if settings.type == ImageGeneratorTaskType.upscale:
+            max_steps = 75
+
+        width, height = self.generator.dimensions_for_settings(settings)
+
+        print(f"[GEN] Generating {batch.size} outputs for {len(batch.tasks)} tasks {width}x{height} at '{self.device_name}': type={settings.type} steps={max_steps}, scale={guidance_scale}, aspect={aspect}.")
+
+        preview_cadence = PreviewCadence(every_steps=self.generator.preview_every_steps, every_ms=self.generator.preview_every_ms)
+
+        # Part of the overall progress and images of the batch covered by the current pipeline call,
+        # pipeline calls for parts of images (tiles) do not produce previews from latents
+        progress_range = (0.0, 1.0)
+        images_range = (0, batch.size)
+        is_tiled = False
+
+        # Steps are timed from the start of pipeline calls
+        last_step_at = monotonic()
+
+        def handle_callback(step, timestep, latents):
+            nonlocal last_step_at
+
+            now = monotonic()
+            DENOISING_STEP.observe(now - last_step_at, type=settings.type.value)
+            last_step_at = now
+
+            # Aborting denoising when every output of the batch is cancelled
+            if batch.is_cancelled == True:
+                raise ImageGeneratorTaskCancelled()
+
+            # Decoding all latents of the batch at once
+            if self.approximate_image_decoder is not None and is_tiled == False and preview_cadence.is_due(step):
+                previews = self.approximate_image_decoder(latents, max_dimension=self.generator.preview_max_dimension)
+
+                duration = monotonic() - now
+                PREVIEW_DECODE.observe(duration, decoder=self.approximate_image_decoder.name)
+
+                for task in batch.tasks:
+                    task.add_timing("preview_decode", duration)
+            else:
+                previews = []
+
+            # Progress calculation
+            progress = 1.0 - float(timestep.item()) / float(self.pipe.scheduler.config.num_train_timesteps)
+            progress = progress_range[0] + (progress_range[1] - progress_range[0]) * progress
+
+            for task, start, end in batch.slices:
+                # Storing progress images at a particular index
+                # latents = 1 / 0.18215 * latents
+                if task.is_cancelled == True:
+                    continue
+
+                for index in range(max(start, images_range[0]), min(end, images_range[0] + len(previews))):
+                    if task.outputs[index - start].is_cancelled == False:
+                        preview_encoder.submit(task.outputs[index - start].url, previews[index - images_range[0]], task.settings.output)
+
+                # Notifying about callback datas
+                callback_started_at = monotonic()
+                task.callback(task, progress, seeds[id(task)])
+                task.add_timing("callback", monotonic() - callback_started_at)
+
+        # Executing the model itself, denoising includes decoding previews and callbacks of steps
+        images = []
+        denoising_started_at = monotonic()
+
+        if settings.type in [ImageGeneratorTaskType.preview, ImageGeneratorTaskType.variation] and isinstance(self.pipe, StableDiffusionPipeline):
+            prompts = [task.prompt for task, start, end in batch.slices for index in range(start, end)]
+            prompt_embeds, negative_prompt_embeds = self.encode_prompts(prompts)
+
+            # Variations are denoised from the initial image resized to the generated size
+            if settings.type == ImageGeneratorTaskType.variation:
+                source_image = Image.open(settings.initial_url).convert("RGB").resize((width, height))
+
+            shape = self.execution_shape(settings, width, height, batch.size)
+            plan = self.plan_execution(settings, shape)
+
+            # Images are generated by parts if the whole batch does not fit the memory
+            for start in range(0, batch.size, plan.max_images):
+                end = min(start + plan.max_images, batch.size)
+
+                images_range = (start, end)
+                progress_range = (start / batch.size, end / batch.size)
+
+                self.reset_peak_memory()
+                last_step_at = monotonic()
+
+                pipe = self.pipe_for_call(settings, width, height, end - start)
+
+                # Strength of variations skips early denoising steps, so they take a part of the steps of previews
+                if settings.type == ImageGeneratorTaskType.variation:
+                    pipe = self.variation_pipe(pipe)
+                    arguments = { "image" : [source_image] * (end - start), "strength" : settings.variation.strength }
+                else:
+                    arguments = { "width" : width, "height" : height }
+
+                images += pipe(
+                    prompt_embeds=prompt_embeds[start:end],
+                    negative_prompt_embeds=negative_prompt_embeds[start:end],
+                    **arguments,
+                    num_inference_steps=max_steps,
+                    guidance_scale=guidance_scale,
+                    num_images_per_prompt=1,
+                    callback=handle_callback,
+                    callback_steps=1,
+                    generator=generators[start:end] if generators is not None else None
+                ).images
+
+                self.record_peak_memory(shape, plan, end - start)
+
+        elif settings.type == ImageGeneratorTaskType.upscale and isinstance(self.pipe, StableDiffusionUpscalePipeline):
+            task = batch.tasks[0]
+            source_image = Image.open(settings.initial_url).convert("RGB")
+
+            # Source is resized to the requested dimension divided by the model scale keeping its aspect
+            width, height = upscaled_source_size(source_image.size, settings.upscale.dimension, self.generator.upscale_tile_size)
+            source_image = source_image.resize((width, height))
+
+            # Images are upscaled by overlapping tiles, so memory depends on the tile size and not the output size
+            tiles = ImageTiles(source_image, tile_size=self.generator.upscale_tile_size, overlap=self.generator.upscale_tile_overlap)
+            is_tiled = len(tiles) > 1
+
+            total = len(tiles) * len(task.outputs)
+
+            tile_width, tile_height = tiles.tile_size
+            shape = self.execution_shape(settings, tile_width, tile_height, min(len(tiles), self.max_batch_size))
+
+            for index, output in enumerate(task.outputs):
+                blender = TileBlender(width, height, scale=UPSCALE_FACTOR, feather=self.generator.upscale_tile_overlap)
+                done = 0
+
+                # Previews decoded from latents of an untiled image belong to the output being upscaled
+                images_range = (index, index + 1)
+
+                while done < len(tiles):
+                    # Tiles are batched within the memory, planned again as recorded peaks refine estimates
+                    plan = self.plan_execution(settings, shape)
+
+                    boxes = tiles.boxes[done:done + plan.max_images]
+                    progress_range = ((index * len(tiles) + done) / total, (index * len(tiles) + done + len(boxes)) / total)
+
+                    self.reset_peak_memory()
+                    last_step_at = monotonic()
+
+                    upscaled = self.pipe_for_call(settings, tile_width, tile_height, len(boxes))(
+                        prompt=[task.prompt] * len(boxes),
+                        callback=handle_callback,
+                        callback_steps=1,
+                        image=tiles.crop(boxes),
+                        generator=[generators[index]] * len(boxes) if generators is not None else None
+                    ).images
+
+                    self.record_peak_memory(shape, plan, len(boxes))
+
+                    for box, image in zip(boxes, upscaled):
+                        blender.add(image, box)
+
+                    done += len(boxes)
+
+                    if is_tiled == True and output.is_cancelled == False:
+                        preview = blender.image()
+                        preview.thumbnail((self.generator.preview_max_dimension, self.generator.preview_max_dimension))
+
+                        preview_encoder.submit(output.url, preview, task.settings.output)
+
+                images.append(blender.image())
+
+        for task in batch.tasks:
+            task.add_timing("denoising", monotonic() - denoising_started_at)
+
+        self.collect_if_needed()
+
+        self.last_task = batch.tasks[-1]
+
+        # Previews which are not written yet must never replace final images
+        preview_encoder.discard([output.url for task in batch.tasks for output in task.outputs])
+
+        # Final images are encoded in the background while the next batch is denoised,
+        # tasks are completed once their images are in place
+        image_encoder = self.generator.image_encoder
+
+        for task, start, end in batch.slices:
+            if task.is_cancelled == True:
+                self.record_task(task, "cancelled")
+                continue
+
+            urls = []
+
+            for index, image in enumerate(images[start:end]):
+                if task.outputs[index].is_cancelled == False:
+                    image_encoder.write(task.outputs[index].url, image, task.settings.output)
+                    urls.append(task.outputs[index].url)
+
+            # Tasks which images fail to be written are failed, so they are not generated again after restart
+            image_encoder.after_written(
+                urls,
+                lambda task=task, seed=seeds[id(task)], started_at=monotonic(): self.complete_task(task, seed, started_at),
+                lambda error, task=task: self.fail_task(task, error)
+            )
+
+    # Notifies about a completed task once its final images are written
+    def complete_task(self, task : ImageGeneratorTask, seed : int, encode_started_at : float):
+        task.add_timing("encode", monotonic() - encode_started_at)
+
+        callback_started_at = monotonic()
+        task.callback(task, 1.0, seed)
+        task.add_timing("callback", monotonic() - callback_started_at)
+
+        self.record_task(task, "completed")
+
+    # Notifies about a task which cannot be generated, its outputs are marked failed and it is never run again
+    def fail_task(self, task : ImageGeneratorTask, error : str):
+        if task.is_cancelled == True:
+            self.record_task(task, "cancelled")
+            return
+
+        self.record_task(task, "failed")
+
+        try:
+            task.callback(task, 1.0, task.settings.seed, error=error)
+        except Exception as e:
+            print(f"[GEN] Failed to notify about failed task: {e}")
+
+    # Counts a finished task and records time spent in every phase of its generation
+    def record_task(self, task : ImageGeneratorTask, result : str):
+        type = task.settings.type.value
+
+        TASKS.inc(type=type, result=result)
+
+        if result == "completed":
+            IMAGES.inc(len([output for output in task.outputs if output.is_cancelled == False]), type=type)
+
+        for phase, duration in task.timings.items():
+            TASK_PHASES.observe(duration, type=type, phase=phase)
+
+    # Text encoder outputs for every prompt, prompts encoded before are taken from the cache
+    def encode_prompts(self, prompts : list[str], negative_prompt : str = "") -> tuple[torch.Tensor, torch.Tensor]:
+        cache = self.generator.prompt_embeddings
+        key = self.cached.key
+
+        def key_for(prompt : str) -> PromptEmbeddingKey:
+            return PromptEmbeddingKey(model=key.model, revision=key.revision, dtype=key.dtype, prompt=prompt, negative_prompt=negative_prompt)
+
+        embeddings = {}
+
+        for prompt in dict.fromkeys(prompts):
+            embedding = cache.get(key_for(prompt))
+
+            if embedding is not None:
+                embeddings[prompt] = embedding
+
+        missing = [prompt for prompt in dict.fromkeys(prompts) if prompt not in embeddings]
+        device = self.pipe._execution_device
+
+        # Unconditional embeddings come first for classifier free guidance
+        if len(missing) > 0:
+            with torch.no_grad():
+                encoded = self.pipe._encode_prompt(missing, device, 1, True, negative_prompt=[negative_prompt] * len(missing))
+
+            for index, prompt in enumerate(missing):
+                embedding = PromptEmbedding(prompt_embeds=encoded[len(missing) + index:len(missing) + index + 1], negative_prompt_embeds=encoded[index:index + 1])
+                embeddings[prompt] = embedding
+
+                cache.put(key_for(prompt), embedding)
+
+        prompt_embeds = torch.cat([embeddings[prompt].prompt_embeds.to(device) for prompt in prompts])
+        negative_prompt_embeds = torch.cat([embeddings[prompt].negative_prompt_embeds.to(device) for prompt in prompts])
+
+        return prompt_embeds, negative_prompt_embeds
+
+    def reset_peak_memory(self):
+        if self.device.type == "cuda":
+            torch.cuda.reset_peak_memory_stats(self.device)
+
+    # Peak memory allocated since the last reset (in bytes), unknown for other devices than CUDA
+    def peak_memory(self) -> int | None:
+        if self.device.type == "cuda":
+            return torch.cuda.max_memory_allocated(self.device) - torch.cuda.memory_allocated(self.device)
+
+        return None
+
+    def record_peak_memory(self, shape : ExecutionShape, plan : ExecutionPlan, images : int):
+        peak = self.peak_memory()
+
+        if peak is not None:
+            self.planner.record(self.cached.key, replace(shape, images=images), plan, peak)
+
+    # Memory related parameters of a pipeline call generating images of the size
+    def execution_shape(self, settings : ImageGeneratorTaskSettings, width : int, height : int, images : int) -> ExecutionShape:
+        heads = self.pipe.unet.config.attention_head_dim
+
+        if isinstance(heads, (list, tuple)):
+            heads = heads[0]
+
+        element_size = torch.finfo(self.dtype).bits // 8
+
+        # Upscaling pipeline has neither VAE slicing nor tiling, so its plans never count on them
+        is_vae_slicing_supported = hasattr(self.pipe, "enable_vae_slicing") or hasattr(self.pipe, "enable_vae_tiling")
+
+        # Upscaling model denoises latents of the source size and has no attention at the highest resolution
+        if settings.type == ImageGeneratorTaskType.upscale:
+            return ExecutionShape(type=settings.type.value, latent_width=width, latent_height=height, scale=UPSCALE_FACTOR,
+                                  images=images, heads=heads, attention_reduction=2, element_size=element_size,
+                                  is_vae_slicing_supported=is_vae_slicing_supported)
+
+        return ExecutionShape(type=settings.type.value, latent_width=width // 8, latent_height=height // 8, scale=8,
+                              images=images, heads=heads, element_size=element_size, is_vae_slicing_supported=is_vae_slicing_supported)
+
+    # Chooses memory saving options for the call and applies them to the current pipeline
+    def plan_execution(self, settings : ImageGeneratorTaskSettings, shape : ExecutionShape) -> ExecutionPlan:
+        available = self.available_memory()
+        plan = self.planner.plan(self.cached.key, shape, available, weights=self.cached.size)
+
+        # Freeing cached allocations only when the plan leaves little headroom
+        if self.planner.is_cleanup_needed(available - plan.estimated_peak, self.total_memory):
+            self.collect()
+
+            available = self.available_memory()
+            plan = self.planner.plan(self.cached.key, shape, available, weights=self.cached.size)
+
+        # Offloaded weights cannot be moved back, the pipeline is loaded again
+        if self.cached.is_offloaded == True and plan.cpu_offload == False:
+            print(f"[GEN] Reloading offloaded model '{self.cached.key.model}'")
+
+            self.pipelines.discard(self.cached.key)
+            self.prepare_model_if_needed(settings)
+
+        self.apply_plan(self.cached, plan)
+
+        print(f"[GEN] Execution plan for {shape.images} images ({plan.estimated_peak / 1024 / 1024:.0f}MB of {available / 1024 / 1024:.0f}MB): {plan}")
+
+        return plan
+
+    def apply_plan(self, cached : CachedPipeline, plan : ExecutionPlan):
+        pipe = cached.pipe
+        current = cached.plan or ExecutionPlan()
+
+        # Shared modules may be changed by plans of other pipelines
+        is_shared = self.pipelines.is_shared(cached)
+
+        if plan.attention_slicing != current.attention_slicing:
+            if plan.attention_slicing == True:
+                pipe.enable_attention_slicing()
+            else:
+                pipe.disable_attention_slicing()
+
+                # Disabling slicing sets the plain attention processor instead of the fused one set on load
+                processor = cached.optimization.processor if cached.optimization is not None else fused_attention_processor()
+
+                if processor is not None:
+                    pipe.unet.set_attn_processor(processor)
+
+        if plan.vae_slicing != current.vae_slicing or is_shared == True:
+            if hasattr(pipe, "enable_vae_slicing"):
+                if plan.vae_slicing == True:
+                    pipe.enable_vae_slicing()
+                else:
+                    pipe.disable_vae_slicing()
+            elif hasattr(pipe, "enable_vae_tiling"):
+                if plan.vae_slicing == True:
+                    pipe.enable_vae_tiling()
+                else:
+                    pipe.disable_vae_tiling()
+
+        if plan.cpu_offload == True and cached.is_offloaded == False:
+            print(f"[GEN] Offloading model '{cached.key.model}' to host memory")
+
+            # Offloading hooks wrap forward methods of modules, which are compiled no longer
+            if cached.optimization is not None:
+                cached.optimization.disable()
+
+            # Offloading hooks are attached to modules, which cannot be shared with pipelines kept on the device anymore
+            if is_shared == True:
+                self.pipelines.unshare(cached)
+
+            pipe.enable_sequential_cpu_offload(gpu_id=self.device.index or 0)
+            cached.is_offloaded = True
+
+        cached.plan = plan
+
+    def pipeline_key(self, settings : ImageGeneratorTaskSettings) -> PipelineKey:
+        model, revision, type = self.generator.pipeline_identity(settings)
+
+        return PipelineKey(
+            model=model,
+            revision=revision,
+            type=type,
+            dtype=str(self.dtype)
+        )
+
+    # Hashes of components of the model, computed on its first load from weights converted to safetensors
+    def component_hashes_for(self, key : PipelineKey, url : str) -> dict[str, str]:
+        models = self.generator.models
+
+        model = next((model for model in models.preview_models + models.upscale_models if model.path == key.model and model.revision == key.revision), None)
+
+        # Hashes are kept only for configured models, others are loaded without sharing
+        if model is None or len(model.component_hashes) > 0:
+            return model.component_hashes if model is not None else {}
+
+        try:
+            hashes = component_hashes(url)
+        except Exception as e:
+            print(f"[GEN] Failed to hash components of '{key.model}': {e}")
+            return {}
+
+        if len(hashes) > 0:
+            self.generator.notify_component_hashes(key.model, key.revision, hashes)
+
+        return hashes
+
+    def prepare_model_if_needed(self, settings : ImageGeneratorTaskSettings):
+        key = self.pipeline_key(settings)
+
+        cached = self.pipelines.get(key)
+
+        if cached is not None:
+            print(f"[GEN] Reusing cached model '{key.model}'")
+
+            MODEL_REQUESTS.inc(type=key.type, result="reused")
+        else:
+            self.pipe = None
+            self.cached = None
+            self.approximate_image_decoder = None
+
+            print(f"[GEN] Loading model '{key.model}' at '{self.device_name}'")
+
+            url = self.url_for_model(key)
+
+            # Components identical to ones of loaded models are taken from them instead of being loaded again,
+            # they are kept referenced even if their pipelines are evicted to make room
+            hashes = self.component_hashes_for(key, url)
+            shared = self.pipelines.shared_components(hashes)
+
+            if len(shared) > 0:
+                print(f"[GEN] Sharing {', '.join(shared)} of model '{key.model}' with loaded models")
+
+            # Making sure the new model fits the budget before loading it
+            self.pipelines.make_room()
+
+            started_at = monotonic()
+
+            cached = self.pipelines.put(key, self.load_pipeline(url, key, shared), component_hashes=hashes)
+            cached.schedulers = SchedulerSet(cached.pipe.scheduler)
+
+            MODEL_LOAD.observe(monotonic() - started_at, type=key.type)
+            MODEL_REQUESTS.inc(type=key.type, result="loaded")
+
+            print(f"[GEN] Loaded model '{key.model}' ({cached.size / 1024 / 1024:.0f}MB)")
+
+            if self.generator.is_optimized == True:
+                self.optimize(cached, settings)
+
+        print(f"[GEN] Models cache at '{self.device_name}': {self.pipelines.stats}")
+
+        # Sampling method is attached per task without reloading weights
+        cached.pipe.scheduler = cached.schedulers.get(settings.method)
+
+        # Seamless tiling is toggled in place on the loaded modules, shared modules may be toggled by other pipelines
+        is_seamless = settings.seamless == 1 and settings.type != ImageGeneratorTaskType.upscale
+
+        if cached.is_seamless != is_seamless or self.pipelines.is_shared(cached) == True:
+            set_seamless(cached.pipe, is_seamless)
+            cached.is_seamless = is_seamless
+
+        if cached.decoder is None:
+            is_upscale = key.type == ImageGeneratorTaskType.upscale
+
+            cached.decoder = self.generator.latent_decoders.decoder_for_pipeline(
+                cached.pipe,
+                id=f"{key.model}@{key.revision}",
+                scaling_factor=0.08333 if is_upscale else 0.18215,
+                is_tiny_compatible=not is_upscale
+            )
+
+            print(f"[GEN] Using '{cached.decoder.name}' preview decoder")
+
+        self.cached = cached
+        self.pipe = cached.pipe
+        self.approximate_image_decoder = cached.decoder
+
+    # Applies the optimized mode to a loaded pipeline, the default image size is compiled right away
+    def optimize(self, cached : CachedPipeline, settings : ImageGeneratorTaskSettings):
+        try:
+            cached.optimization = PipelineOptimization(cached.pipe)
+        except Exception as e:
+            print(f"[GEN] Failed to optimize model '{cached.key.model}': {e}")
+            return
+
+        if cached.key.type == ImageGeneratorTaskType.preview:
+            width, height = self.generator.dimensions_for_settings(replace(settings, dimensions=1.0))
+            self.request_compiling(cached, CompiledShape(width=width, height=height, images=1, method=settings.method))
+
+    # Pipeline to call for images of the size, using compiled modules once the size is compiled
+    def pipe_for_call(self, settings : ImageGeneratorTaskSettings, width : int, height : int, images : int):
+        optimization = self.cached.optimization
+        plan = self.cached.plan or ExecutionPlan()
+
+        # Sliced attention is used only when memory is short, it is not worth compiling
+        if optimization is None or optimization.is_enabled == False or plan.attention_slicing == True:
+            return self.pipe
+
+        shape = CompiledShape(
+            width=width,
+            height=height,
+            images=images,
+            method=settings.method,
+            is_seamless=self.cached.is_seamless,
+            vae_slicing=plan.vae_slicing
+        )
+
+        pipe = optimization.pipe_for(shape)
+
+        if pipe is None:
+            self.request_compiling(self.cached, shape)
+            return self.pipe
+
+        return pipe
+
+    # Image to image pipeline made of modules of the pipeline, so variations load no weights of their own
+    def variation_pipe(self, pipe) -> StableDiffusionImg2ImgPipeline:
+        return StableDiffusionImg2ImgPipeline(
+            vae=pipe.vae,
+            text_encoder=pipe.text_encoder,
+            tokenizer=pipe.tokenizer,
+            unet=pipe.unet,
+            scheduler=pipe.scheduler,
+            safety_checker=None,
+            feature_extractor=None,
+            requires_safety_checker=False
+        )
+
+    # Sizes are requested by the worker thread, which compiles them once it is idle
+    def request_compiling(self, cached : CachedPipeline, shape : CompiledShape):
+        if shape in cached.optimization.requested:
+            return
+
+        cached.optimization.requested.add(shape)
+        self.compile_requests.append((cached, shape))
+
+    # Compiles graphs of a shape by running a tiny generation of the shape with a copy of the pipeline
+    def compile_shape(self, cached : CachedPipeline, shape : CompiledShape):
+        optimization = cached.optimization
+
+        if optimization.is_enabled == False:
+            return
+
+        # Pipelines evicted or changed since the request are compiled when the shape is requested again
+        if cached not in list(self.pipelines.resident.values()) or cached.is_seamless != shape.is_seamless:
+            optimization.requested.discard(shape)
+            return
+
+        print(f"[GEN] Compiling model '{cached.key.model}' for {shape.images} images {shape.width}x{shape.height}")
+
+        started_at = monotonic()
+
+        # Compiling runs in the worker thread, so failures disable the optimization instead of stopping the worker
+        try:
+            scheduler = cached.schedulers.get(shape.method)
+            pipe = optimization.compiled_pipe(type(scheduler).from_config(scheduler.config), vae_slicing=shape.vae_slicing)
+
+            if isinstance(pipe, StableDiffusionUpscalePipeline):
+                pipe(
+                    prompt=[""] * shape.images,
+                    image=[Image.new("RGB", (shape.width, shape.height))] * shape.images,
+                    num_inference_steps=2
+                )
+            else:
+                pipe(
+                    prompt=[""] * shape.images,
+                    width=shape.width,
+                    height=shape.height,
+                    num_inference_steps=2
+                )
+        except Exception as e:
+            print(f"[GEN] Failed to compile model '{cached.key.model}', it is used without compiling: {e}")
+            optimization.disable()
+            return
+
+        optimization.shapes.add(shape)
+
+        print(f"[GEN] Compiled model '{cached.key.model}' for {shape.images} images {shape.width}x{shape.height} in {monotonic() - started_at:.1f}s")
+
+    # Local folder of a downloaded model, where pickle weights are converted to safetensors once
+    def url_for_model(self, key : PipelineKey) -> str:
+        if os.path.isdir(key.model):
+            url = key.model
+        else:
+            from huggingface_hub import snapshot_download
+
+            url = snapshot_download(
+                key.model,
+                revision=key.revision,
+                cache_dir=self.generator.models.url_for_models,
+                local_files_only=True
+            )
+
+        if is_safetensors_available():
+            try:
+                convert_to_safetensors(url)
+            except Exception as e:
+                print(f"[GEN] Failed to convert weights of '{key.model}' to safetensors: {e}")
+
+        return url
+
+    # Safetensors weights are preferred by pipelines and memory mapped instead of being unpickled into host memory,
+    # so they are read only once when moved to the device
+    def load_pipeline(self, url : str, key : PipelineKey, shared : dict | None = None):
+        shared = shared if shared is not None else {}
+
+        # Shared components are passed to pipelines, so their weights are not read
+        if key.type == ImageGeneratorTaskType.upscale:
+            pipe = StableDiffusionUpscalePipeline.from_pretrained(
+                url,
+                torch_dtype=self.dtype,
+                local_files_only=True,
+                **shared
+            )
+        else:
+            pipe = StableDiffusionPipeline.from_pretrained(
+                url,
+                torch_dtype=self.dtype,
+                safety_checker=None,
+                local_files_only=True,
+                **shared
+            )
+
+        return pipe.to(self.device_name)
+
+    def wait(self):
+        self.daemon.join()
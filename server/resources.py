@@ -7,18 +7,23 @@ resources = Blueprint("resources", url_prefix="/resources")
 
 @resources.route("/")
 async def get_resources_status(request):
-    manager = context.generator.models
+    manager = context.models
+    is_generator_ready = context.is_generator_ready
 
     return json({
         "preview_models" : [model.to_dict() for model in manager.preview_models],
         "upscale_models" : [model.to_dict() for model in manager.upscale_models],
         "data_path" : manager.url_for_data,
-        "is_downloading" : manager.is_downloading
+        "is_downloading" : manager.is_downloading,
+        "is_generator_ready" : is_generator_ready,
+        "workers" : context.generator.stats if is_generator_ready == True else [],
+        "embeddings" : context.generator.embeddings_stats if is_generator_ready == True else {},
+        "results" : context.results.stats
     })
 
 @resources.route("/downloads/start")
 async def start_downloading(request):
-    context.generator.models.start_downloading()
+    context.models.start_downloading()
 
     return json({
         "status" : "ok"
@@ -26,7 +31,7 @@ async def start_downloading(request):
 
 @resources.route("/downloads/stop")
 async def stop_downloading(request):
-    context.generator.models.stop_downloading()
+    context.models.stop_downloading()
 
     return json({
         "status" : "ok"
@@ -46,7 +51,7 @@ async def add_model(request):
         })
     
     try:
-        await context.generator.models.add_preview_model(id)
+        await context.models.add_preview_model(id)
 
         return json({
             "status" : "ok"
@@ -73,7 +78,7 @@ async def remove_model(request):
         })
     
     try:
-        await context.generator.models.remove_preview_model(id)
+        await context.models.remove_preview_model(id)
 
         return json({
             "status" : "ok"
@@ -110,7 +115,7 @@ async def update_data_path(request):
             "error" : "path-not-directory"
         })
     
-    context.generator.models.update_url_for_data(path)
+    context.models.update_url_for_data(path)
 
     return json({
         "status" : "ok"
@@ -1,7 +1,11 @@
+from lib.timing import startup
+
 import os
 from sanic import Sanic
 from sanic_ext import Extend
 
+startup.mark("imports")
+
 from context import context
 
 from resources import resources
@@ -11,6 +15,9 @@ from outputs import outputs
 from files import files
 from settings import settings
 from updates import updates
+from tasks import tasks
+from status import status
+from metrics import metrics
 
 app = Sanic("varnava-server")
 app.config.CORS_ORIGINS = "*"
@@ -23,9 +30,17 @@ app.blueprint(outputs)
 app.blueprint(files)
 app.blueprint(settings)
 app.blueprint(updates)
+app.blueprint(tasks)
+app.blueprint(status)
+app.blueprint(metrics)
 
 Extend(app)
 
+# Time until requests are served, generator keeps starting in the background
+@app.after_server_start
+async def mark_server_started(app, loop):
+    startup.mark("server", after="imports")
+
 def run():
     port = int(os.environ.get("VARNAVA_SERVER_PORT", 23804))
 
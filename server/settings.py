@@ -7,7 +7,13 @@ settings = Blueprint("settings")
 # Listing all possible prompts settings
 @settings.get("/settings/prompts")
 async def list_prompts_settings(request):
-    manager = context.generator.models
+    manager = context.models
+
+    # Dimensions depend on devices of the generator
+    if await context.wait_for_generator(timeout=60) == False:
+        return json({
+            "error" : "warming-up"
+        }, status=503)
 
     ids = [model.path for model in manager.preview_models if model.total_file_bytes == model.downloaded_file_bytes]
 
@@ -0,0 +1,14 @@
+from sanic import Blueprint
+from lib.json import json
+from lib.timing import startup
+from context import context
+
+status = Blueprint("status")
+
+# Getting readiness of the server with durations of its startup phases
+@status.get("/status")
+async def get_status(request):
+    return json({
+        "is_generator_ready" : context.is_generator_ready,
+        "startup" : startup.to_dict()
+    })
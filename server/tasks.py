@@ -0,0 +1,80 @@
+import asyncio
+from sanic import Blueprint
+from playhouse.shortcuts import model_to_dict
+from db.models import Prompt, Output
+from context import context
+from lib.json import json
+
+tasks = Blueprint("tasks", url_prefix="/tasks")
+
+# Getting generation queue state with its scheduling policy
+@tasks.get("/")
+async def get_tasks_status(request):
+    if context.is_generator_ready == False:
+        return json({
+            "error" : "warming-up"
+        }, status=503)
+
+    scheduler = context.generator.tasks
+
+    return json({
+        "policy" : scheduler.policy,
+        "stats" : scheduler.stats,
+        "pending" : [
+            {
+                "outputs" : [output.id for output in task.outputs],
+                "type" : task.settings.type.value,
+                "model" : task.settings.model,
+                "priority" : task.priority.value
+            } for task in scheduler.pending()
+        ]
+    })
+
+# Marks outputs as cancelled in the database and notifies clients
+def mark_outputs_cancelled(ids):
+    if len(ids) == 0:
+        return
+
+    Output.update(isCancelled=True).where(Output.id.in_(ids), Output.progress < 1.0).execute()
+
+    for output in Output.select().where(Output.id.in_(ids)):
+        context.channel.send("output.updated", model_to_dict(output))
+
+# Cancelling queued and running outputs by output, prompt or project
+@tasks.post("/cancel")
+async def cancel_tasks(request):
+    input = request.json if request.json is not None else {}
+
+    query = Output.select(Output.id).join(Prompt).where(Output.progress < 1.0, Output.isCancelled == False)
+
+    if "output_id" in input:
+        query = query.where(Output.id == input["output_id"])
+    elif "prompt_id" in input:
+        query = query.where(Output.prompt == input["prompt_id"])
+    elif "project_id" in input:
+        query = query.where(Prompt.project == input["project_id"])
+    else:
+        return json({
+            "error" : "missing-field",
+            "error-details" : {
+                "name" : "output_id"
+            }
+        }, status=400)
+
+    # Cancelling waits for the generator, so it never blocks other requests
+    ids = await asyncio.get_running_loop().run_in_executor(None, context.queue.cancel_outputs, set(output.id for output in query))
+    mark_outputs_cancelled(ids)
+
+    return json({
+        "cancelled" : ids
+    })
+
+# Cancelling everything in the queue
+@tasks.post("/clear")
+async def clear_tasks(request):
+    ids = await asyncio.get_running_loop().run_in_executor(None, context.queue.cancel_outputs)
+    mark_outputs_cancelled(ids)
+
+    return json({
+        "cancelled" : ids
+    })
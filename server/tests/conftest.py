@@ -0,0 +1,19 @@
+import os
+import sys
+
+# Server modules are imported from the server folder, as the server runs from it
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+# Empty database in a temporary folder, bound to models for the test
+@pytest.fixture
+def database(tmp_path):
+    from db.models import db, Project, Prompt, Output, QueuedTask, CachedResult
+
+    db.init(str(tmp_path / "database.db"))
+    db.create_tables([Project, Prompt, Output, QueuedTask, CachedResult])
+
+    yield db
+
+    db.close()
@@ -0,0 +1,110 @@
+import torch
+from rendering.cache import PipelineCache, PipelineKey
+
+class FakePipeline:
+    def __init__(self, **components):
+        self.components = components
+
+    def to(self, device : str):
+        for component in self.components.values():
+            component.to(device)
+
+        return self
+
+# Module holding the number of bytes of weights
+def create_module(size : int) -> torch.nn.Module:
+    module = torch.nn.Module()
+    module.register_buffer("weight", torch.zeros(size // 4, dtype=torch.float32))
+
+    return module
+
+def create_key(model : str) -> PipelineKey:
+    return PipelineKey(model=model, revision=None, type="preview", dtype="torch.float32")
+
+def test_least_recently_used_pipelines_are_evicted():
+    cache = PipelineCache("cpu", memory_budget=1000)
+
+    first = cache.put(create_key("first"), FakePipeline(unet=create_module(400)))
+    cache.put(create_key("second"), FakePipeline(unet=create_module(400)))
+
+    assert cache.get(create_key("first")) is first
+
+    cache.put(create_key("third"), FakePipeline(unet=create_module(400)))
+
+    assert [key.model for key in cache.resident] == ["first", "third"]
+    assert cache.stats["evictions"] == 1
+    assert cache.get(create_key("second")) is None
+
+def test_room_is_made_before_loading():
+    cache = PipelineCache("cpu", memory_budget=1000)
+
+    cache.put(create_key("first"), FakePipeline(unet=create_module(400)))
+    cache.put(create_key("second"), FakePipeline(unet=create_module(400)))
+
+    cache.make_room(400)
+
+    assert [key.model for key in cache.resident] == ["second"]
+
+def test_evicted_pipelines_are_spilled_to_host():
+    cache = PipelineCache("cpu", memory_budget=1000, spill_to_host=True, host_memory_budget=1000)
+
+    first = cache.put(create_key("first"), FakePipeline(unet=create_module(600)))
+    cache.put(create_key("second"), FakePipeline(unet=create_module(600)))
+
+    assert list(cache.spilled) == [create_key("first")]
+    assert cache.spilled_size == 600
+
+    assert cache.get(create_key("first")) is first
+    assert cache.stats["host_hits"] == 1
+    assert list(cache.resident) == [create_key("first")]
+    assert list(cache.spilled) == [create_key("second")]
+
+def test_spilled_pipelines_fit_host_budget():
+    cache = PipelineCache("cpu", memory_budget=500, spill_to_host=True, host_memory_budget=500)
+
+    cache.put(create_key("first"), FakePipeline(unet=create_module(400)))
+    cache.put(create_key("second"), FakePipeline(unet=create_module(400)))
+    cache.put(create_key("third"), FakePipeline(unet=create_module(400)))
+
+    assert list(cache.spilled) == [create_key("second")]
+
+def test_shared_modules_are_counted_once():
+    cache = PipelineCache("cpu", memory_budget=10000)
+    vae = create_module(200)
+
+    first = cache.put(create_key("first"), FakePipeline(unet=create_module(400), vae=vae), component_hashes={ "vae" : "hash" })
+
+    shared = cache.shared_components({ "vae" : "hash", "text_encoder" : "other" })
+
+    assert shared == { "vae" : vae }
+
+    second = cache.put(create_key("second"), FakePipeline(unet=create_module(400), **shared), component_hashes={ "vae" : "hash" })
+
+    assert cache.resident_size == 1000
+    assert cache.shared_size == 200
+    assert cache.is_shared(first) == True
+
+    cache.unshare(second)
+
+    assert list(cache.resident) == [create_key("second")]
+    assert cache.is_shared(second) == False
+
+def test_offloaded_modules_are_never_shared():
+    cache = PipelineCache("cpu", memory_budget=10000)
+
+    cached = cache.put(create_key("first"), FakePipeline(vae=create_module(200)), component_hashes={ "vae" : "hash" })
+    cached.is_offloaded = True
+
+    assert cache.shared_components({ "vae" : "hash" }) == {}
+
+def test_removed_models_are_dropped():
+    cache = PipelineCache("cpu", memory_budget=500, spill_to_host=True, host_memory_budget=1000)
+
+    cache.put(create_key("first"), FakePipeline(unet=create_module(400)))
+    cache.put(create_key("second"), FakePipeline(unet=create_module(400)))
+
+    cache.remove("first")
+    cache.remove("second")
+
+    assert len(cache.resident) == 0
+    assert len(cache.spilled) == 0
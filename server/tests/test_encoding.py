@@ -0,0 +1,90 @@
+from threading import Event
+from time import sleep
+from PIL import Image
+import rendering.encoding
+from rendering.encoding import ImageEncodingPool
+from rendering.previews import PreviewEncoder
+from rendering.tasks import ImageGeneratorImageFormat, ImageGeneratorTaskOutputSettings
+
+def wait_for_callbacks(pool : ImageEncodingPool, url : str) -> tuple[list, list]:
+    completed = []
+    failed = []
+    called = Event()
+
+    def complete():
+        completed.append(True)
+        called.set()
+
+    def fail(error : str):
+        failed.append(error)
+        called.set()
+
+    pool.write(url, Image.new("RGB", (8, 8)))
+    pool.after_written([url], complete, fail)
+
+    assert called.wait(5) == True
+
+    return completed, failed
+
+def test_written_images_complete(tmp_path):
+    pool = ImageEncodingPool(workers=1)
+    pool.start()
+
+    completed, failed = wait_for_callbacks(pool, str(tmp_path / "image.jpg"))
+    pool.stop()
+
+    assert (completed, failed) == ([True], [])
+    assert pool.written == 1
+
+def test_images_failed_before_waiting_fail(tmp_path, monkeypatch):
+    def save_image(image, url, **options):
+        raise OSError("disk is full")
+
+    monkeypatch.setattr(rendering.encoding, "save_image", save_image)
+
+    pool = ImageEncodingPool(workers=1)
+    pool.start()
+
+    url = str(tmp_path / "image.jpg")
+    pool.write(url, Image.new("RGB", (8, 8)))
+    pool.stop()
+
+    failed = []
+    pool.after_written([url], lambda: failed.append(None), failed.append)
+
+    assert len(failed) == 1 and "disk is full" in failed[0]
+    assert pool.errors == {}
+
+def test_failed_images_fail(tmp_path, monkeypatch):
+    def save_image(image, url, **options):
+        raise OSError("disk is full")
+
+    monkeypatch.setattr(rendering.encoding, "save_image", save_image)
+
+    pool = ImageEncodingPool(workers=1)
+    pool.start()
+
+    completed, failed = wait_for_callbacks(pool, str(tmp_path / "image.jpg"))
+    pool.stop()
+
+    assert completed == []
+    assert len(failed) == 1 and "disk is full" in failed[0]
+    assert pool.failed == 1
+    assert pool.waiting == []
+
+def test_previews_are_written_in_format_of_output(tmp_path):
+    encoder = PreviewEncoder()
+    encoder.start()
+
+    for index, format in enumerate([ImageGeneratorImageFormat.png, ImageGeneratorImageFormat.webp, ImageGeneratorImageFormat.jpeg]):
+        url = str(tmp_path / f"image.{format.value}")
+
+        encoder.submit(url, Image.new("RGB", (8, 8)), ImageGeneratorTaskOutputSettings(format=format))
+
+        for _ in range(100):
+            if encoder.written == index + 1:
+                break
+
+            sleep(0.05)
+
+        assert Image.open(url).format == format.value.upper()
@@ -0,0 +1,72 @@
+from rendering.planning import ExecutionPlan, ExecutionPlanner, ExecutionShape
+
+def create_shape(**options) -> ExecutionShape:
+    return ExecutionShape(**{
+        "type" : "preview",
+        "latent_width" : 64,
+        "latent_height" : 64,
+        "scale" : 8,
+        "images" : 4,
+        **options
+    })
+
+def test_plans_never_slice_unsupported_vae():
+    planner = ExecutionPlanner(is_offload_supported=True)
+    shape = create_shape(type="upscale", scale=4, attention_reduction=2, is_vae_slicing_supported=False)
+
+    candidates = planner.candidates(shape)
+
+    assert all(candidate.vae_slicing == False for candidate in candidates)
+    assert candidates[-1].cpu_offload == True
+
+def test_unsupported_vae_slicing_saves_no_memory():
+    planner = ExecutionPlanner()
+    shape = create_shape(scale=32)
+    unsupported = create_shape(scale=32, is_vae_slicing_supported=False)
+
+    plan = ExecutionPlan(vae_slicing=True, max_images=4)
+
+    assert planner.estimate("model", shape, plan) < planner.estimate("model", shape, ExecutionPlan(max_images=4))
+    assert planner.estimate("model", unsupported, plan) == planner.estimate("model", unsupported, ExecutionPlan(max_images=4))
+
+def test_fastest_plan_is_picked_with_enough_memory():
+    planner = ExecutionPlanner()
+    shape = create_shape()
+
+    plan = planner.plan("model", shape, 1 << 40)
+
+    assert (plan.attention_slicing, plan.vae_slicing, plan.cpu_offload, plan.max_images) == (False, False, False, 4)
+    assert plan.estimated_peak == planner.estimate("model", shape, plan)
+
+def test_batches_are_split_when_memory_is_short():
+    planner = ExecutionPlanner()
+    shape = create_shape()
+
+    single = planner.estimate("model", shape, ExecutionPlan(attention_slicing=True, vae_slicing=True, max_images=1))
+    plan = planner.plan("model", shape, int(single * 1.5 / planner.headroom))
+
+    assert plan.max_images == 1
+    assert plan.attention_slicing == True
+    assert planner.stats["splits"] == 1
+
+def test_weights_are_offloaded_when_nothing_fits():
+    shape = create_shape()
+
+    assert ExecutionPlanner().plan("model", shape, 0).cpu_offload == False
+    assert ExecutionPlanner(is_offload_supported=True).plan("model", shape, 0).cpu_offload == True
+
+def test_recorded_peaks_correct_estimates():
+    planner = ExecutionPlanner()
+    shape = create_shape()
+    plan = ExecutionPlan(max_images=4)
+
+    estimated = planner.estimate("model", shape, plan)
+
+    planner.record("model", shape, plan, estimated * 2)
+
+    assert planner.estimate("model", shape, plan) == estimated * 2
+    assert planner.estimate("other", shape, plan) == estimated
+
+    planner.record("model", shape, plan, estimated)
+
+    assert planner.estimate("model", shape, plan) == int(estimated * 1.5)
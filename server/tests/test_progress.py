@@ -0,0 +1,49 @@
+from threading import Thread, Event
+import db.progress
+from db.models import Project, Prompt, Output
+from db.progress import OutputProgressAggregator
+from lib.channel import Channel
+
+class PausedDatabase:
+    """Database whose first transaction waits until it is resumed, as if a flush was slow to write."""
+
+    def __init__(self, database):
+        self.database = database
+        self.started = Event()
+        self.resumed = Event()
+
+    def atomic(self):
+        if self.started.is_set() == False:
+            self.started.set()
+            self.resumed.wait(5)
+
+        return self.database.atomic()
+
+def test_concurrent_flushes_keep_latest_progress(database, monkeypatch):
+    paused = PausedDatabase(database)
+    monkeypatch.setattr(db.progress, "db", paused)
+
+    prompt = Prompt.create(project=Project.create(title="Project"), value="a house")
+    output = Output.create(prompt=prompt, url="output.jpg")
+
+    progress = OutputProgressAggregator(Channel())
+
+    # Periodic flush takes the progress and pauses before writing it
+    progress.update({ output.id : 7 }, 0.9)
+
+    periodic = Thread(target=progress.flush)
+    periodic.start()
+
+    assert paused.started.wait(5) == True
+
+    # Completion is flushed while the periodic flush is still writing
+    completion = Thread(target=progress.update, args=({ output.id : 7 }, 1.0))
+    completion.start()
+    completion.join(0.5)
+
+    paused.resumed.set()
+
+    periodic.join(5)
+    completion.join(5)
+
+    assert Output.get_by_id(output.id).progress == 1.0
@@ -0,0 +1,133 @@
+from threading import Thread
+from uuid import uuid4
+from db.models import Project, Prompt, Output, QueuedTask
+from db.progress import OutputProgressAggregator
+from db.queue import PersistentTaskQueue
+from db.results import ResultCache
+from lib.channel import Channel
+from rendering.models import ModelsSnapshot
+from rendering.tasks import ImageGeneratorTask, ImageGeneratorOutput, ImageGeneratorTaskSettings
+
+class FakeGenerator:
+    def __init__(self):
+        self.tasks = []
+
+    def add_task(self, task):
+        self.tasks.append(task)
+
+# Generator which tasks are added to while it is cancelling outputs
+class CancellingGenerator(FakeGenerator):
+    def __init__(self, queue, task, prompt):
+        super().__init__()
+        self.adding = Thread(target=queue.add, args=(task, prompt))
+
+    def cancel_outputs(self, ids):
+        self.adding.start()
+        self.adding.join(5)
+
+        return []
+
+def create_queue(tmp_path):
+    url_for_output = lambda *parts: str(tmp_path.joinpath(*parts))
+
+    return PersistentTaskQueue(OutputProgressAggregator(Channel()), ResultCache(url_for_output, ModelsSnapshot(url_for_models=str(tmp_path))), url_for_output)
+
+def create_task(prompt, count):
+    outputs = [Output.create(prompt=prompt, url=f"{uuid4()}.jpg") for _ in range(count)]
+
+    return ImageGeneratorTask(
+        prompt=prompt.value,
+        outputs=[ImageGeneratorOutput(id=output.id, url=output.url) for output in outputs],
+        settings=ImageGeneratorTaskSettings(seed=7)
+    )
+
+def create_prompt():
+    return Prompt.create(project=Project.create(title="Project"), value="a house")
+
+def test_restore_adds_unfinished_outputs_in_order(database, tmp_path):
+    queue = create_queue(tmp_path)
+    prompt = create_prompt()
+    task = create_task(prompt, 4)
+
+    queue.add(task, prompt)
+
+    first, second, third, fourth = [output.id for output in task.outputs]
+
+    Output.update(progress=1.0).where(Output.id == first).execute()
+    Output.update(isCancelled=True).where(Output.id == third).execute()
+
+    generator = FakeGenerator()
+    queue.attach(generator)
+
+    assert len(generator.tasks) == 1
+
+    restored = generator.tasks[0]
+
+    assert restored.id == task.id
+    assert [output.id for output in restored.outputs] == [second, fourth]
+    assert [output.seed_offset for output in restored.outputs] == [1, 3]
+    assert restored.settings.seed == 7
+    assert restored.callback == queue.update_outputs_progress
+
+def test_restored_outputs_keep_their_seeds(database, tmp_path):
+    queue = create_queue(tmp_path)
+    prompt = create_prompt()
+    task = create_task(prompt, 3)
+
+    queue.add(task, prompt)
+
+    first, second, third = [output.id for output in task.outputs]
+
+    Output.update(progress=1.0, seed=7).where(Output.id == first).execute()
+
+    generator = FakeGenerator()
+    queue.attach(generator)
+
+    restored = generator.tasks[0]
+    queue.update_outputs_progress(restored, 1.0, 7)
+
+    assert Output.get_by_id(second).seed == 8
+    assert Output.get_by_id(third).seed == 9
+
+def test_restore_removes_finished_tasks(database, tmp_path):
+    queue = create_queue(tmp_path)
+    prompt = create_prompt()
+    task = create_task(prompt, 2)
+
+    queue.add(task, prompt)
+
+    Output.update(progress=1.0).execute()
+
+    generator = FakeGenerator()
+    queue.attach(generator)
+
+    assert generator.tasks == []
+    assert QueuedTask.select().count() == 0
+
+def test_failed_task_is_not_restored(database, tmp_path):
+    queue = create_queue(tmp_path)
+    prompt = create_prompt()
+    task = create_task(prompt, 2)
+
+    queue.add(task, prompt)
+    queue.update_outputs_progress(task, 1.0, 7, error="missing initial image")
+
+    assert QueuedTask.select().count() == 0
+    assert all(output.isFailed == True and output.progress == 0 for output in Output.select())
+
+    generator = FakeGenerator()
+    queue.attach(generator)
+
+    assert generator.tasks == []
+
+def test_tasks_are_added_while_generator_cancels(database, tmp_path):
+    queue = create_queue(tmp_path)
+    prompt = create_prompt()
+    task = create_task(prompt, 1)
+
+    generator = CancellingGenerator(queue, task, prompt)
+    queue.attach(generator)
+
+    queue.cancel_outputs()
+
+    assert generator.tasks == [task]
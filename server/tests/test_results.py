@@ -0,0 +1,62 @@
+from rendering.models import ModelsSnapshot, RemoteModel
+from rendering.tasks import ImageGeneratorTaskType, ImageGeneratorTaskSettings
+from db.results import ResultCache
+
+CPU = [["cpu", "torch.float32"]]
+
+def create_cache(preview_models : list[RemoteModel], upscale_models : list[RemoteModel] = [], execution_identity : list | None = CPU) -> ResultCache:
+    models = ModelsSnapshot(url_for_models="models", preview_models=preview_models, upscale_models=upscale_models)
+
+    cache = ResultCache(lambda *parts: "/".join(parts), models)
+    cache.execution_identity = execution_identity
+
+    return cache
+
+def test_random_seeds_have_no_key():
+    cache = create_cache([RemoteModel(name="Preview", path="preview")])
+
+    assert cache.key_for("a house", ImageGeneratorTaskSettings(seed=-1), 0) is None
+
+def test_keys_differ_by_index_and_ignore_batch():
+    cache = create_cache([RemoteModel(name="Preview", path="preview")])
+    settings = ImageGeneratorTaskSettings(seed=7)
+
+    assert cache.key_for("a house", settings, 0) != cache.key_for("a house", settings, 1)
+    assert cache.key_for("a house", settings, 1) == cache.key_for("a house", ImageGeneratorTaskSettings(seed=8), 0)
+
+def test_default_model_is_resolved():
+    first = RemoteModel(name="First", path="first", revision="main")
+    second = RemoteModel(name="Second", path="second", revision="main")
+
+    settings = ImageGeneratorTaskSettings(seed=7)
+    explicit = ImageGeneratorTaskSettings(seed=7, model="first")
+
+    assert create_cache([first, second]).key_for("a house", settings, 0) == create_cache([first, second]).key_for("a house", explicit, 0)
+    assert create_cache([first, second]).key_for("a house", settings, 0) != create_cache([second, first]).key_for("a house", settings, 0)
+
+def test_revisions_change_keys():
+    settings = ImageGeneratorTaskSettings(seed=7, model="preview")
+
+    before = create_cache([RemoteModel(name="Preview", path="preview", revision="main")]).key_for("a house", settings, 0)
+    after = create_cache([RemoteModel(name="Preview", path="preview", revision="fp16")]).key_for("a house", settings, 0)
+
+    assert before != after
+
+def test_upscale_model_is_resolved():
+    settings = ImageGeneratorTaskSettings(seed=7, type=ImageGeneratorTaskType.upscale)
+    preview = [RemoteModel(name="Preview", path="preview")]
+
+    before = create_cache(preview, [RemoteModel(name="Upscale", path="upscale", revision="main")]).key_for("a house", settings, 0)
+    after = create_cache(preview, [RemoteModel(name="Upscale", path="upscale", revision="fp16")]).key_for("a house", settings, 0)
+
+    assert before != after
+
+def test_devices_and_precisions_change_keys():
+    preview = [RemoteModel(name="Preview", path="preview")]
+    settings = ImageGeneratorTaskSettings(seed=7)
+
+    cpu = create_cache(preview).key_for("a house", settings, 0)
+    cuda = create_cache(preview, execution_identity=[["cuda", "torch.float16"]]).key_for("a house", settings, 0)
+
+    assert cpu != cuda
+    assert create_cache(preview, execution_identity=None).key_for("a house", settings, 0) is None
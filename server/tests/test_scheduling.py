@@ -0,0 +1,86 @@
+from rendering.scheduling import TaskScheduler
+from rendering.tasks import ImageGeneratorTask, ImageGeneratorTaskPriority
+
+def create_task(priority : ImageGeneratorTaskPriority = ImageGeneratorTaskPriority.interactive) -> ImageGeneratorTask:
+    return ImageGeneratorTask(prompt="a house", outputs=[], priority=priority)
+
+# Makes the most recently added task look like it was waiting for the number of seconds
+def age_last(scheduler : TaskScheduler, seconds : float):
+    scheduler.entries[-1].enqueued_at -= seconds
+
+def test_tasks_are_taken_by_priority_then_order():
+    scheduler = TaskScheduler()
+
+    bulk = create_task(ImageGeneratorTaskPriority.bulk)
+    first = create_task()
+    second = create_task()
+
+    scheduler.put(bulk, "model")
+    scheduler.put(first, "model")
+    scheduler.put(second, "model")
+
+    assert [scheduler.take(), scheduler.take(), scheduler.take()] == [first, second, bulk]
+    assert scheduler.stats["reordered"] == 2
+
+def test_waiting_tasks_are_promoted():
+    scheduler = TaskScheduler(aging_interval=10.0)
+
+    bulk = create_task(ImageGeneratorTaskPriority.bulk)
+    interactive = create_task()
+
+    scheduler.put(bulk, "model")
+    age_last(scheduler, 35.0)
+    scheduler.put(interactive, "model")
+
+    assert scheduler.take() is bulk
+
+def test_loaded_pipelines_are_preferred_within_window():
+    scheduler = TaskScheduler(affinity_window=0.5)
+
+    head = create_task()
+    loaded = create_task()
+
+    scheduler.put(head, "other")
+    scheduler.put(loaded, "loaded")
+
+    assert scheduler.take(loaded_keys=["loaded"]) is loaded
+    assert scheduler.stats["reloads_avoided"] == 1
+
+def test_loaded_pipelines_never_skip_other_classes():
+    scheduler = TaskScheduler(affinity_window=0.5)
+
+    head = create_task()
+    loaded = create_task(ImageGeneratorTaskPriority.variation)
+
+    scheduler.put(head, "other")
+    scheduler.put(loaded, "loaded")
+
+    assert scheduler.take(loaded_keys=["loaded"]) is head
+
+def test_pipelines_busy_on_other_workers_are_avoided():
+    scheduler = TaskScheduler(affinity_window=0.5)
+
+    busy = create_task()
+    free = create_task()
+
+    scheduler.put(busy, "busy")
+    scheduler.put(free, "free")
+
+    assert scheduler.take(busy_keys=["busy"]) is free
+
+def test_taking_without_tasks():
+    scheduler = TaskScheduler()
+
+    assert scheduler.take(block=False) is None
+    assert scheduler.take(is_interrupted=lambda: True) is None
+
+def test_matching_tasks_are_taken_together():
+    scheduler = TaskScheduler()
+
+    tasks = [create_task() for _ in range(3)]
+
+    for index, task in enumerate(tasks):
+        scheduler.put(task, "model" if index != 1 else "other")
+
+    assert scheduler.take_matching(lambda task: task is not tasks[1]) == [tasks[0], tasks[2]]
+    assert scheduler.pending() == [tasks[1]]
@@ -0,0 +1,42 @@
+import torch
+from rendering.seamless import set_seamless
+
+class FakePipeline:
+    def __init__(self):
+        self.unet = torch.nn.Sequential(torch.nn.Conv2d(4, 4, 3, padding=1), torch.nn.SiLU(), torch.nn.Conv2d(4, 4, 3, padding=1))
+        self.vae = torch.nn.Sequential(torch.nn.Conv2d(4, 3, 3, padding=1))
+        self.text_encoder = torch.nn.Sequential(torch.nn.Conv2d(4, 4, 3, padding=1))
+
+def padding_modes(module : torch.nn.Module) -> list[str]:
+    return [child.padding_mode for child in module.modules() if isinstance(child, torch.nn.Conv2d)]
+
+def test_seamless_is_toggled_in_place():
+    init = torch.nn.Conv2d.__init__
+    pipe = FakePipeline()
+
+    set_seamless(pipe, True)
+
+    assert padding_modes(pipe.unet) == ["circular", "circular"]
+    assert padding_modes(pipe.vae) == ["circular"]
+    assert padding_modes(pipe.text_encoder) == ["zeros"]
+
+    set_seamless(pipe, False)
+
+    assert padding_modes(pipe.unet) == ["zeros", "zeros"]
+    assert padding_modes(pipe.vae) == ["zeros"]
+
+    # Convolutions created afterwards are never affected
+    assert torch.nn.Conv2d.__init__ is init
+    assert torch.nn.Conv2d(4, 4, 3).padding_mode == "zeros"
+
+def test_seamless_images_wrap_around():
+    pipe = FakePipeline()
+    latents = torch.randn(1, 4, 8, 8)
+
+    set_seamless(pipe, True)
+
+    with torch.no_grad():
+        shifted = pipe.unet(torch.roll(latents, 3, dims=3))
+        rolled = torch.roll(pipe.unet(latents), 3, dims=3)
+
+    assert torch.allclose(shifted, rolled, atol=1e-5)
@@ -0,0 +1,51 @@
+import numpy as np
+from PIL import Image
+from rendering.tiling import tile_positions, ImageTiles, TileBlender
+
+def test_small_lengths_have_a_single_tile():
+    assert tile_positions(100, 128, 32) == [0]
+    assert tile_positions(128, 128, 32) == [0]
+
+def test_tiles_cover_length_with_overlap():
+    for length in [129, 200, 256, 300, 517]:
+        positions = tile_positions(length, 128, 32)
+
+        assert positions[0] == 0
+        assert positions[-1] == length - 128
+        assert all(next - current <= 128 - 32 for current, next in zip(positions, positions[1:]))
+
+def test_tiles_of_image():
+    tiles = ImageTiles(Image.new("RGB", (300, 100)), 128, 32)
+
+    assert tiles.tile_size == (128, 100)
+    assert len(tiles) == len(tile_positions(300, 128, 32))
+    assert all(box[3] == 100 for box in tiles.boxes)
+
+def test_blended_tiles_restore_image():
+    pixels = np.random.default_rng(7).integers(0, 256, (150, 200, 3), dtype=np.uint8)
+    image = Image.fromarray(pixels)
+
+    tiles = ImageTiles(image, 64, 16)
+    blender = TileBlender(image.width, image.height, scale=1, feather=8)
+
+    for box, tile in zip(tiles.boxes, tiles.crop(tiles.boxes)):
+        blender.add(tile, box)
+
+    assert np.array_equal(np.asarray(blender.image()), pixels)
+
+def test_scaled_tiles_are_feathered():
+    blender = TileBlender(96, 64, scale=2, feather=16)
+
+    blender.add(Image.new("RGB", (128, 128), (0, 0, 0)), (0, 0, 64, 64))
+    blender.add(Image.new("RGB", (128, 128), (200, 200, 200)), (32, 0, 96, 64))
+
+    image = np.asarray(blender.image())[:, :, 0]
+
+    assert image.shape == (128, 192)
+    assert image[64, 0] == 0
+    assert image[64, -1] == 200
+
+    # Values across the overlap only grow from one tile to the other
+    row = image[64, 64:128].astype(int)
+    assert all(np.diff(row) >= 0)
+    assert row[0] < 100 < row[-1]
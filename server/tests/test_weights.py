@@ -0,0 +1,32 @@
+import os
+import json
+import torch
+from safetensors.torch import save_file
+from rendering.weights import component_hash, convert_to_safetensors
+
+def create_component(url : str, tensors : dict, format : str, metadata : dict | None = None):
+    os.makedirs(url, exist_ok=True)
+
+    with open(os.path.join(url, "config.json"), "w") as file:
+        json.dump({ "_name_or_path" : url, "layers" : 2 }, file)
+
+    if format == "bin":
+        torch.save(tensors, os.path.join(url, "diffusion_pytorch_model.bin"))
+    else:
+        save_file(tensors, os.path.join(url, "diffusion_pytorch_model.safetensors"), metadata=metadata)
+
+def test_converted_weights_match_shipped_safetensors(tmp_path):
+    tensors = { "b.weight" : torch.ones(4, 4), "a.bias" : torch.arange(4, dtype=torch.float32) }
+
+    create_component(str(tmp_path / "shipped" / "vae"), tensors, "safetensors", metadata={ "format" : "pt", "author" : "someone" })
+    create_component(str(tmp_path / "pickled" / "vae"), tensors, "bin")
+
+    convert_to_safetensors(str(tmp_path / "pickled"))
+
+    assert component_hash(str(tmp_path / "shipped" / "vae")) == component_hash(str(tmp_path / "pickled" / "vae"))
+
+def test_different_weights_do_not_match(tmp_path):
+    create_component(str(tmp_path / "first" / "vae"), { "weight" : torch.ones(4) }, "safetensors")
+    create_component(str(tmp_path / "second" / "vae"), { "weight" : torch.zeros(4) }, "safetensors")
+
+    assert component_hash(str(tmp_path / "first" / "vae")) != component_hash(str(tmp_path / "second" / "vae"))
@@ -0,0 +1,103 @@
+from threading import Condition
+from uuid import uuid4
+from rendering.scheduling import TaskScheduler
+from rendering.tasks import ImageGeneratorTask, ImageGeneratorOutput, ImageGeneratorTaskSettings, ImageGeneratorBatch
+from rendering.worker import ImageGeneratorWorker
+
+class FakeEncoder:
+    def discard(self, urls):
+        pass
+
+class FakeGenerator:
+    def __init__(self):
+        self.tasks = TaskScheduler()
+        self.workers = []
+        self.base_dimension = 64
+        self.is_optimized = False
+        self.preview_encoder = FakeEncoder()
+
+    def dimensions_for_settings(self, settings):
+        return 64, 64
+
+class Recorder:
+    def __init__(self):
+        self.finished = {}
+        self.condition = Condition()
+
+    def callback(self, task, progress, seed, error=None):
+        with self.condition:
+            if progress >= 1.0:
+                self.finished[task.prompt] = error
+                self.condition.notify_all()
+
+    def wait(self, count):
+        with self.condition:
+            return self.condition.wait_for(lambda: len(self.finished) >= count, timeout=10)
+
+def create_worker():
+    generator = FakeGenerator()
+    worker = ImageGeneratorWorker(generator, "cpu")
+    generator.workers.append(worker)
+
+    return generator, worker
+
+def create_task(recorder, prompt, **settings):
+    return ImageGeneratorTask(
+        prompt=prompt,
+        outputs=[ImageGeneratorOutput(id=uuid4(), url=f"/tmp/{uuid4()}.jpg")],
+        settings=ImageGeneratorTaskSettings.from_dict({ "batch" : 1, "method" : "ddim", **settings }),
+        callback=recorder.callback
+    )
+
+def test_failed_batch_does_not_stop_worker():
+    generator, worker = create_worker()
+    recorder = Recorder()
+
+    def execute_batch(batch):
+        for task in batch.tasks:
+            if task.prompt == "failing":
+                raise RuntimeError("out of memory")
+
+            task.callback(task, 1.0, 0)
+
+    worker.execute_batch = execute_batch
+
+    generator.tasks.put(create_task(recorder, "failing"), key="model")
+    generator.tasks.put(create_task(recorder, "completed", seamless=1), key="model")
+
+    worker.start()
+
+    assert recorder.wait(2) == True
+    assert recorder.finished == { "failing" : "out of memory", "completed" : None }
+    assert worker.daemon.is_alive() == True
+
+def test_missing_initial_image_fails_task():
+    generator, worker = create_worker()
+    recorder = Recorder()
+
+    task = create_task(recorder, "variation", type="variation", initial_url=f"/tmp/{uuid4()}.jpg")
+
+    def prepare_model_if_needed(settings):
+        raise AssertionError("models are not loaded for failed tasks")
+
+    worker.prepare_model_if_needed = prepare_model_if_needed
+    worker.execute_batch(ImageGeneratorBatch(tasks=[task]))
+
+    assert "is missing" in recorder.finished["variation"]
+
+def test_variations_of_same_image_are_batched():
+    generator, worker = create_worker()
+    recorder = Recorder()
+
+    first = create_task(recorder, "first", type="variation", initial_url="/tmp/source.jpg")
+    second = create_task(recorder, "second", type="variation", initial_url="/tmp/source.jpg")
+    other = create_task(recorder, "other", type="variation", initial_url="/tmp/other.jpg")
+
+    for task in [first, second, other]:
+        generator.tasks.put(task, "model")
+
+    assert worker.next_batch().tasks == [first, second]
+
+    worker.running = None
+
+    assert worker.next_batch().tasks == [other]
@@ -21,7 +21,7 @@ export class ActivityStore extends Store<ActivityState> {
 
     public get unfinishedOutputsCount() {
         return computed(() => {
-            return this.state.outputs.filter(output => output.progress < 1).length
+            return this.state.outputs.filter(output => output.progress < 1 && !output.isCancelled && !output.isFailed).length
         })
     }
 
@@ -23,6 +23,8 @@ export interface Output {
     settings : { [key : string] : any }
     isFavorite : boolean
     isArchived : boolean
+    isCancelled : boolean
+    isFailed : boolean
 }
 
 /* State */